@@ -6,6 +6,7 @@ import vtk
 
 from ProstateAblationUtils.appConfig import ConfigurationParser
 from ProstateAblationUtils.session import ProstateAblationSession
+from ProstateAblationUtils.helpers import SeriesTypeManager
 from ProstateAblationUtils.steps.base import ProstateAblationStep
 from ProstateAblationUtils.steps.overview import ProstateAblationOverviewStep
 from ProstateAblationUtils.steps.zFrameRegistration import ProstateAblationZFrameRegistrationStep
@@ -43,6 +44,7 @@ class ProstateAblationWidget(ModuleWidgetMixin, ScriptedLoadableModuleWidget):
     ScriptedLoadableModuleWidget.__init__(self, parent)
     self.modulePath = os.path.dirname(slicer.util.modulePath(self.moduleName))
     ConfigurationParser(os.path.join(self.modulePath, 'Resources', "default.cfg"))
+    SeriesTypeManager().reloadSettings()
     self.logic = ProstateAblationLogic()
 
     self.session = ProstateAblationSession()
@@ -68,6 +70,7 @@ class ProstateAblationWidget(ModuleWidgetMixin, ScriptedLoadableModuleWidget):
   @logmethod(logging.DEBUG)
   def cleanup(self):
     ScriptedLoadableModuleWidget.cleanup(self)
+    self.session.iceBallSliceIntersections.cleanup()
     self.patientWatchBox.sourceFile = None
     self.intraopWatchBox.sourceFile = None
 
@@ -152,17 +155,16 @@ class ProstateAblationWidget(ModuleWidgetMixin, ScriptedLoadableModuleWidget):
   def onUpdateScreenShotDir(self, caller, event):
     self.screenShotButton.caseResultDir = self.session.outputDirectory
 
-  @vtk.calldata_type(vtk.VTK_STRING)
-  def onNewFileIndexed(self, caller, event, callData):
-    text, size, currentIndex = ast.literal_eval(callData)
+  def onNewFileIndexed(self, caller, event):
+    progress = self.session.importProgress
     if not self.customStatusProgressBar.visible:
       self.customStatusProgressBar.show()
-    self.customStatusProgressBar.maximum = size
-    self.customStatusProgressBar.updateStatus(text, currentIndex)
+    self.customStatusProgressBar.maximum = progress.total
+    self.customStatusProgressBar.updateStatus(progress.text, progress.current)
 
   @vtk.calldata_type(vtk.VTK_STRING)
   def onCurrentSeriesChanged(self, caller, event, callData):
-    receivedFile = self.session.loadableList[callData][0] if callData else None
+    receivedFile = self.session.seriesRegistry.get(callData).files[0] if callData else None
     if self.patientWatchBox.sourceFile is None:
       self.patientWatchBox.sourceFile = receivedFile
     self.intraopWatchBox.sourceFile = receivedFile
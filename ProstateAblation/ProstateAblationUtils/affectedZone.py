@@ -0,0 +1,316 @@
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
+
+
+class AffectedZoneGeometryBase(object):
+
+  # The offset and ellipsoid parameters are taken from the following source code
+  # http://viewvc.slicer.org/viewvc.cgi/NAMICSandBox/trunk/IGTLoadableModules/ProstateNav/TransPerinealProstateCryoTemplate/vtkMRMLTransPerinealProstateCryoTemplateNode.cxx?revision=8043&view=markup
+  OFFSET_FROM_TIP = 5.0 # unit mm
+  CONE_HEIGHT = 5.0
+  NEEDLE_RADIUS = 1.5
+  NEEDLE_SIDES = 6
+
+  @property
+  def needlePolyData(self):
+    return self.needleAppend.GetOutput()
+
+  @property
+  def affectedAreaPolyData(self):
+    return self.affectedAreaAppend.GetOutput()
+
+  def __init__(self, guidanceComputation):
+    self.guidanceComputation = guidanceComputation
+    self.needleAppend = vtk.vtkAppendPolyData()
+    self.affectedAreaAppend = vtk.vtkAppendPolyData()
+
+  def clear(self):
+    raise NotImplementedError
+
+  def update(self, markupIDs, positions, needleTypes, radii, zFrameMatrix, templateVersion):
+    raise NotImplementedError
+
+  def computeNeedlePaths(self, positions):
+    (starts, ends, _, _, depths, _) = self.guidanceComputation.computeNearestPaths(positions)
+    directions = ends - starts
+    directions /= numpy.linalg.norm(directions, axis=1)[:, numpy.newaxis]
+    return starts, directions, depths
+
+  def computeIceBallEllipsoids(self, positions, radii, zFrameMatrix):
+    positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+    radii = numpy.asarray(radii, dtype=float).reshape(-1, 3)
+    validRows = radii.all(axis=1)
+    positions, radii = positions[validRows], radii[validRows]
+    starts, directions, depths = self.computeNeedlePaths(positions)
+    centers = starts + (depths + self.OFFSET_FROM_TIP - radii[:, 2])[:, numpy.newaxis] * directions
+    halfAxes = self.getRotation(zFrameMatrix)[numpy.newaxis, :, :] * radii[:, numpy.newaxis, :]
+    return centers, halfAxes
+
+  def createConeSource(self):
+    cone = vtk.vtkConeSource()
+    cone.SetRadius(self.NEEDLE_RADIUS)
+    cone.SetResolution(self.NEEDLE_SIDES)
+    cone.SetHeight(self.CONE_HEIGHT)
+    cone.CappingOff()
+    return cone
+
+  def createConeTipTransform(self):
+    transform = vtk.vtkTransform()
+    transform.RotateY(-90)
+    transform.RotateX(30)
+    transform.Translate(-self.CONE_HEIGHT / 2, 0.0, 0.0)
+    return transform
+
+  @staticmethod
+  def createEllipsoidSource(radius):
+    ellipsoid = vtk.vtkParametricEllipsoid()
+    ellipsoid.SetXRadius(radius[0])
+    ellipsoid.SetYRadius(radius[1])
+    ellipsoid.SetZRadius(radius[2])
+    source = vtk.vtkParametricFunctionSource()
+    source.SetParametricFunction(ellipsoid)
+    source.SetScalarModeToV()
+    return source
+
+  @staticmethod
+  def getRotation(matrix):
+    if isinstance(matrix, vtk.vtkMatrix4x4):
+      matrix = [[matrix.GetElement(row, col) for col in range(4)] for row in range(4)]
+    return numpy.asarray(matrix, dtype=float)[0:3, 0:3]
+
+  @staticmethod
+  def createPoseTransform(rotation, translation):
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(3):
+      for col in range(3):
+        matrix.SetElement(row, col, rotation[row][col])
+      matrix.SetElement(row, 3, translation[row])
+    transform = vtk.vtkTransform()
+    transform.SetMatrix(matrix)
+    return transform
+
+
+class AffectedZoneGeometryCache(AffectedZoneGeometryBase):
+  """ Keeps the needle and ice ball geometry of every displayed target and only rebuilds targets whose markup ID,
+  position, needle type or template transform version changed.
+  """
+
+  def __init__(self, guidanceComputation):
+    super(AffectedZoneGeometryCache, self).__init__(guidanceComputation)
+    self.clear()
+
+  def clear(self):
+    self._entries = {}
+    self._order = []
+    self.needleAppend.RemoveAllInputs()
+    self.affectedAreaAppend.RemoveAllInputs()
+    self.needlePolyData.Initialize()
+    self.affectedAreaPolyData.Initialize()
+
+  def update(self, markupIDs, positions, needleTypes, radii, zFrameMatrix, templateVersion):
+    markupIDs = list(markupIDs)
+    positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+    radii = numpy.asarray(radii, dtype=float).reshape(-1, 3)
+    keys = [(tuple(position), needleType, tuple(radius), templateVersion)
+            for position, needleType, radius in zip(positions, needleTypes, radii)]
+    staleRows = [row for row, markupID in enumerate(markupIDs)
+                 if markupID not in self._entries or self._entries[markupID][0] != keys[row]]
+
+    if staleRows:
+      rotation = self.getRotation(zFrameMatrix)
+      starts, directions, depths = self.computeNeedlePaths(positions[staleRows])
+      for start, direction, depth, row in zip(starts, directions, depths, staleRows):
+        self._entries[markupIDs[row]] = (keys[row],
+                                         self.createNeedlePolyData(start, direction, depth, rotation),
+                                         self.createIceBallPolyData(start, direction, depth, radii[row], rotation))
+
+    for markupID in set(self._entries.keys()) - set(markupIDs):
+      del self._entries[markupID]
+    self.spliceIntoAppendedOutput(markupIDs, [markupIDs[row] for row in staleRows])
+    return len(staleRows)
+
+  def spliceIntoAppendedOutput(self, markupIDs, updatedMarkupIDs):
+    if markupIDs != self._order:
+      self.needleAppend.RemoveAllInputs()
+      self.affectedAreaAppend.RemoveAllInputs()
+      for markupID in markupIDs:
+        _, needle, iceBall = self._entries[markupID]
+        self.needleAppend.AddInputData(needle)
+        self.affectedAreaAppend.AddInputData(iceBall)
+      self._order = markupIDs
+    elif updatedMarkupIDs:
+      for markupID in updatedMarkupIDs:
+        _, needle, iceBall = self._entries[markupID]
+        self.needleAppend.SetInputDataByNumber(self._order.index(markupID), needle)
+        self.affectedAreaAppend.SetInputDataByNumber(self._order.index(markupID), iceBall)
+    else:
+      return
+    for append in [self.needleAppend, self.affectedAreaAppend]:
+      if append.GetNumberOfInputConnections(0):
+        append.Update()
+      else:
+        append.GetOutput().Initialize()
+
+  def createNeedlePolyData(self, start, direction, depth, rotation):
+    cone = self.createConeSource()
+    cone.Update()
+    tFilter0 = vtk.vtkTransformPolyDataFilter()
+    tFilter0.SetInputData(cone.GetOutput())
+    tFilter0.SetTransform(self.createConeTipTransform())
+    tFilter0.Update()
+    tFilter1 = vtk.vtkTransformPolyDataFilter()
+    tFilter1.SetTransform(self.createPoseTransform(rotation, start + depth * direction))
+    tFilter1.SetInputData(tFilter0.GetOutput())
+    tFilter1.Update()
+    pathTubeFilter = ModuleLogicMixin.createVTKTubeFilter(start, start + (depth - self.CONE_HEIGHT) * direction,
+                                                          radius=self.NEEDLE_RADIUS, numSides=self.NEEDLE_SIDES)
+    needleAppend = vtk.vtkAppendPolyData()
+    needleAppend.AddInputData(tFilter1.GetOutput())
+    needleAppend.AddInputData(pathTubeFilter.GetOutput())
+    needleAppend.Update()
+    return needleAppend.GetOutput()
+
+  def createIceBallPolyData(self, start, direction, depth, radius, rotation):
+    affectedBallAreaSource = self.createEllipsoidSource(radius)
+    affectedBallAreaSource.Update()
+    tFilter = vtk.vtkTransformPolyDataFilter()
+    tFilter.SetTransform(self.createPoseTransform(rotation,
+                                                  start + (depth + self.OFFSET_FROM_TIP - radius[2]) * direction))
+    tFilter.SetInputData(affectedBallAreaSource.GetOutput())
+    tFilter.Update()
+    return tFilter.GetOutput()
+
+
+class AffectedZoneGlyphRenderer(AffectedZoneGeometryBase):
+  """ Instances one prototype mesh per needle part and needle type through tensor glyph filters, so that the pipeline
+  size does not depend on the number of displayed targets.
+
+  The tensor of every glyph is the z-frame rotation with the columns scaled by the per target stretch, which
+  places the prototypes (needle axis along +z, tip in the origin) at the needle tip.
+  """
+
+  # (maximum number of displayed targets, ellipsoid u/v resolution)
+  LEVELS_OF_DETAIL = [(8, 48), (20, 24), (40, 16), (None, 10)]
+
+  def __init__(self, guidanceComputation):
+    super(AffectedZoneGlyphRenderer, self).__init__(guidanceComputation)
+    self.resolution = None
+    self.coneGlyph = self.createTensorGlyph(self.createConePrototype())
+    self.shaftGlyph = self.createTensorGlyph(self.createShaftPrototype())
+    self.needleAppend.AddInputConnection(self.coneGlyph.GetOutputPort())
+    self.needleAppend.AddInputConnection(self.shaftGlyph.GetOutputPort())
+    self.iceBallGlyphs = {}
+    self.clear()
+
+  def clear(self):
+    for glyph in [self.coneGlyph, self.shaftGlyph] + [glyph for _, glyph, _ in self.iceBallGlyphs.values()]:
+      glyph.SetInputData(self.createGlyphInput(numpy.zeros((0, 3)), numpy.zeros((0, 9))))
+    self.needleAppend.Update()
+    if self.iceBallGlyphs:
+      self.affectedAreaAppend.Update()
+
+  def createConePrototype(self):
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputConnection(self.createConeSource().GetOutputPort())
+    transformFilter.SetTransform(self.createConeTipTransform())
+    return transformFilter
+
+  def createShaftPrototype(self):
+    line = vtk.vtkLineSource()
+    line.SetPoint1(0.0, 0.0, 0.0)
+    line.SetPoint2(0.0, 0.0, 1.0)
+    tube = vtk.vtkTubeFilter()
+    tube.SetInputConnection(line.GetOutputPort())
+    tube.SetRadius(self.NEEDLE_RADIUS)
+    tube.SetNumberOfSides(self.NEEDLE_SIDES)
+    return tube
+
+  @staticmethod
+  def createTensorGlyph(prototype):
+    glyph = vtk.vtkTensorGlyph()
+    glyph.SetSourceConnection(prototype.GetOutputPort())
+    glyph.ExtractEigenvaluesOff()
+    glyph.ThreeGlyphsOff()
+    glyph.SymmetricOff()
+    glyph.ColorGlyphsOff()
+    glyph.ClampScalingOff()
+    glyph.ScalingOn()
+    glyph.SetScaleFactor(1.0)
+    return glyph
+
+  @staticmethod
+  def createGlyphInput(points, tensors):
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(points, dtype=float), deep=True))
+    vtkTensors = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(tensors, dtype=float), deep=True)
+    vtkTensors.SetName("Pose")
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(vtkPoints)
+    polyData.GetPointData().SetTensors(vtkTensors)
+    return polyData
+
+  @staticmethod
+  def createTensors(rotation, scales):
+    # vtkTensorGlyph maps the prototype's x, y and z axes to the tensor components 0-2, 3-5 and 6-8
+    scales = numpy.asarray(scales, dtype=float).reshape(-1, 3)
+    return (rotation.T[numpy.newaxis, :, :] * scales[:, :, numpy.newaxis]).reshape(-1, 9)
+
+  def getResolutionForNumberOfTargets(self, numberOfTargets):
+    for maximum, resolution in self.LEVELS_OF_DETAIL:
+      if maximum is None or numberOfTargets <= maximum:
+        return resolution
+
+  def getOrCreateIceBallGlyph(self, needleType, radius):
+    source, glyph, currentRadius = self.iceBallGlyphs.get(needleType, (None, None, None))
+    if source is None or currentRadius != tuple(radius):
+      source = self.createEllipsoidSource(radius)
+      source.SetUResolution(self.resolution)
+      source.SetVResolution(self.resolution)
+      if glyph is None:
+        glyph = self.createTensorGlyph(source)
+        self.affectedAreaAppend.AddInputConnection(glyph.GetOutputPort())
+      else:
+        glyph.SetSourceConnection(source.GetOutputPort())
+      self.iceBallGlyphs[needleType] = (source, glyph, tuple(radius))
+    return glyph
+
+  def setResolution(self, resolution):
+    if resolution == self.resolution:
+      return
+    self.resolution = resolution
+    for source, _, _ in self.iceBallGlyphs.values():
+      source.SetUResolution(resolution)
+      source.SetVResolution(resolution)
+
+  def update(self, markupIDs, positions, needleTypes, radii, zFrameMatrix, templateVersion):
+    positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+    radii = numpy.asarray(radii, dtype=float).reshape(-1, 3)
+    self.setResolution(self.getResolutionForNumberOfTargets(len(positions)))
+    rotation = self.getRotation(zFrameMatrix)
+    starts, directions, depths = self.computeNeedlePaths(positions)
+    tips = starts + depths[:, numpy.newaxis] * directions
+    numberOfTargets = len(positions)
+
+    unitScales = numpy.ones((numberOfTargets, 3))
+    self.coneGlyph.SetInputData(self.createGlyphInput(tips, self.createTensors(rotation, unitScales)))
+    shaftLengths = numpy.maximum(depths - self.CONE_HEIGHT, 1e-3)
+    shaftScales = numpy.column_stack((numpy.ones(numberOfTargets), numpy.ones(numberOfTargets), shaftLengths))
+    self.shaftGlyph.SetInputData(self.createGlyphInput(starts, self.createTensors(rotation, shaftScales)))
+    self.needleAppend.Update()
+
+    for needleType in set(needleTypes) | set(self.iceBallGlyphs.keys()):
+      rows = [row for row, currentType in enumerate(needleTypes) if currentType == needleType and radii[row].any()]
+      if rows:
+        glyph = self.getOrCreateIceBallGlyph(needleType, radii[rows[0]])
+      elif needleType in self.iceBallGlyphs:
+        glyph = self.iceBallGlyphs[needleType][1]
+      else:
+        continue
+      centers = starts[rows] + (depths[rows] + self.OFFSET_FROM_TIP - radii[rows, 2])[:, numpy.newaxis] * directions[rows]
+      glyph.SetInputData(self.createGlyphInput(centers, self.createTensors(rotation, numpy.ones((len(rows), 3)))))
+    if self.iceBallGlyphs:
+      self.affectedAreaAppend.Update()
+    return numberOfTargets
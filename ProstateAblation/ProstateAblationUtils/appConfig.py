@@ -73,5 +73,40 @@ class ConfigurationParser(ModuleWidgetMixin):
         (not self.config.get('CurrentNeedleType', 'NeedleType') == self.getSetting("NeedleType")) :
       self.setSetting("NeedleType", self.config.get('CurrentNeedleType', 'NeedleType'))
 
+    if not self.getSetting("AffectedZone_Rendering") or \
+        (not self.config.get('AffectedZone', 'Rendering') == self.getSetting("AffectedZone_Rendering")) :
+      self.setSetting("AffectedZone_Rendering", self.config.get('AffectedZone', 'Rendering'))
+
+    if not self.getSetting("AffectedZone_SliceIntersection") or \
+        (not self.config.get('AffectedZone', 'SliceIntersection') == self.getSetting("AffectedZone_SliceIntersection")) :
+      self.setSetting("AffectedZone_SliceIntersection", self.config.get('AffectedZone', 'SliceIntersection'))
+
+    self.setSetting("Recomputation_MaxRate", self.config.get('Recomputation', 'MaxRate'))
+    self.setSetting("Import_TimeSlice", self.config.get('Import', 'TimeSlice'))
+    self.setSetting("Import_ProgressRate", self.config.get('Import', 'ProgressRate'))
+    self.setSetting("Import_HardLink", self.config.get('Import', 'HardLink'))
+
+    if not self.getSetting("Intraop_Watcher_Mode") or \
+        (not self.config.get('Intraop Watcher', 'Mode') == self.getSetting("Intraop_Watcher_Mode")) :
+      self.setSetting("Intraop_Watcher_Mode", self.config.get('Intraop Watcher', 'Mode'))
+
+    if not self.getSetting("Intraop_Storage_Layout") or \
+        (not self.config.get('Intraop Storage', 'Layout') == self.getSetting("Intraop_Storage_Layout")) :
+      self.setSetting("Intraop_Storage_Layout", self.config.get('Intraop Storage', 'Layout'))
+
+    self.setSetting("Series_Assembly_StallTimeout", self.config.get('Series Assembly', 'StallTimeout'))
+
+    if not self.getSetting("Volume_Loader") or \
+        (not self.config.get('Volume Loading', 'Loader') == self.getSetting("Volume_Loader")) :
+      self.setSetting("Volume_Loader", self.config.get('Volume Loading', 'Loader'))
+
+    self.setSetting("Prefetch_Enabled", self.config.get('Prefetch', 'Enabled'))
+    self.setSetting("Prefetch_SeriesTypes", self.config.get('Prefetch', 'SeriesTypes'))
+    self.setSetting("Prefetch_MemoryLimit", self.config.get('Prefetch', 'MemoryLimit'))
+    self.setSetting("Volume_Cache_MemoryLimit", self.config.get('Volume Cache', 'MemoryLimit'))
+
+    for key in ['Enabled', 'MinimumSlices', 'SliceStep', 'InPlaneStep']:
+      self.setSetting("Progressive_Display_%s" % key, self.config.get('Progressive Display', key))
+
 
 
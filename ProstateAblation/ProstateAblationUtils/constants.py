@@ -8,6 +8,23 @@ class ProstateAblationConstants(object):
 
   JSON_FILENAME = "results.json"
 
+  DICOM_HEADER_INDEX_FILENAME = "intraopHeaderIndex.json"
+
+  DICOM_INSTANCE_NUMBER = '0020,0013'
+  DICOM_SOP_INSTANCE_UID = '0008,0018'
+  DICOM_SERIES_INSTANCE_UID = '0020,000E'
+  DICOM_IMAGES_IN_ACQUISITION = '0020,1002'
+  DICOM_NUMBER_OF_FRAMES = '0028,0008'
+  DICOM_IMAGE_POSITION_PATIENT = '0020,0032'
+  DICOM_IMAGE_ORIENTATION_PATIENT = '0020,0037'
+  DICOM_PIXEL_SPACING = '0028,0030'
+  DICOM_ROWS = '0028,0010'
+  DICOM_COLUMNS = '0028,0011'
+  DICOM_BITS_ALLOCATED = '0028,0100'
+  DICOM_PIXEL_REPRESENTATION = '0028,0103'
+  DICOM_RESCALE_INTERCEPT = '0028,1052'
+  DICOM_RESCALE_SLOPE = '0028,1053'
+
   LAYOUT_RED_SLICE_ONLY = slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpRedSliceView
   LAYOUT_FOUR_UP = slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView
   LAYOUT_SIDE_BY_SIDE = slicer.vtkMRMLLayoutNode.SlicerLayoutSideBySideView
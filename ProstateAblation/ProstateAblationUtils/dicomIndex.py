@@ -0,0 +1,452 @@
+import os
+import qt
+import ctk
+import json
+import slicer
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from constants import ProstateAblationConstants as constants
+from SlicerDevelopmentToolboxUtils.constants import DICOMTAGS
+from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
+
+try:
+  import pydicom as dicom
+except ImportError:
+  try:
+    import dicom
+  except ImportError:
+    dicom = None
+
+
+class DICOMHeaderIndex(object):
+  """ Header values of all DICOM files within a directory which are needed for the series bookkeeping. Every file is
+  parsed once, the series to files mapping is kept up to date incrementally and everything is persisted to a JSON
+  sidecar, so that reopening a case only parses files which were added or changed since.
+  """
+
+  VERSION = 6
+
+  FIELDS = {
+    "SeriesNumber": DICOMTAGS.SERIES_NUMBER,
+    "SeriesDescription": DICOMTAGS.SERIES_DESCRIPTION,
+    "PatientID": DICOMTAGS.PATIENT_ID,
+    "PatientName": DICOMTAGS.PATIENT_NAME,
+    "InstanceNumber": constants.DICOM_INSTANCE_NUMBER,
+    "SOPInstanceUID": constants.DICOM_SOP_INSTANCE_UID,
+    "SeriesInstanceUID": constants.DICOM_SERIES_INSTANCE_UID,
+    "ImagesInAcquisition": constants.DICOM_IMAGES_IN_ACQUISITION,
+    "NumberOfFrames": constants.DICOM_NUMBER_OF_FRAMES,
+    "ImagePositionPatient": constants.DICOM_IMAGE_POSITION_PATIENT,
+    "ImageOrientationPatient": constants.DICOM_IMAGE_ORIENTATION_PATIENT,
+    "PixelSpacing": constants.DICOM_PIXEL_SPACING,
+    "Rows": constants.DICOM_ROWS,
+    "Columns": constants.DICOM_COLUMNS,
+    "BitsAllocated": constants.DICOM_BITS_ALLOCATED,
+    "PixelRepresentation": constants.DICOM_PIXEL_REPRESENTATION,
+    "RescaleIntercept": constants.DICOM_RESCALE_INTERCEPT,
+    "RescaleSlope": constants.DICOM_RESCALE_SLOPE
+  }
+
+  MISSING_VALUES = [None, "", "__TAG_NOT_IN_INSTANCE__"]
+
+  MINIMUM_FILES_FOR_THREAD_POOL = 8
+
+  def __init__(self, directory, sidecarFileName, numberOfWorkers=None):
+    self.directory = directory
+    self.numberOfWorkers = numberOfWorkers or min(8, multiprocessing.cpu_count())
+    self.sidecarFileName = sidecarFileName
+    self.entries = {}
+    self.seriesFiles = {}
+    self.instances = {}
+    self.movedFiles = {}
+    self.skippedDuplicates = 0
+    self.modified = False
+    self.pool = None
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, fileName):
+    return self.getRelativePath(fileName) in self.entries
+
+  def getRelativePath(self, fileName):
+    return os.path.relpath(os.path.join(self.directory, fileName), self.directory)
+
+  def getAbsolutePath(self, relativePath):
+    return os.path.join(self.directory, relativePath)
+
+  def load(self):
+    self.entries = {}
+    self.movedFiles = {}
+    if os.path.exists(self.sidecarFileName):
+      try:
+        with open(self.sidecarFileName) as sidecarFile:
+          data = json.load(sidecarFile)
+        if data.get("version") == self.VERSION:
+          self.entries = data.get("files", {})
+          self.movedFiles = data.get("moved", {})
+      except (IOError, ValueError):
+        logging.warning("DICOM header index %s could not be read and will be rebuilt" % self.sidecarFileName)
+    self.rebuildSeriesFiles()
+    self.modified = False
+
+  def save(self):
+    if not self.modified:
+      return
+    temporaryFileName = self.sidecarFileName + ".tmp"
+    with open(temporaryFileName, 'w') as outfile:
+      json.dump({"version": self.VERSION, "files": self.entries, "moved": self.movedFiles}, outfile)
+    if os.path.exists(self.sidecarFileName):
+      os.remove(self.sidecarFileName)
+    os.rename(temporaryFileName, self.sidecarFileName)
+    self.modified = False
+
+  def update(self, fileNames, progressCallback=None, skippedFiles=None):
+    """ Parses all files which are not indexed yet or changed on disk and returns the relative paths of the instances
+    which were not known before. Headers are read on a thread pool, which is kept until the index is cancelled, while
+    the results are merged on the calling thread in file order. Files holding an already indexed SOPInstanceUID are
+    counted as skipped duplicates and are appended to skippedFiles instead.
+    """
+    staleFiles = []
+    for fileName in fileNames:
+      relativePath = self.getRelativePath(fileName)
+      fileStat = self.getFileStat(relativePath)
+      if fileStat is None:
+        self.remove(relativePath)
+        continue
+      entry = self.entries.get(relativePath)
+      if not entry or entry["stat"] != fileStat:
+        staleFiles.append((relativePath, fileStat))
+    headers = self.readHeaders([self.getAbsolutePath(relativePath) for relativePath, _ in staleFiles], progressCallback)
+    newFiles = []
+    for (relativePath, fileStat), header in zip(staleFiles, headers):
+      if self.addEntry(relativePath, header, fileStat):
+        newFiles.append(relativePath)
+      else:
+        self.skippedDuplicates += 1
+        if skippedFiles is not None:
+          skippedFiles.append(relativePath)
+    return newFiles
+
+  def readHeaders(self, fileNames, progressCallback=None):
+    if dicom is None or self.numberOfWorkers < 2 or len(fileNames) < self.MINIMUM_FILES_FOR_THREAD_POOL:
+      headers = []
+      for fileName in fileNames:
+        headers.append(self.readHeader(fileName))
+        if progressCallback:
+          progressCallback(len(headers), len(fileNames))
+      return headers
+    headers = []
+    for header in self.getPool().imap(self.readHeaderFromFileOrNone, fileNames, chunksize=4):
+      headers.append(header)
+      if progressCallback:
+        progressCallback(len(headers), len(fileNames))
+    # the DICOM database is not thread safe, therefore files that could not be parsed are read here
+    return [self.readHeader(fileName) if header is None else self.normalizeHeader(header)
+            for fileName, header in zip(fileNames, headers)]
+
+  def getPool(self):
+    if self.pool is None:
+      self.pool = ThreadPool(self.numberOfWorkers)
+    return self.pool
+
+  def cancel(self):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool.join()
+      self.pool = None
+
+  def getFileStat(self, relativePath):
+    try:
+      fileStat = os.stat(self.getAbsolutePath(relativePath))
+    except OSError:
+      return None
+    return [fileStat.st_size, fileStat.st_mtime]
+
+  def addEntry(self, relativePath, header, fileStat):
+    """ Returns False if the file holds an instance which was indexed before, either from another file or from this
+    file before it was rewritten
+    """
+    uid = header.get("SOPInstanceUID")
+    previousEntry = self.entries.get(relativePath)
+    wasOriginal = previousEntry is not None and "DuplicateOf" not in previousEntry
+    resent = wasOriginal and uid and previousEntry.get("SOPInstanceUID") == uid
+    self.remove(relativePath, promoteDuplicate=False)
+    entry = dict(header)
+    entry["stat"] = fileStat
+    originalPath = self.instances.get(uid) if uid else None
+    if originalPath is not None:
+      entry["DuplicateOf"] = originalPath
+    self.entries[relativePath] = entry
+    self.addToLookups(relativePath, entry)
+    if wasOriginal and not resent:
+      self.promoteDuplicate(relativePath)
+    self.modified = True
+    return originalPath is None and not resent
+
+  def addToLookups(self, relativePath, entry):
+    if "DuplicateOf" in entry:
+      return
+    seriesNumber = self.getSeriesNumber(entry)
+    if seriesNumber is not None:
+      self.seriesFiles.setdefault(seriesNumber, set()).add(relativePath)
+    uid = entry.get("SOPInstanceUID")
+    if uid:
+      self.instances[uid] = relativePath
+
+  def hasInstance(self, uid):
+    return uid is not None and uid in self.instances
+
+  def isDuplicate(self, fileName):
+    entry = self.entries.get(self.getRelativePath(fileName))
+    return entry is not None and "DuplicateOf" in entry
+
+  def remove(self, fileName, promoteDuplicate=True):
+    relativePath = self.getRelativePath(fileName)
+    entry = self.entries.pop(relativePath, None)
+    if entry is None:
+      return
+    self.modified = True
+    if "DuplicateOf" in entry:
+      return
+    seriesNumber = self.getSeriesNumber(entry)
+    if seriesNumber in self.seriesFiles:
+      self.seriesFiles[seriesNumber].discard(relativePath)
+      if not self.seriesFiles[seriesNumber]:
+        del self.seriesFiles[seriesNumber]
+    uid = entry.get("SOPInstanceUID")
+    if uid and self.instances.get(uid) == relativePath:
+      del self.instances[uid]
+      if promoteDuplicate:
+        self.promoteDuplicate(relativePath)
+
+  def promoteDuplicate(self, originalPath):
+    """ Lets the first remaining duplicate of a removed file take its place """
+    duplicates = sorted(p for p, e in self.entries.iteritems() if e.get("DuplicateOf") == originalPath)
+    for relativePath in duplicates:
+      if relativePath == duplicates[0]:
+        del self.entries[relativePath]["DuplicateOf"]
+        self.addToLookups(relativePath, self.entries[relativePath])
+      else:
+        self.entries[relativePath]["DuplicateOf"] = duplicates[0]
+
+  def moveFiles(self, moves):
+    """ Updates the entries of files which were moved within the directory. moves maps old to new relative paths. """
+    if not moves:
+      return
+    for oldPath, newPath in moves.iteritems():
+      entry = self.entries.pop(oldPath, None)
+      if entry is None:
+        continue
+      fileStat = self.getFileStat(newPath)
+      if fileStat is not None:
+        entry["stat"] = fileStat
+      self.entries[newPath] = entry
+      if "DuplicateOf" in entry:
+        continue
+      seriesNumber = self.getSeriesNumber(entry)
+      if seriesNumber in self.seriesFiles:
+        self.seriesFiles[seriesNumber].discard(oldPath)
+      self.addToLookups(newPath, entry)
+    for entry in self.entries.itervalues():
+      if entry.get("DuplicateOf") in moves:
+        entry["DuplicateOf"] = moves[entry["DuplicateOf"]]
+    for oldPath, newPath in moves.iteritems():
+      # a resent file with the name of a moved one keeps resolving to the file moved first while that is indexed
+      if self.movedFiles.get(oldPath) not in self.entries:
+        self.movedFiles[oldPath] = newPath
+    self.modified = True
+
+  def resolveMovedFile(self, fileName):
+    """ Returns the relative path a file was moved to by moveFiles, or its own relative path if it was not moved or a
+    file exists at its original location again
+    """
+    relativePath = self.getRelativePath(fileName)
+    movedPath = self.movedFiles.get(relativePath)
+    if movedPath is None or os.path.exists(self.getAbsolutePath(relativePath)):
+      return relativePath
+    return movedPath
+
+  def removeSeries(self, seriesNumber):
+    """ Removes all files of the series including its duplicates and the records of their moves and returns the
+    absolute paths of the duplicates
+    """
+    duplicates = [p for p, e in self.entries.iteritems() if "DuplicateOf" in e and self.getSeriesNumber(e) == seriesNumber]
+    removedFiles = set(duplicates) | self.seriesFiles.get(seriesNumber, set())
+    for relativePath in removedFiles:
+      self.remove(relativePath, promoteDuplicate=False)
+    movedFiles = dict((oldPath, newPath) for oldPath, newPath in self.movedFiles.iteritems()
+                      if newPath not in removedFiles)
+    if len(movedFiles) != len(self.movedFiles):
+      self.movedFiles = movedFiles
+      self.modified = True
+    return [self.getAbsolutePath(relativePath) for relativePath in duplicates]
+
+  def rebuildSeriesFiles(self):
+    self.seriesFiles = {}
+    self.instances = {}
+    for relativePath, entry in self.entries.iteritems():
+      self.addToLookups(relativePath, entry)
+
+  def getValue(self, fileName, field):
+    entry = self.entries.get(self.getRelativePath(fileName))
+    return entry.get(field) if entry else None
+
+  def getIntegerValue(self, fileName, field):
+    try:
+      return int(self.getValue(fileName, field))
+    except (TypeError, ValueError):
+      return None
+
+  def getFloatValues(self, fileName, field):
+    """ Returns the values of a multi-valued field, which are stored separated by backslashes like ctk reports them
+    """
+    try:
+      return [float(value) for value in self.getValue(fileName, field).split("\\")]
+    except (AttributeError, ValueError):
+      return None
+
+  def getSeriesNumber(self, entry):
+    try:
+      return int(entry.get("SeriesNumber"))
+    except (TypeError, ValueError):
+      return None
+
+  def getSeriesNumberForFile(self, fileName):
+    entry = self.entries.get(self.getRelativePath(fileName))
+    return self.getSeriesNumber(entry) if entry and "DuplicateOf" not in entry else None
+
+  def getFilesForSeries(self, seriesNumber):
+    relativePaths = self.seriesFiles.get(seriesNumber, [])
+    return [self.getAbsolutePath(relativePath) for relativePath in sorted(relativePaths, key=self.getInstanceSortKey)]
+
+  def getInstanceSortKey(self, relativePath):
+    try:
+      return int(self.entries[relativePath].get("InstanceNumber")), relativePath
+    except (TypeError, ValueError):
+      return None, relativePath
+
+  def getPatientInformation(self, fileName):
+    return {
+      "PatientID": self.getValue(fileName, "PatientID"),
+      "PatientName": self.getValue(fileName, "PatientName"),
+      "SeriesDescription": self.getValue(fileName, "SeriesDescription")}
+
+  @classmethod
+  def readHeader(cls, fileName):
+    header = cls.readHeaderFromFileOrNone(fileName) if dicom is not None else None
+    if header is None:
+      header = dict((field, ModuleLogicMixin.getDICOMValue(fileName, tag)) for field, tag in cls.FIELDS.items())
+    return cls.normalizeHeader(header)
+
+  @classmethod
+  def normalizeHeader(cls, header):
+    return dict((field, None if value in cls.MISSING_VALUES else value) for field, value in header.items())
+
+  @classmethod
+  def readHeaderFromFileOrNone(cls, fileName):
+    try:
+      return cls.readHeaderFromFile(fileName)
+    except Exception as exc:
+      logging.debug("Could not parse DICOM header of %s: %s" % (fileName, exc))
+      return None
+
+  @classmethod
+  def getTags(cls):
+    return dict((field, tuple(int(part, 16) for part in tag.split(","))) for field, tag in cls.FIELDS.items())
+
+  @classmethod
+  def readHeaderFromFile(cls, fileName):
+    tags = cls.getTags()
+    try:
+      dataset = dicom.read_file(fileName, stop_before_pixels=True, specific_tags=tags.values())
+    except TypeError:
+      # dicom versions before pydicom 1.0 cannot restrict parsing to specific tags
+      dataset = dicom.read_file(fileName, stop_before_pixels=True)
+    header = {}
+    for field, tag in tags.items():
+      dataElement = dataset.get(tag)
+      if dataElement is None or dataElement.value is None:
+        header[field] = None
+      elif dataElement.VM > 1:
+        header[field] = "\\".join(str(value).strip() for value in dataElement.value)
+      else:
+        header[field] = str(dataElement.value).strip()
+    return header
+
+
+class DICOMDatabaseIndexer(object):
+  """ Adds files to the Slicer DICOM database a whole chunk per indexer call instead of one call per file. Files whose
+  headers are already known from the header index can be deferred to a background pass running at idle time, as
+  volumes are loaded from the files directly and never wait for the database. Deferred files which were added before,
+  during this session or an earlier one, are skipped.
+  """
+
+  CHUNK_SIZE = 200
+  DEFERRED_CHUNK_SIZE = 25
+  DEFERRED_INTERVAL = 100 # unit ms
+
+  @property
+  def database(self):
+    return slicer.dicomDatabase
+
+  def __init__(self):
+    self.indexer = ctk.ctkDICOMIndexer()
+    self.deferredFiles = []
+    self.indexedFiles = set()
+    self.timer = qt.QTimer()
+    self.timer.setSingleShot(True)
+    self.timer.connect('timeout()', self.indexDeferredChunk)
+
+  def addFiles(self, fileNames, progressCallback=None):
+    fileNames = list(fileNames)
+    self.removeDeferredFiles(fileNames)
+    for start in range(0, len(fileNames), self.CHUNK_SIZE):
+      chunk = fileNames[start:start + self.CHUNK_SIZE]
+      self.addChunk(chunk)
+      if progressCallback:
+        progressCallback(start + len(chunk), len(fileNames))
+
+  def addChunk(self, fileNames):
+    if not fileNames:
+      return
+    try:
+      self.indexer.addListOfFiles(self.database, fileNames, "")
+    except (AttributeError, TypeError, ValueError):
+      for fileName in fileNames:
+        self.indexer.addFile(self.database, fileName, None)
+    self.indexedFiles.update(fileNames)
+
+  def isIndexed(self, fileName):
+    if fileName in self.indexedFiles:
+      return True
+    try:
+      return bool(self.database.fileExistsAndUpToDate(fileName))
+    except AttributeError:
+      return False
+
+  def deferFiles(self, fileNames):
+    deferredFiles = set(self.deferredFiles)
+    self.deferredFiles += [fileName for fileName in fileNames
+                           if fileName not in deferredFiles and fileName not in self.indexedFiles]
+    if self.deferredFiles and not self.timer.isActive():
+      self.timer.start(self.DEFERRED_INTERVAL)
+
+  def removeDeferredFiles(self, fileNames):
+    if self.deferredFiles:
+      fileNames = set(fileNames)
+      self.deferredFiles = [fileName for fileName in self.deferredFiles if fileName not in fileNames]
+
+  def indexDeferredChunk(self):
+    chunk, self.deferredFiles = self.deferredFiles[:self.DEFERRED_CHUNK_SIZE], \
+                                self.deferredFiles[self.DEFERRED_CHUNK_SIZE:]
+    self.addChunk([fileName for fileName in chunk if not self.isIndexed(fileName)])
+    if self.deferredFiles:
+      self.timer.start(self.DEFERRED_INTERVAL)
+
+  def cancel(self):
+    self.timer.stop()
+    self.deferredFiles = []
+    self.indexedFiles = set()
@@ -0,0 +1,195 @@
+import os
+import sys
+import ctypes
+import ctypes.util
+import errno
+import struct
+import logging
+import qt
+
+
+class DirectoryWatcherBase(object):
+  """ Reports files of a directory once they have been completely written. The callback receives the list of file
+  names relative to the watched directory.
+  """
+
+  def __init__(self, directory, callback):
+    self.directory = directory
+    self.callback = callback
+
+  @staticmethod
+  def isIgnored(fileName):
+    return fileName.startswith(".")
+
+  def reportFiles(self, fileNames):
+    fileNames = [f for f in fileNames if not self.isIgnored(f) and os.path.isfile(os.path.join(self.directory, f))]
+    if fileNames:
+      self.callback(fileNames)
+
+  def start(self):
+    raise NotImplementedError
+
+  def stop(self):
+    raise NotImplementedError
+
+
+class InotifyDirectoryWatcher(DirectoryWatcherBase):
+  """ Uses Linux inotify, so that every file is reported as soon as the writer closes it or moves it into place.
+  """
+
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_TO = 0x00000080
+  IN_Q_OVERFLOW = 0x00004000
+  IN_NONBLOCK = 0x00000800
+  IN_CLOEXEC = 0x00080000
+
+  EVENT_HEADER = struct.Struct("iIII")
+  READ_SIZE = 64 * 1024
+
+  _libc = None
+
+  @classmethod
+  def getLibC(cls):
+    if cls._libc is None and sys.platform.startswith("linux"):
+      try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        cls._libc = libc
+      except (OSError, AttributeError):
+        cls._libc = None
+    return cls._libc
+
+  @classmethod
+  def isAvailable(cls):
+    return cls.getLibC() is not None
+
+  def __init__(self, directory, callback):
+    super(InotifyDirectoryWatcher, self).__init__(directory, callback)
+    self.fileDescriptor = None
+    self.notifier = None
+
+  def start(self):
+    libc = self.getLibC()
+    fileDescriptor = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    if fileDescriptor < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    if libc.inotify_add_watch(fileDescriptor, self.directory.encode(sys.getfilesystemencoding() or "utf-8"),
+                              self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+      error = ctypes.get_errno()
+      os.close(fileDescriptor)
+      raise OSError(error, "inotify_add_watch failed for %s" % self.directory)
+    self.fileDescriptor = fileDescriptor
+    self.notifier = qt.QSocketNotifier(fileDescriptor, qt.QSocketNotifier.Read)
+    self.notifier.connect('activated(int)', self.onReadyRead)
+
+  def stop(self):
+    if self.notifier:
+      self.notifier.setEnabled(False)
+      self.notifier.disconnect('activated(int)', self.onReadyRead)
+      self.notifier = None
+    if self.fileDescriptor is not None:
+      os.close(self.fileDescriptor)
+      self.fileDescriptor = None
+
+  def onReadyRead(self, fileDescriptor=None):
+    fileNames = []
+    overflow = False
+    while self.fileDescriptor is not None:
+      try:
+        data = os.read(self.fileDescriptor, self.READ_SIZE)
+      except OSError as exc:
+        if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          break
+        raise
+      if not data:
+        break
+      events, eventsOverflowed = self.parseEvents(data)
+      fileNames += [name for name in events if name not in fileNames]
+      overflow = overflow or eventsOverflowed
+    if overflow:
+      logging.warning("inotify event queue overflowed for %s, rescanning" % self.directory)
+      fileNames = os.listdir(self.directory)
+    self.reportFiles(fileNames)
+
+  @classmethod
+  def parseEvents(cls, data):
+    fileNames = []
+    overflow = False
+    offset = 0
+    while offset + cls.EVENT_HEADER.size <= len(data):
+      _, mask, _, nameLength = cls.EVENT_HEADER.unpack_from(data, offset)
+      offset += cls.EVENT_HEADER.size
+      name = data[offset:offset + nameLength].split(b"\0", 1)[0]
+      offset += nameLength
+      if mask & cls.IN_Q_OVERFLOW:
+        overflow = True
+      elif name:
+        fileNames.append(name.decode(sys.getfilesystemencoding() or "utf-8"))
+    return fileNames, overflow
+
+
+class PollingDirectoryWatcher(DirectoryWatcherBase):
+  """ Fallback for platforms without inotify: a file is reported once its size and modification time did not change
+  between two consecutive polls.
+  """
+
+  POLL_INTERVAL = 500 # unit ms
+
+  def __init__(self, directory, callback):
+    super(PollingDirectoryWatcher, self).__init__(directory, callback)
+    self.candidates = {}
+    self.reported = {}
+    self.timer = qt.QTimer()
+    self.timer.setInterval(self.POLL_INTERVAL)
+    self.timer.connect('timeout()', self.poll)
+
+  def start(self):
+    self.reported = self.scan()
+    self.candidates = {}
+    self.timer.start()
+
+  def stop(self):
+    self.timer.stop()
+
+  def scan(self):
+    signatures = {}
+    try:
+      fileNames = os.listdir(self.directory)
+    except OSError:
+      return signatures
+    for fileName in fileNames:
+      try:
+        fileStat = os.stat(os.path.join(self.directory, fileName))
+      except OSError:
+        continue
+      signatures[fileName] = (fileStat.st_size, fileStat.st_mtime)
+    return signatures
+
+  def poll(self):
+    signatures = self.scan()
+    stableFiles = [fileName for fileName, signature in signatures.items()
+                   if self.reported.get(fileName) != signature and self.candidates.get(fileName) == signature]
+    self.candidates = dict((fileName, signature) for fileName, signature in signatures.items()
+                           if self.reported.get(fileName) != signature)
+    for fileName in stableFiles:
+      self.reported[fileName] = signatures[fileName]
+      del self.candidates[fileName]
+    self.reportFiles(sorted(stableFiles))
+
+
+def createDirectoryWatcher(directory, callback, mode="AUTO"):
+  """ Returns a started watcher for the given mode (AUTO, INOTIFY or POLLING), or None if mode is OFF
+  """
+  if mode == "OFF":
+    return None
+  if mode in ["AUTO", "INOTIFY"] and InotifyDirectoryWatcher.isAvailable():
+    watcher = InotifyDirectoryWatcher(directory, callback)
+    try:
+      watcher.start()
+      return watcher
+    except OSError as exc:
+      logging.warning("Falling back to polling %s: %s" % (directory, exc))
+  watcher = PollingDirectoryWatcher(directory, callback)
+  watcher.start()
+  return watcher
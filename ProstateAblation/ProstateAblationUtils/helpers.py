@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 import datetime
 import qt
 import vtk
@@ -98,6 +99,7 @@ class NewCaseSelectionNameWidget(qt.QMessageBox, ModuleWidgetMixin):
 class SeriesTypeManager(LogicBase):
 
   SeriesTypeManuallyAssignedEvent = vtk.vtkCommand.UserEvent + 2334
+  SeriesTypeSettingsChangedEvent = vtk.vtkCommand.UserEvent + 2335
 
   MODULE_NAME = constants.MODULE_NAME
 
@@ -105,42 +107,78 @@ class SeriesTypeManager(LogicBase):
 
   assignedSeries = {}
 
+  OTHER_IMAGE_SETTING = "OTHER_IMAGE"
+  SERIES_TYPE_SETTINGS = ["COVER_PROSTATE", "COVER_TEMPLATE", "NEEDLE_IMAGE", "VIBE_IMAGE"] # in order of precedence
+
   def __init__(self):
     LogicBase.__init__(self)
+    self.reloadSettings()
+
+  def getRawSettings(self):
+    return [self.getSetting(settingName)
+            for settingName in ["SERIES_TYPES", self.OTHER_IMAGE_SETTING] + self.SERIES_TYPE_SETTINGS]
+
+  def refreshSettings(self):
+    """ Reloads the keywords if the settings changed since they were compiled, e.g. from the module settings dialog """
+    if self.getRawSettings() != self.rawSettings:
+      self.reloadSettings()
+      self.invokeEvent(self.SeriesTypeSettingsChangedEvent)
+
+  def reloadSettings(self):
+    """ Reads the series description keywords from the settings and compiles them into a single pattern """
+    self.rawSettings = self.getRawSettings()
     self.seriesTypes = self.getSetting("SERIES_TYPES")
+    self.keywords = dict((settingName, self.getKeywords(settingName))
+                         for settingName in [self.OTHER_IMAGE_SETTING] + self.SERIES_TYPE_SETTINGS)
+    allKeywords = sorted(set(k for keywords in self.keywords.values() for k in keywords), key=len, reverse=True)
+    self.keywordPattern = re.compile("(?=(%s))" % "|".join(re.escape(k) for k in allKeywords)) if allKeywords else None
+    self.containedKeywords = dict((keyword, [k for k in allKeywords if k in keyword]) for keyword in allKeywords)
+    self.matchedKeywords = {}
+
+  def getKeywords(self, settingName):
+    value = self.getSetting(settingName)
+    if isinstance(value, (tuple, list)):
+      return tuple(unicode(keyword) for keyword in value if keyword)
+    return (unicode(value),) if value else ()
 
   def clear(self):
     self.assignedSeries = {}
 
   def getSeriesType(self, series):
+    self.refreshSettings()
     try:
       return self.assignedSeries[series]
     except KeyError:
       return self.computeSeriesType(series)
 
+  def getMatchedKeywords(self, series):
+    """ Returns the set of configured keywords contained in series. Results are cached per series until the settings
+    change.
+    """
+    try:
+      return self.matchedKeywords[series]
+    except KeyError:
+      pass
+    matched = set()
+    if self.keywordPattern:
+      for keyword in set(self.keywordPattern.findall(series)):
+        matched.update(self.containedKeywords[keyword])
+    self.matchedKeywords[series] = matched
+    return matched
+
   def checkInSetting(self, series, settingName):
-    seriesType = None
-    if type(self.getSetting(settingName)) is type(tuple()):
-      for keyWord in self.getSetting(settingName):
-        if keyWord in series:
-          seriesType = keyWord
-          break
-    elif type(self.getSetting(settingName)) is type(unicode()):
-      if self.getSetting(settingName) in series:
-        seriesType = self.getSetting(settingName)
-    return seriesType
+    matched = self.getMatchedKeywords(series)
+    for keyWord in self.keywords.get(settingName, ()):
+      if keyWord in matched:
+        return keyWord
+    return None
 
   def computeSeriesType(self, series):
-    seriesType = self.checkInSetting(series, "OTHER_IMAGE")
-    if self.checkInSetting(series, "COVER_PROSTATE"):
-      seriesType = self.checkInSetting(series, "COVER_PROSTATE")
-    elif self.checkInSetting(series, "COVER_TEMPLATE"):
-      seriesType = self.checkInSetting(series, "COVER_TEMPLATE")
-    elif self.checkInSetting(series, "NEEDLE_IMAGE"):
-      seriesType = self.checkInSetting(series, "NEEDLE_IMAGE")
-    elif self.checkInSetting(series, "VIBE_IMAGE"):
-      seriesType = self.checkInSetting(series, "VIBE_IMAGE")
-    return seriesType
+    for settingName in self.SERIES_TYPE_SETTINGS:
+      seriesType = self.checkInSetting(series, settingName)
+      if seriesType:
+        return seriesType
+    return self.checkInSetting(series, self.OTHER_IMAGE_SETTING)
 
   def autoAssign(self, series):
     self.assignedSeries[series] = self.getSeriesType(series)
@@ -149,6 +187,7 @@ class SeriesTypeManager(LogicBase):
     if series in self.assignedSeries.keys() and self.assignedSeries[series] == seriesType:
       return
     if seriesType:
+      self.refreshSettings()
       assert seriesType in self.seriesTypes
       self.assignedSeries[series] = seriesType
       self.invokeEvent(self.SeriesTypeManuallyAssignedEvent)
@@ -156,33 +195,147 @@ class SeriesTypeManager(LogicBase):
       self.autoAssign(series)
 
   def isCoverProstate(self, series):
-    return self._hasSeriesType(series, self.getSetting("COVER_PROSTATE"))
+    return self._hasSeriesType(series, "COVER_PROSTATE")
 
   def isCoverTemplate(self, series):
-    return self._hasSeriesType(series, self.getSetting("COVER_TEMPLATE"))
+    return self._hasSeriesType(series, "COVER_TEMPLATE")
 
   def isGuidance(self, series):
-    return self._hasSeriesType(series, self.getSetting("NEEDLE_IMAGE"))
+    return self._hasSeriesType(series, "NEEDLE_IMAGE")
 
   def isVibe(self, series):
-    return self._hasSeriesType(series, self.getSetting("VIBE_IMAGE"))
+    return self._hasSeriesType(series, "VIBE_IMAGE")
 
   def isOther(self, series):
-    return self._hasSeriesType(series, self.getSetting("OTHER_IMAGE")) or not (self.isCoverProstate(series) or
-                                                                               self.isCoverTemplate(series) or
-                                                                               self.isGuidance(series) or
-                                                                               self.isVibe(series))
+    return self._hasSeriesType(series, self.OTHER_IMAGE_SETTING) or not self.isWorkableSeries(series)
+
   def isWorkableSeries(self, series):
-    return (self.isCoverProstate(series) or self.isCoverTemplate(series) or self.isGuidance(series) or self.isVibe(series))
+    self.refreshSettings()
+    return any(self._hasSeriesTypeUnchecked(series, settingName) for settingName in self.SERIES_TYPE_SETTINGS)
 
-  def _hasSeriesType(self, series, seriesType):
-    listItems = [str(item) for item in seriesType]
+  def isSeriesTypeOf(self, seriesType, settingName):
+    """ Returns whether seriesType, as returned by getSeriesType, is one of the keywords of settingName """
+    self.refreshSettings()
+    return seriesType in self.keywords.get(settingName, ())
+
+  def isWorkableSeriesType(self, seriesType):
+    return any(self.isSeriesTypeOf(seriesType, settingName) for settingName in self.SERIES_TYPE_SETTINGS)
+
+  def _hasSeriesType(self, series, settingName):
+    self.refreshSettings()
+    return self._hasSeriesTypeUnchecked(series, settingName)
+
+  def _hasSeriesTypeUnchecked(self, series, settingName):
+    keywords = self.keywords[settingName]
     if self.assignedSeries.has_key(series):
-      for serieName in listItems:
-        if self.assignedSeries[series] == serieName:
-          return True
-    else:
-      for serieName in listItems:
-        if serieName in series:
-          return True
-    return False
+      return self.assignedSeries[series] in keywords
+    return not self.getMatchedKeywords(series).isdisjoint(keywords)
+
+
+class CoalescingScheduler(object):
+  """ Coalesces bursts of schedule requests into a single callback run at the next idle tick of the event loop, but
+  not more often than maxRate times per second. The callback receives the set of keys marked dirty since its last run.
+  """
+
+  def __init__(self, callback, maxRate=None):
+    self.callback = callback
+    self.minimumInterval = 1000.0 / maxRate if maxRate else 0.0
+    self.dirtyKeys = set()
+    self.lastRunTime = None
+    self.timer = qt.QTimer()
+    self.timer.setSingleShot(True)
+    self.timer.connect('timeout()', self.flush)
+
+  @property
+  def pending(self):
+    return self.timer.isActive()
+
+  def schedule(self, *keys):
+    self.dirtyKeys.update(keys)
+    if not self.pending:
+      elapsed = (time.time() - self.lastRunTime) * 1000.0 if self.lastRunTime else self.minimumInterval
+      self.timer.start(int(max(0.0, self.minimumInterval - elapsed)))
+
+  def flush(self):
+    self.timer.stop()
+    dirtyKeys, self.dirtyKeys = self.dirtyKeys, set()
+    self.lastRunTime = time.time()
+    self.callback(dirtyKeys)
+
+  def flushIfPending(self):
+    if self.pending:
+      self.flush()
+
+  def cancel(self):
+    self.timer.stop()
+    self.dirtyKeys = set()
+
+
+class CooperativeTask(object):
+  """ Runs the units of work of a generator at idle ticks of the event loop, as many per tick as fit into timeSlice
+  milliseconds before yielding back to Qt. Values yielded by the generator are progress reports which are passed on to
+  progressCallback at most progressRate times per second. The last one is always passed on.
+  """
+
+  def __init__(self, generator, timeSlice=50, progressCallback=None, progressRate=None, finishedCallback=None):
+    self.generator = generator
+    self.timeSlice = timeSlice / 1000.0
+    self.progressCallback = progressCallback
+    self.minimumProgressInterval = 1.0 / progressRate if progressRate else 0.0
+    self.finishedCallback = finishedCallback
+    self.progress = None
+    self.progressReported = True
+    self.lastProgressTime = None
+    self.timer = qt.QTimer()
+    self.timer.setSingleShot(True)
+    self.timer.connect('timeout()', self.runTimeSlice)
+
+  @property
+  def running(self):
+    return self.generator is not None
+
+  def start(self):
+    if self.running and not self.timer.isActive():
+      self.timer.start(0)
+
+  def runTimeSlice(self):
+    deadline = time.time() + self.timeSlice
+    while self.running:
+      self.step()
+      if time.time() >= deadline:
+        break
+    self.start()
+
+  def step(self):
+    try:
+      progress = next(self.generator)
+    except StopIteration:
+      self.generator = None
+      self.reportProgress(force=True)
+      if self.finishedCallback:
+        self.finishedCallback()
+      return
+    if progress is not None:
+      self.progress = progress
+      self.progressReported = False
+      self.reportProgress()
+
+  def reportProgress(self, force=False):
+    if self.progressCallback is None or self.progressReported:
+      return
+    now = time.time()
+    if force or self.lastProgressTime is None or now - self.lastProgressTime >= self.minimumProgressInterval:
+      self.lastProgressTime = now
+      self.progressReported = True
+      self.progressCallback(self.progress)
+
+  def finish(self):
+    self.timer.stop()
+    while self.running:
+      self.step()
+
+  def cancel(self):
+    self.timer.stop()
+    if self.running:
+      self.generator.close()
+      self.generator = None
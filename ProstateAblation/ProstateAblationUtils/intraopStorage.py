@@ -0,0 +1,127 @@
+import os
+import re
+import json
+import shutil
+import logging
+
+
+class IntraopStorage(object):
+  """ Layout of the received intraop DICOM files. Files are received flat into the directory. With partitionBySeries,
+  indexed files are moved into one subdirectory per series which holds a manifest of its files, so that listing and
+  deleting a series only touches the files of that series instead of the whole directory.
+
+  Series directories are listed from their manifests regardless of partitionBySeries, which keeps partitioned cases
+  readable when the layout setting is switched back, while flat cases are listed by the top level scan.
+  """
+
+  SERIES_DIRECTORY_PATTERN = re.compile(r"^Series(-?\d+)$")
+  MANIFEST_FILENAME = "manifest.json"
+  MANIFEST_VERSION = 1
+
+  def __init__(self, directory, partitionBySeries=False):
+    self.directory = directory
+    self.partitionBySeries = partitionBySeries
+    self.manifests = {}
+
+  def getSeriesDirectory(self, seriesNumber):
+    return os.path.join(self.directory, "Series%d" % seriesNumber)
+
+  def getManifestFileName(self, seriesNumber):
+    return os.path.join(self.getSeriesDirectory(seriesNumber), self.MANIFEST_FILENAME)
+
+  def isSeriesDirectory(self, relativePath):
+    return self.SERIES_DIRECTORY_PATTERN.match(relativePath) is not None
+
+  def listFiles(self):
+    """ Returns the paths relative to the directory of all flat files and of all files listed by series manifests """
+    try:
+      names = os.listdir(self.directory)
+    except OSError:
+      return []
+    fileNames = []
+    for name in sorted(names):
+      if name.startswith("."):
+        continue
+      match = self.SERIES_DIRECTORY_PATTERN.match(name)
+      if match:
+        fileNames += [os.path.join(name, f) for f in self.getManifest(int(match.group(1)))]
+      elif os.path.isfile(os.path.join(self.directory, name)):
+        fileNames.append(name)
+    return fileNames
+
+  def getManifest(self, seriesNumber):
+    """ Returns the file names of a series directory. Directories without a readable manifest are scanned. """
+    if seriesNumber in self.manifests:
+      return self.manifests[seriesNumber]
+    fileNames = None
+    try:
+      with open(self.getManifestFileName(seriesNumber)) as manifestFile:
+        data = json.load(manifestFile)
+      if data.get("version") == self.MANIFEST_VERSION:
+        fileNames = data.get("files")
+    except (IOError, ValueError):
+      pass
+    if fileNames is None:
+      seriesDirectory = self.getSeriesDirectory(seriesNumber)
+      fileNames = sorted(f for f in os.listdir(seriesDirectory) if not f.startswith(".") and
+                         f != self.MANIFEST_FILENAME and os.path.isfile(os.path.join(seriesDirectory, f)))
+    self.manifests[seriesNumber] = fileNames
+    return fileNames
+
+  def saveManifest(self, seriesNumber):
+    manifestFileName = self.getManifestFileName(seriesNumber)
+    temporaryFileName = manifestFileName + ".tmp"
+    with open(temporaryFileName, 'w') as outfile:
+      json.dump({"version": self.MANIFEST_VERSION, "seriesNumber": seriesNumber,
+                 "files": self.manifests[seriesNumber]}, outfile)
+    if os.path.exists(manifestFileName):
+      os.remove(manifestFileName)
+    os.rename(temporaryFileName, manifestFileName)
+
+  def partition(self, relativePaths, seriesNumberCallback):
+    """ Moves flat files into the directory of the series returned by seriesNumberCallback(absolutePath) and returns
+    a dict mapping the relative paths of all moved files to their new relative paths. Files whose name is taken in the
+    series directory already, e.g. by the original of a resent instance, are stored next to it with a numbered suffix.
+    """
+    if not self.partitionBySeries:
+      return {}
+    moves = {}
+    touchedSeries = set()
+    for relativePath in relativePaths:
+      if os.path.dirname(relativePath):
+        continue
+      seriesNumber = seriesNumberCallback(os.path.join(self.directory, relativePath))
+      if seriesNumber is None:
+        continue
+      seriesDirectory = self.getSeriesDirectory(seriesNumber)
+      destination = self.getFreeFileName(seriesDirectory, relativePath)
+      if not os.path.isdir(seriesDirectory):
+        os.makedirs(seriesDirectory)
+      try:
+        os.rename(os.path.join(self.directory, relativePath), destination)
+      except OSError as exc:
+        logging.warning("Could not move %s into %s: %s" % (relativePath, seriesDirectory, exc))
+        continue
+      manifest = self.getManifest(seriesNumber)
+      if os.path.basename(destination) not in manifest:
+        manifest.append(os.path.basename(destination))
+      touchedSeries.add(seriesNumber)
+      moves[relativePath] = os.path.relpath(destination, self.directory)
+    for seriesNumber in touchedSeries:
+      self.saveManifest(seriesNumber)
+    return moves
+
+  @staticmethod
+  def getFreeFileName(directory, fileName):
+    destination = os.path.join(directory, fileName)
+    suffix = 1
+    while os.path.exists(destination):
+      destination = os.path.join(directory, "%s.%d" % (fileName, suffix))
+      suffix += 1
+    return destination
+
+  def deleteSeries(self, seriesNumber):
+    self.manifests.pop(seriesNumber, None)
+    seriesDirectory = self.getSeriesDirectory(seriesNumber)
+    if os.path.isdir(seriesDirectory):
+      shutil.rmtree(seriesDirectory)
@@ -0,0 +1,128 @@
+import math
+import time
+import logging
+import qt
+import vtk
+
+from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
+
+
+class SeriesAssemblyState(object):
+
+  __slots__ = ("series", "numberOfFiles", "instanceNumbers", "expectedNumberOfFiles", "transferFinished",
+               "lastArrivalTime", "state")
+
+  def __init__(self, series):
+    self.series = series
+    self.numberOfFiles = 0
+    self.instanceNumbers = ()
+    self.expectedNumberOfFiles = None
+    self.transferFinished = False
+    self.lastArrivalTime = None
+    self.state = SeriesAssembler.PARTIAL
+
+
+class SeriesAssembler(ModuleLogicMixin):
+  """ Keeps track of whether received series are complete. The number of expected files is derived from
+  ImagesInAcquisition and NumberOfFrames. A series is also considered complete once the transfer was reported finished,
+  even if fewer files than expected arrived, or if neither value is available and its InstanceNumber range is
+  contiguous and did not change for STABILIZATION_TIME seconds.
+  Series which don't get complete and receive no files for STALL_TIMEOUT seconds are marked as stalled.
+
+  SeriesCompletedEvent and SeriesStalledEvent are invoked with the list of affected series as callData.
+  """
+
+  SeriesCompletedEvent = vtk.vtkCommand.UserEvent + 153
+  SeriesStalledEvent = vtk.vtkCommand.UserEvent + 154
+
+  PARTIAL = "PARTIAL"
+  COMPLETE = "COMPLETE"
+  STALLED = "STALLED"
+
+  STABILIZATION_TIME = 2.0
+  STALL_TIMEOUT = 30.0
+  CHECK_INTERVAL = 500 # unit ms
+
+  def __init__(self, stallTimeout=None):
+    self.stallTimeout = stallTimeout or self.STALL_TIMEOUT
+    self.states = {}
+    self.timer = qt.QTimer()
+    self.timer.setInterval(self.CHECK_INTERVAL)
+    self.timer.connect('timeout()', self.evaluatePendingSeries)
+
+  def clear(self):
+    self.timer.stop()
+    self.states = {}
+
+  def getState(self, series):
+    assemblyState = self.states.get(series)
+    return assemblyState.state if assemblyState else None
+
+  def isComplete(self, series):
+    return self.getState(series) == self.COMPLETE
+
+  def update(self, series, instanceNumbers, imagesInAcquisition=None, numberOfFrames=None, transferFinished=False):
+    """ Records the header values of all files of a series received so far. instanceNumbers holds one entry per file,
+    None for files without InstanceNumber. Call evaluatePendingSeries once all received series were updated.
+    """
+    assemblyState = self.states.setdefault(series, SeriesAssemblyState(series))
+    numberOfFiles = len(instanceNumbers)
+    instanceNumbers = tuple(sorted(n for n in instanceNumbers if n is not None))
+    if numberOfFiles != assemblyState.numberOfFiles or instanceNumbers != assemblyState.instanceNumbers:
+      assemblyState.lastArrivalTime = time.time()
+      if assemblyState.state == self.STALLED:
+        assemblyState.state = self.PARTIAL
+    assemblyState.numberOfFiles = numberOfFiles
+    assemblyState.instanceNumbers = instanceNumbers
+    assemblyState.expectedNumberOfFiles = self.computeExpectedNumberOfFiles(imagesInAcquisition, numberOfFrames)
+    assemblyState.transferFinished = assemblyState.transferFinished or transferFinished
+
+  @staticmethod
+  def computeExpectedNumberOfFiles(imagesInAcquisition, numberOfFrames):
+    framesPerFile = numberOfFrames if numberOfFrames and numberOfFrames > 1 else 1
+    if imagesInAcquisition:
+      return int(math.ceil(float(imagesInAcquisition) / framesPerFile))
+    return 1 if framesPerFile > 1 else None
+
+  def evaluatePendingSeries(self):
+    self.evaluate([s for s in self.states.values() if s.state != self.COMPLETE])
+
+  def evaluate(self, assemblyStates):
+    now = time.time()
+    completed = []
+    stalled = []
+    for assemblyState in assemblyStates:
+      if self.isAssemblyComplete(assemblyState, now):
+        assemblyState.state = self.COMPLETE
+        completed.append(assemblyState.series)
+      elif now - assemblyState.lastArrivalTime >= self.stallTimeout:
+        if assemblyState.state != self.STALLED:
+          assemblyState.state = self.STALLED
+          stalled.append(assemblyState.series)
+      else:
+        assemblyState.state = self.PARTIAL
+    if any(s.state == self.PARTIAL for s in self.states.values()):
+      if not self.timer.isActive():
+        self.timer.start()
+    else:
+      self.timer.stop()
+    if stalled:
+      logging.warning("Series %s stalled before all files were received" % stalled)
+      self.invokeEvent(self.SeriesStalledEvent, stalled.__str__())
+    if completed:
+      self.invokeEvent(self.SeriesCompletedEvent, completed.__str__())
+
+  def isAssemblyComplete(self, assemblyState, now):
+    expectedNumberOfFiles = assemblyState.expectedNumberOfFiles
+    if expectedNumberOfFiles is not None and assemblyState.numberOfFiles >= expectedNumberOfFiles:
+      return True
+    if assemblyState.transferFinished:
+      if expectedNumberOfFiles is not None:
+        logging.warning("Transfer of series %s finished with %d of %d expected files" %
+                        (assemblyState.series, assemblyState.numberOfFiles, expectedNumberOfFiles))
+      return True
+    if expectedNumberOfFiles is not None:
+      return False
+    instanceNumbers = assemblyState.instanceNumbers
+    return len(instanceNumbers) > 0 and instanceNumbers[-1] - instanceNumbers[0] + 1 == len(instanceNumbers) and \
+           now - assemblyState.lastArrivalTime >= self.STABILIZATION_TIME
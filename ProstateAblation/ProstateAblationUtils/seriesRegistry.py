@@ -0,0 +1,89 @@
+import bisect
+
+
+class Series(object):
+  """ Everything known about one received series. name is the "number: description" string used throughout the UI
+  and in event payloads.
+  """
+
+  __slots__ = ("number", "description", "name", "uid", "files", "seriesType", "completeness", "loadState")
+
+  NOT_LOADED = "NOT_LOADED"
+  PREVIEW = "PREVIEW"
+  LOADED = "LOADED"
+
+  def __init__(self, number, description, name, uid=None):
+    self.number = number
+    self.description = description
+    self.name = name
+    self.uid = uid
+    self.files = []
+    self.seriesType = None
+    self.completeness = None
+    self.loadState = self.NOT_LOADED
+
+  def __repr__(self):
+    return "Series(%s)" % self.name
+
+
+class SeriesRegistry(object):
+  """ Received series indexed by number, name and SeriesInstanceUID. The view ordered by series number is kept sorted
+  by inserting new series at their position instead of sorting again.
+  """
+
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    self.byNumber = {}
+    self.byName = {}
+    self.byUID = {}
+    self.numbers = []
+    self.names = []
+
+  def __len__(self):
+    return len(self.numbers)
+
+  def __iter__(self):
+    return (self.byNumber[number] for number in self.numbers)
+
+  def __contains__(self, name):
+    return name in self.byName
+
+  def get(self, name):
+    return self.byName.get(name)
+
+  def getByNumber(self, number):
+    return self.byNumber.get(number)
+
+  def getByUID(self, uid):
+    return self.byUID.get(uid)
+
+  def first(self):
+    return self.byNumber[self.numbers[0]] if self.numbers else None
+
+  def add(self, series):
+    if series.number in self.byNumber:
+      self.remove(series.number)
+    position = bisect.bisect_left(self.numbers, series.number)
+    self.numbers.insert(position, series.number)
+    self.names.insert(position, series.name)
+    self.byNumber[series.number] = series
+    self.byName[series.name] = series
+    if series.uid:
+      self.byUID[series.uid] = series
+
+  def remove(self, number):
+    series = self.byNumber.pop(number, None)
+    if series is None:
+      return None
+    position = bisect.bisect_left(self.numbers, number)
+    del self.numbers[position]
+    del self.names[position]
+    self.byName.pop(series.name, None)
+    if series.uid:
+      self.byUID.pop(series.uid, None)
+    return series
+
+  def sortNames(self, names):
+    return sorted(names, key=lambda name: self.byName[name].number if name in self.byName else None)
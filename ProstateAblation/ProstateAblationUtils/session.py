@@ -2,11 +2,21 @@ import os, logging
 import vtk, ctk, ast, qt
 import numpy
 import slicer
+from collections import namedtuple
 from sessionData import SessionData
 from ProstateAblationUtils.constants import ProstateAblationConstants as constants
 from ProstateAblationUtils.steps.plugins.targetsDefinition import TargetsDefinitionPlugin
 from ProstateAblationUtils.steps.plugins.targetsDefinitionTable import ZFrameGuidanceComputation
-from helpers import SeriesTypeManager
+from helpers import SeriesTypeManager, CoalescingScheduler, CooperativeTask
+from affectedZone import AffectedZoneGeometryCache, AffectedZoneGlyphRenderer
+from sliceIntersections import EllipsoidSliceIntersections
+from dicomIndex import DICOMHeaderIndex, DICOMDatabaseIndexer
+from directoryWatcher import createDirectoryWatcher
+from seriesAssembler import SeriesAssembler
+from volumeLoader import DICOMVolumeLoader, VolumePrefetcher
+from volumeCache import VolumeCache
+from seriesRegistry import Series, SeriesRegistry
+from intraopStorage import IntraopStorage
 
 from SlicerDevelopmentToolboxUtils.exceptions import DICOMValueError, UnknownSeriesError
 from SlicerDevelopmentToolboxUtils.constants import DICOMTAGS, FileExtension, STYLE
@@ -18,6 +28,9 @@ from SlicerDevelopmentToolboxUtils.decorators import singleton
 from SlicerDevelopmentToolboxUtils.decorators import onExceptionReturnFalse, onReturnProcessEvents
 from SlicerDevelopmentToolboxUtils.module.session import StepBasedSession
 
+
+ImportProgress = namedtuple("ImportProgress", "text total current")
+
 @singleton
 class ProstateAblationSession(StepBasedSession):
 
@@ -33,6 +46,7 @@ class ProstateAblationSession(StepBasedSession):
   SegmentationCancelledEvent = vtk.vtkCommand.UserEvent + 144
 
   CurrentSeriesChangedEvent = vtk.vtkCommand.UserEvent + 151
+  IntraopSeriesUpdatedEvent = vtk.vtkCommand.UserEvent + 152
 
   InitiateZFrameCalibrationEvent = vtk.vtkCommand.UserEvent + 160
   InitiateTargetingEvent = vtk.vtkCommand.UserEvent + 161
@@ -52,11 +66,39 @@ class ProstateAblationSession(StepBasedSession):
 
   ISSEEDTYPE = "IceSeed"
   ISRODTYPE = "IceRod"
+
+  IMPORT_CHUNK_SIZE = 25
   
   @property
   def intraopDICOMDirectory(self):
     return os.path.join(self.directory, "DICOM", "Intraop") if self.directory else None
 
+  @property
+  def seriesList(self):
+    return list(self.seriesRegistry.names)
+
+  @property
+  def intraopStorage(self):
+    directory = self.intraopDICOMDirectory
+    if not directory:
+      return None
+    if self._intraopStorage is None or self._intraopStorage.directory != directory:
+      self._intraopStorage = IntraopStorage(directory, partitionBySeries=self.getSetting("Intraop_Storage_Layout") ==
+                                                                           "SERIES")
+    return self._intraopStorage
+
+  @property
+  def dicomHeaderIndex(self):
+    directory = self.intraopDICOMDirectory
+    if not directory:
+      return None
+    if self._dicomHeaderIndex is None or self._dicomHeaderIndex.directory != directory:
+      self.resetDICOMHeaderIndex()
+      self._dicomHeaderIndex = DICOMHeaderIndex(directory, os.path.join(self.directory, "DICOM",
+                                                                        constants.DICOM_HEADER_INDEX_FILENAME))
+      self._dicomHeaderIndex.load()
+    return self._dicomHeaderIndex
+
   @property
   def outputDirectory(self):
     # was outputDir
@@ -96,7 +138,7 @@ class ProstateAblationSession(StepBasedSession):
     if series == self.currentSeries:
       return
     print "set current Series on session"
-    if series and series not in self.seriesList :
+    if series and series not in self.seriesRegistry :
       raise UnknownSeriesError("Series %s is unknown" % series)
     self._currentSeries = series
     self.invokeEvent(self.CurrentSeriesChangedEvent, series)
@@ -112,13 +154,62 @@ class ProstateAblationSession(StepBasedSession):
     StepBasedSession.__init__(self)
     self.seriesTypeManager = SeriesTypeManager()
     self.seriesTypeManager.addEventObserver(self.seriesTypeManager.SeriesTypeManuallyAssignedEvent,
-                                            lambda caller, event: self.invokeEvent(self.SeriesTypeManuallyAssignedEvent))
+                                            self.onSeriesTypeManuallyAssigned)
+    self.seriesTypeManager.addEventObserver(self.seriesTypeManager.SeriesTypeSettingsChangedEvent,
+                                            self.onSeriesTypeSettingsChanged)
     self.targetingPlugin = TargetsDefinitionPlugin(self)
     self.needlePathCaculator = ZFrameGuidanceComputation(self)
+    self.affectedZoneGeometry = self.createAffectedZoneGeometry()
+    self.analyticSliceIntersections = self.getSetting("AffectedZone_SliceIntersection") == "ANALYTIC"
+    self.iceBallSliceIntersections = EllipsoidSliceIntersections(color=(0.0, 1.0, 0.0))
+    self.affectiveZoneAndDistanceScheduler = CoalescingScheduler(lambda dirtyKeys: self.updateAffectiveZoneAndDistance(),
+                                                                 maxRate=self.getRecomputationMaxRate())
     self.segmentationEditor = slicer.qMRMLSegmentEditorWidget()
+    self.dicomDatabaseIndexer = DICOMDatabaseIndexer()
+    self.seriesAssembler = SeriesAssembler(stallTimeout=self.getNumericSetting("Series_Assembly_StallTimeout"))
+    self.seriesAssembler.addEventObserver(self.seriesAssembler.SeriesCompletedEvent, self.onSeriesCompleted)
+    self.seriesAssembler.addEventObserver(self.seriesAssembler.SeriesStalledEvent, self.onSeriesStalled)
+    self.volumePrefetcher = VolumePrefetcher(self.onVolumePrefetched)
     self.resetAndInitializeMembers()
     self.resetAndInitializedTargetsAndSegments()
   
+  def getNumericSetting(self, key):
+    try:
+      return float(self.getSetting(key))
+    except (TypeError, ValueError):
+      return None
+
+  def getRecomputationMaxRate(self):
+    return self.getNumericSetting("Recomputation_MaxRate")
+
+  def getPinnedVolumeIDs(self):
+    volumes = [self.data.initialVolume, self.volumeCache.peek(self.currentSeries) if self.currentSeries else None]
+    if self.data.zFrameRegistrationResult:
+      volumes.append(self.data.zFrameRegistrationResult.volume)
+    volumeIDs = set(volume.GetID() for volume in volumes if volume)
+    compositeNodes = slicer.mrmlScene.GetNodesByClass("vtkMRMLSliceCompositeNode")
+    for index in range(compositeNodes.GetNumberOfItems()):
+      compositeNode = compositeNodes.GetItemAsObject(index)
+      volumeIDs.update([compositeNode.GetBackgroundVolumeID(), compositeNode.GetForegroundVolumeID()])
+    volumeIDs.discard(None)
+    return volumeIDs
+
+  def getPrefetchedSeriesTypes(self):
+    seriesTypes = self.getSetting("Prefetch_SeriesTypes") or ""
+    if isinstance(seriesTypes, basestring):
+      seriesTypes = seriesTypes.split(",")
+    return [str(seriesType).strip() for seriesType in seriesTypes if str(seriesType).strip()]
+
+  def createAffectedZoneGeometry(self):
+    if self.getSetting("AffectedZone_Rendering") == "GLYPH":
+      return AffectedZoneGlyphRenderer(self.needlePathCaculator)
+    return AffectedZoneGeometryCache(self.needlePathCaculator)
+
+  def resetDICOMHeaderIndex(self):
+    if getattr(self, "_dicomHeaderIndex", None) is not None:
+      self._dicomHeaderIndex.cancel()
+    self._dicomHeaderIndex = None
+
   def resetAndInitializeMembers(self):
     self.seriesTypeManager.clear()
     self.initializeColorNodes()
@@ -126,9 +217,22 @@ class ProstateAblationSession(StepBasedSession):
     self.data = SessionData()
     self.trainingMode = False
     self.resetIntraopDICOMReceiver()
-    self.loadableList = {}
-    self.seriesList = []
-    self.alreadyLoadedSeries = {}
+    self.seriesRegistry = SeriesRegistry()
+    self.volumeCache = VolumeCache(byteBudget=(self.getNumericSetting("Volume_Cache_MemoryLimit") or 0) * 1024 * 1024,
+                                   pinnedVolumeIDsCallback=self.getPinnedVolumeIDs,
+                                   evictedCallback=lambda series: self.setSeriesLoadState(series, Series.NOT_LOADED))
+    self.resetDICOMHeaderIndex()
+    self._intraopStorage = None
+    self.dicomDatabaseIndexer.cancel()
+    if getattr(self, "importTask", None):
+      self.importTask.cancel()
+    self.importTask = None
+    self.importProgress = None
+    self.pendingImports = []
+    self.seriesAssembler.clear()
+    self.volumePrefetcher.clear()
+    self.prefetchedSeries = {}
+    self.previewJobs = {}
     self._currentSeries = None
     self.retryMode = False
     self.lastSelectedModelIndex = None
@@ -137,6 +241,10 @@ class ProstateAblationSession(StepBasedSession):
   def resetAndInitializedTargetsAndSegments(self):
     self.displayForTargets = dict()
     self.needleTypeForTargets = dict()
+    self.affectiveZoneAndDistanceScheduler.cancel()
+    self.affectedZoneGeometry.clear()
+    self.iceBallSliceIntersections.clear()
+    self.iceBallSliceIntersections.cleanup()
     self.targetingPlugin.cleanup()
     self.needleModelNode = None
     self.affectedAreaModelNode = None
@@ -179,11 +287,11 @@ class ProstateAblationSession(StepBasedSession):
   
   def setupFiducialWidgetAndTableWidget(self):
     self.targetingPlugin.fiducialsWidget.addEventObserver(slicer.vtkMRMLMarkupsNode().MarkupAddedEvent,
-                                     self.updateAffectiveZoneAndDistance)
+                                                          self.scheduleAffectiveZoneAndDistanceUpdate)
     self.targetingPlugin.fiducialsWidget.addEventObserver(slicer.vtkMRMLMarkupsNode().MarkupRemovedEvent,
-                                                          self.updateAffectiveZoneAndDistance)
-    self.targetingPlugin.targetTablePlugin.addEventObserver(self.targetingPlugin.targetTablePlugin.TargetPosUpdatedEvent, self.updateAffectiveZoneAndDistance)
-
+                                                          self.scheduleAffectiveZoneAndDistanceUpdate)
+    self.targetingPlugin.targetTablePlugin.addEventObserver(self.targetingPlugin.targetTablePlugin.TargetPosUpdatedEvent,
+                                                            self.scheduleAffectiveZoneAndDistanceUpdate)
 
   def processDirectory(self):
     self.newCaseCreated = getattr(self, "newCaseCreated", False)
@@ -260,6 +368,8 @@ class ProstateAblationSession(StepBasedSession):
       self.targetingPlugin.targetDistanceWidget.visible = True
       self.setupLoadedTargets()
     self.startIntraopDICOMReceiver()
+    # stored series need to exist before loading is reported as finished
+    self.finishPendingImports()
     
   def setupSegmentationWidget(self):
     for child in self.segmentationEditor.children():
@@ -325,6 +435,9 @@ class ProstateAblationSession(StepBasedSession):
     self.segmentationEditor.setMRMLSegmentEditorNode(self.segmentEditorNode)
     self.segmentationEditorMaskOverWriteCombox.setCurrentIndex(self.segmentationEditorMaskOverWriteCombox.findText('None'))
 
+  def scheduleAffectiveZoneAndDistanceUpdate(self, caller=None, event=None):
+    self.affectiveZoneAndDistanceScheduler.schedule()
+
   def updateAffectiveZoneAndDistance(self, caller = None, event = None):
     self.updateAffectiveZone()
     self.targetingPlugin.calculateTargetsDistance()
@@ -349,76 +462,27 @@ class ProstateAblationSession(StepBasedSession):
     if self.targetingPlugin.fiducialsWidget.visible:
       targetingNode = self.targetingPlugin.fiducialsWidget.currentNode
     if self.needleModelNode and self.affectedAreaModelNode and self.approvedCoverTemplate and targetingNode.GetNumberOfFiducials():
-      needleModelAppend = vtk.vtkAppendPolyData()
-      affectedBallAreaAppend = vtk.vtkAppendPolyData()
-      zFrameTransformMatrix = self.data.zFrameRegistrationResult.transform.GetMatrixTransformToParent()
-      # The offset and ellipsoid parameters are taken from the following source code
-      # http://viewvc.slicer.org/viewvc.cgi/NAMICSandBox/trunk/IGTLoadableModules/ProstateNav/TransPerinealProstateCryoTemplate/vtkMRMLTransPerinealProstateCryoTemplateNode.cxx?revision=8043&view=markup
-      offsetFromTip = 5.0 #unit mm
-      coneHeight = 5.0
-      for targetIndex in range(targetingNode.GetNumberOfFiducials()):
-        if self.displayForTargets.get(targetingNode.GetNthMarkupID(targetIndex)) == qt.Qt.Checked:
-          affectedBallAreaRadius = self.GetIceBallRadius(self.needleTypeForTargets.get(targetingNode.GetNthMarkupID(targetIndex)))  # unit mm
-          targetPosition = [0.0,0.0,0.0]
-          targetingNode.GetNthFiducialPosition(targetIndex, targetPosition)
-          (start, end, indexX, indexY, depth, inRange) = self.needlePathCaculator.computeNearestPath(targetPosition)
-          needleDirection = (numpy.array(end) - numpy.array(start))/numpy.linalg.norm(numpy.array(end)-numpy.array(start))
-          cone = vtk.vtkConeSource()
-          cone.SetRadius(1.5)
-          cone.SetResolution(6)
-          cone.SetHeight(coneHeight)
-          cone.CappingOff()
-          cone.Update()
-          transform = vtk.vtkTransform()
-          transform.RotateY(-90)
-          transform.RotateX(30)
-          transform.Translate(-coneHeight / 2, 0.0, 0.0)
-          tFilter0 = vtk.vtkTransformPolyDataFilter()
-          tFilter0.SetInputData(cone.GetOutput())
-          tFilter0.SetTransform(transform)
-          tFilter0.Update()
-          translatePart = start+depth*needleDirection
-          for index, posElement in enumerate(translatePart):
-            zFrameTransformMatrix.SetElement(index, 3, posElement)
-          transform.SetMatrix(zFrameTransformMatrix)
-          tFilter1 = vtk.vtkTransformPolyDataFilter()
-          tFilter1.SetTransform(transform)
-          tFilter1.SetInputData(tFilter0.GetOutput())
-          tFilter1.Update()
-          needleModelAppend.AddInputData(tFilter1.GetOutput())
-          needleModelAppend.Update()
-          pathTubeFilter = ModuleLogicMixin.createVTKTubeFilter(start, start+(depth-coneHeight)*needleDirection, radius=1.5, numSides=6)
-          needleModelAppend.AddInputData(pathTubeFilter.GetOutput())
-          needleModelAppend.Update()
-          #End of needle model
-          #--------------
-          #--------------
-          #Begin of affectedBallArea
-          affectedBallArea = vtk.vtkParametricEllipsoid()
-          affectedBallArea.SetXRadius(float(affectedBallAreaRadius[0]))
-          affectedBallArea.SetYRadius(float(affectedBallAreaRadius[1]))
-          affectedBallArea.SetZRadius(float(affectedBallAreaRadius[2]))
-          affectedBallAreaSource = vtk.vtkParametricFunctionSource()
-          affectedBallAreaSource.SetParametricFunction(affectedBallArea)
-          affectedBallAreaSource.SetScalarModeToV()
-          affectedBallAreaSource.Update()
-          translatePart = start+(depth+offsetFromTip-float(affectedBallAreaRadius[2]))*needleDirection
-          for index, posElement in enumerate(translatePart):
-            zFrameTransformMatrix.SetElement(index, 3, posElement)
-          transform.SetMatrix(zFrameTransformMatrix)
-          tFilter2 = vtk.vtkTransformPolyDataFilter()
-          tFilter2.SetTransform(transform)
-          tFilter2.SetInputData(affectedBallAreaSource.GetOutput())
-          tFilter2.Update()
-          affectedBallAreaAppend.AddInputData(tFilter2.GetOutput())
-          affectedBallAreaAppend.Update()
-
-      self.needleModelNode.SetAndObservePolyData(needleModelAppend.GetOutput())
-      self.affectedAreaModelNode.SetAndObservePolyData(affectedBallAreaAppend.GetOutput())
+      markupIDs = [targetingNode.GetNthMarkupID(targetIndex) for targetIndex in range(targetingNode.GetNumberOfFiducials())]
+      displayedTargets = [targetIndex for targetIndex, markupID in enumerate(markupIDs)
+                          if self.displayForTargets.get(markupID) == qt.Qt.Checked]
+      displayedMarkupIDs = [markupIDs[targetIndex] for targetIndex in displayedTargets]
+      needleTypes = [self.needleTypeForTargets.get(markupID) for markupID in displayedMarkupIDs]
+      targetPositions = ZFrameGuidanceComputation.getTargetPositions(targetingNode, displayedTargets)
+      iceBallRadii = [self.GetIceBallRadius(needleType) for needleType in needleTypes]  # unit mm
+      zFrameMatrix = self.data.zFrameRegistrationResult.transform.GetMatrixTransformToParent()
+      self.affectedZoneGeometry.update(displayedMarkupIDs, targetPositions, needleTypes, iceBallRadii, zFrameMatrix,
+                                       self.needlePathCaculator.zFrameRegistration.templatePaths.version)
+      self.needleModelNode.SetAndObservePolyData(self.affectedZoneGeometry.needlePolyData)
+      self.affectedAreaModelNode.SetAndObservePolyData(self.affectedZoneGeometry.affectedAreaPolyData)
       ModuleLogicMixin.setNodeVisibility(self.needleModelNode, True)
       ModuleLogicMixin.setNodeVisibility(self.affectedAreaModelNode, True)
       ModuleLogicMixin.setNodeSliceIntersectionVisibility(self.needleModelNode, True)
-      ModuleLogicMixin.setNodeSliceIntersectionVisibility(self.affectedAreaModelNode, True)
+      ModuleLogicMixin.setNodeSliceIntersectionVisibility(self.affectedAreaModelNode, not self.analyticSliceIntersections)
+      if self.analyticSliceIntersections:
+        self.iceBallSliceIntersections.setEllipsoids(*self.affectedZoneGeometry.computeIceBallEllipsoids(targetPositions,
+                                                                                                        iceBallRadii,
+                                                                                                        zFrameMatrix))
+        self.iceBallSliceIntersections.setVisibility(True)
     pass 
   
   def setupLoadedTransform(self):
@@ -440,9 +504,11 @@ class ProstateAblationSession(StepBasedSession):
       self.intraopDICOMReceiver = SmartDICOMReceiver(self.intraopDICOMDirectory)
       self._observeIntraopDICOMReceiverEvents()
       self.intraopDICOMReceiver.start(not (self.trainingMode or self.data.completed))
+      self.intraopDirectoryWatcher = createDirectoryWatcher(self.intraopDICOMDirectory, self.onIntraopFilesWritten,
+                                                            mode=self.getSetting("Intraop_Watcher_Mode") or "OFF")
     else:
       self.invokeEvent(SlicerDevelopmentToolboxEvents.StoppedEvent)
-    self.importDICOMSeries(self.getFileList(self.intraopDICOMDirectory))
+    self.importDICOMSeries(self.intraopStorage.listFiles())
     if self.intraopDICOMReceiver:
       self.intraopDICOMReceiver.forceStatusChangeEventUpdate()
 
@@ -451,6 +517,10 @@ class ProstateAblationSession(StepBasedSession):
     if self.intraopDICOMReceiver:
       self.intraopDICOMReceiver.stop()
       self.intraopDICOMReceiver.removeEventObservers()
+    self.intraopDirectoryWatcher = getattr(self, "intraopDirectoryWatcher", None)
+    if self.intraopDirectoryWatcher:
+      self.intraopDirectoryWatcher.stop()
+      self.intraopDirectoryWatcher = None
 
   def _observeIntraopDICOMReceiverEvents(self):
     self.intraopDICOMReceiver.addEventObserver(self.intraopDICOMReceiver.IncomingDataReceiveFinishedEvent,
@@ -471,27 +541,258 @@ class ProstateAblationSession(StepBasedSession):
     if self.trainingMode is True:
       self.resetIntraopDICOMReceiver()
 
-  def importDICOMSeries(self, newFileList):
-    indexer = ctk.ctkDICOMIndexer()
+  def onIntraopFilesWritten(self, fileNames):
+    self.importDICOMSeries(fileNames, transferFinished=False)
 
-    newSeries = []
-    for currentIndex, currentFile in enumerate(newFileList, start=1):
-      self.invokeEvent(SlicerDevelopmentToolboxEvents.NewFileIndexedEvent,
-                       ["Indexing file %s" % currentFile, len(newFileList), currentIndex].__str__())
-      slicer.app.processEvents()
-      currentFile = os.path.join(self.intraopDICOMDirectory, currentFile)
-      indexer.addFile(slicer.dicomDatabase, currentFile, None)
-      series = self.makeSeriesNumberDescription(currentFile)
-      if series not in self.seriesList:
-        if not series.split(": ")[0] == '__TAG_NOT_IN_INSTANCE__':
-          self.seriesList.append(series)
-          newSeries.append(series)
-          self.loadableList[series] = self.createLoadableFileListForSeries(series)
-    self.seriesList = sorted(self.seriesList, key=lambda s: int(s.split(": ")[0]))
-
-    if len(newFileList):
+  def importDICOMSeries(self, newFileList, transferFinished=True):
+    if self.pendingImports and self.pendingImports[-1][1] == transferFinished:
+      self.pendingImports[-1][0].extend(newFileList)
+    else:
+      self.pendingImports.append((list(newFileList), transferFinished))
+    if not (self.importTask and self.importTask.running):
+      self.importTask = CooperativeTask(self.generateImportSteps(),
+                                        timeSlice=self.getNumericSetting("Import_TimeSlice") or 50,
+                                        progressCallback=self.onImportProgress,
+                                        progressRate=self.getNumericSetting("Import_ProgressRate"))
+      self.importTask.start()
+
+  def finishPendingImports(self):
+    """ Runs queued imports to completion right away, for callers relying on all received series to be known """
+    if self.importTask:
+      self.importTask.finish()
+
+  def generateImportSteps(self):
+    while self.pendingImports:
+      newFileList, transferFinished = self.pendingImports.pop(0)
+      for progress in self.generateImportStepsForFiles(newFileList, transferFinished):
+        yield progress
+
+  def generateImportStepsForFiles(self, newFileList, transferFinished=True):
+    headerIndex = self.dicomHeaderIndex
+    # the receiver and the watcher keep reporting the names of files which were moved into series directories since
+    newFileList = [headerIndex.resolveMovedFile(f) for f in newFileList if not self.intraopStorage.isSeriesDirectory(f)]
+    filePaths = [os.path.join(self.intraopDICOMDirectory, f) for f in newFileList]
+    updatedFiles = set()
+    skippedFiles = []
+    for start in range(0, len(filePaths), self.IMPORT_CHUNK_SIZE):
+      chunk = filePaths[start:start + self.IMPORT_CHUNK_SIZE]
+      updatedFiles.update(headerIndex.update(chunk, skippedFiles=skippedFiles))
+      yield ImportProgress("Reading DICOM headers", len(filePaths), start + len(chunk))
+    if skippedFiles:
+      logging.info("Skipped %d resent DICOM instances (%d in total)" % (len(skippedFiles),
+                                                                       headerIndex.skippedDuplicates))
+
+    # newly indexed files are moved into their series directories before anything refers to their paths
+    moves = self.intraopStorage.partition(list(updatedFiles) + skippedFiles,
+                                          lambda f: headerIndex.getIntegerValue(f, "SeriesNumber"))
+    if moves:
+      headerIndex.moveFiles(moves)
+      updatedFiles = set(moves.get(f, f) for f in updatedFiles)
+      skippedFiles = [moves.get(f, f) for f in skippedFiles]
+      newFileList = [moves.get(headerIndex.getRelativePath(f), f) for f in newFileList]
+      filePaths = [os.path.join(self.intraopDICOMDirectory, f) for f in newFileList]
+
+    # files with unchanged headers from a previous session are only added to the DICOM database in the background,
+    # resent instances are not added at all
+    newFiles = [f for f in filePaths if headerIndex.getRelativePath(f) in updatedFiles]
+    skippedFiles = set(skippedFiles)
+    self.dicomDatabaseIndexer.deferFiles([f for f in filePaths if headerIndex.getRelativePath(f) not in updatedFiles
+                                          and headerIndex.getRelativePath(f) not in skippedFiles
+                                          and not headerIndex.isDuplicate(f)])
+    for start in range(0, len(newFiles), self.IMPORT_CHUNK_SIZE):
+      chunk = newFiles[start:start + self.IMPORT_CHUNK_SIZE]
+      self.dicomDatabaseIndexer.addFiles(chunk)
+      yield ImportProgress("Indexing DICOM files", len(newFiles), start + len(chunk))
+
+    receivedSeries, newSeries = self.updateSeriesForFiles(newFileList)
+    headerIndex.save()
+
+    if transferFinished and len(newFileList):
       self.verifyPatientIDEquality(newFileList)
-      self.invokeEvent(self.NewImageSeriesReceivedEvent, newSeries.__str__())
+    if newSeries:
+      self.invokeEvent(self.IntraopSeriesUpdatedEvent)
+    # series are announced by NewImageSeriesReceivedEvent once the assembler considers them complete
+    for series in receivedSeries:
+      self.updateSeriesAssembly(series, transferFinished)
+    self.seriesAssembler.evaluatePendingSeries()
+
+  def updateSeriesAssembly(self, series, transferFinished):
+    files = self.seriesRegistry.get(series).files
+    headerIndex = self.dicomHeaderIndex
+    imagesInAcquisition = [headerIndex.getIntegerValue(f, "ImagesInAcquisition") for f in files]
+    numberOfFrames = [headerIndex.getIntegerValue(f, "NumberOfFrames") for f in files]
+    self.seriesAssembler.update(series, [headerIndex.getIntegerValue(f, "InstanceNumber") for f in files],
+                                imagesInAcquisition=max([n for n in imagesInAcquisition if n is not None] or [None]),
+                                numberOfFrames=max([n for n in numberOfFrames if n is not None] or [None]),
+                                transferFinished=transferFinished)
+    self.updateSeriesCompleteness(series)
+
+  @vtk.calldata_type(vtk.VTK_STRING)
+  def onSeriesCompleted(self, caller, event, callData):
+    completedSeries = self.seriesRegistry.sortNames(ast.literal_eval(callData))
+    for series in completedSeries:
+      record = self.seriesRegistry.get(series)
+      if record is None:
+        continue
+      # volumes loaded before the series was complete are loaded again with all files
+      if record.loadState != Series.NOT_LOADED and not self.isSeriesComplete(series):
+        self.volumeCache.pop(series)
+        self.setSeriesLoadState(series, Series.NOT_LOADED)
+        self.previewJobs.pop(series, None)
+        self.volumePrefetcher.cancel(series)
+      self.updateSeriesCompleteness(series)
+    for series in completedSeries:
+      self.prefetchVolumeForSeries(series)
+    self.invokeEvent(self.NewImageSeriesReceivedEvent, completedSeries.__str__())
+
+  def isPrefetchEnabledForSeries(self, series):
+    seriesType = self.getSeriesType(series)
+    return any(self.seriesTypeManager.isSeriesTypeOf(seriesType, settingName)
+               for settingName in self.getPrefetchedSeriesTypes())
+
+  def prefetchVolumeForSeries(self, series):
+    record = self.seriesRegistry.get(series)
+    if record is None or record.loadState != Series.NOT_LOADED or self.volumePrefetcher.isPending(series) or \
+        str(self.getSetting("Prefetch_Enabled")).lower() != "true" or self.getSetting("Volume_Loader") == "SLICER" or \
+        not self.isPrefetchEnabledForSeries(series):
+      return
+    loader = DICOMVolumeLoader(self.dicomHeaderIndex)
+    geometry = loader.computeGeometry(record.files)
+    if geometry is None:
+      return
+    memorySize = geometry.estimateMemorySize()
+    memoryLimit = (self.getNumericSetting("Prefetch_MemoryLimit") or 0) * 1024 * 1024
+    self.prefetchedSeries = dict((s, size) for s, size in self.prefetchedSeries.items()
+                                 if s in self.volumeCache or self.volumePrefetcher.isPending(s))
+    if sum(self.prefetchedSeries.values()) + memorySize > memoryLimit:
+      logging.info("Not prefetching series %s, prefetch memory limit reached" % series)
+      return
+    self.prefetchedSeries[series] = memorySize
+    self.volumePrefetcher.enqueue(series, loader, geometry)
+
+  def onVolumePrefetched(self, job):
+    previewJob = self.previewJobs.pop(job.series, None)
+    if job.imageData is None or job.series not in self.seriesRegistry:
+      self.prefetchedSeries.pop(job.series, None)
+      if previewJob and job.series in self.seriesRegistry:
+        # the full resolution data is read again once it is needed
+        self.previewJobs[job.series] = previewJob
+      return
+    self.setFullResolutionVolume(job.series, job)
+
+  def setFullResolutionVolume(self, series, job):
+    self.previewJobs.pop(series, None)
+    volume = self.volumeCache.peek(series)
+    if volume is None:
+      volume = DICOMVolumeLoader.createVolumeNode(series, job.imageData, job.geometry.ijkToRAS)
+    else:
+      # replacing the data of a preview in place keeps views and slice positions
+      DICOMVolumeLoader.updateVolumeNode(volume, job.imageData, job.geometry.ijkToRAS)
+    self.volumeCache.add(series, volume)
+    self.setSeriesLoadState(series, Series.LOADED)
+    return volume
+
+  def onSeriesTypeManuallyAssigned(self, caller, event):
+    self.updateSeriesTypes()
+    self.invokeEvent(self.SeriesTypeManuallyAssignedEvent)
+
+  def onSeriesTypeSettingsChanged(self, caller, event):
+    self.updateSeriesTypes()
+
+  def updateSeriesTypes(self):
+    for record in self.seriesRegistry:
+      record.seriesType = self.seriesTypeManager.getSeriesType(record.name)
+
+  def getSeriesType(self, series):
+    # changed settings are applied to the records by onSeriesTypeSettingsChanged
+    self.seriesTypeManager.refreshSettings()
+    record = self.seriesRegistry.get(series)
+    return record.seriesType if record else self.seriesTypeManager.getSeriesType(series)
+
+  def isWorkableSeries(self, series):
+    return self.seriesTypeManager.isWorkableSeriesType(self.getSeriesType(series))
+
+  def isSeriesComplete(self, series):
+    record = self.seriesRegistry.get(series)
+    return record is not None and record.completeness == SeriesAssembler.COMPLETE
+
+  def setSeriesLoadState(self, series, loadState):
+    record = self.seriesRegistry.get(series)
+    if record:
+      record.loadState = loadState
+
+  def updateSeriesCompleteness(self, series):
+    record = self.seriesRegistry.get(series)
+    if record:
+      record.completeness = self.seriesAssembler.getState(series)
+
+  def createPreviewVolumeForSeries(self, series):
+    files = self.seriesRegistry.get(series).files
+    if str(self.getSetting("Progressive_Display_Enabled")).lower() != "true" or \
+        self.getSetting("Volume_Loader") == "SLICER" or \
+        len(files) < (self.getNumericSetting("Progressive_Display_MinimumSlices") or 0):
+      return None
+    loader = DICOMVolumeLoader(self.dicomHeaderIndex)
+    geometry = loader.computeGeometry(files)
+    if geometry is None:
+      return None
+    previewGeometry = loader.computePreviewGeometry(
+      geometry, sliceStep=int(self.getNumericSetting("Progressive_Display_SliceStep") or 1),
+      inPlaneStep=int(self.getNumericSetting("Progressive_Display_InPlaneStep") or 1))
+    try:
+      imageData = loader.readImageData(previewGeometry)
+    except Exception as exc:
+      logging.warning("Could not create a preview for series %s: %s" % (series, exc))
+      return None
+    volume = DICOMVolumeLoader.createVolumeNode(series, imageData, previewGeometry.ijkToRAS)
+    self.volumeCache.add(series, volume)
+    self.setSeriesLoadState(series, Series.PREVIEW)
+    self.previewJobs[series] = self.volumePrefetcher.enqueue(series, loader, geometry)
+    return volume
+
+  def completePreviewVolume(self, series):
+    job = self.previewJobs.pop(series)
+    self.volumePrefetcher.wait(series)
+    if job.imageData is None:
+      try:
+        job.imageData = job.loader.readImageData(job.geometry)
+      except Exception as exc:
+        logging.warning("Could not load series %s in full resolution: %s" % (series, exc))
+        self.volumeCache.evict(series)
+        return None
+    return self.setFullResolutionVolume(series, job)
+
+  @vtk.calldata_type(vtk.VTK_STRING)
+  def onSeriesStalled(self, caller, event, callData):
+    for series in ast.literal_eval(callData):
+      self.updateSeriesCompleteness(series)
+    self.invokeEvent(self.IntraopSeriesUpdatedEvent)
+
+  def onImportProgress(self, progress):
+    self.importProgress = progress
+    self.invokeEvent(SlicerDevelopmentToolboxEvents.NewFileIndexedEvent)
+
+  def updateSeriesForFiles(self, fileList):
+    headerIndex = self.dicomHeaderIndex
+    receivedSeries = []
+    newSeries = []
+    receivedSeriesNumbers = set()
+    for currentFile in [os.path.join(self.intraopDICOMDirectory, f) for f in fileList]:
+      seriesNumber = headerIndex.getSeriesNumberForFile(currentFile)
+      if seriesNumber is None or seriesNumber in receivedSeriesNumbers:
+        continue
+      receivedSeriesNumbers.add(seriesNumber)
+      uid = headerIndex.getValue(currentFile, "SeriesInstanceUID")
+      record = (self.seriesRegistry.getByUID(uid) if uid else None) or self.seriesRegistry.getByNumber(seriesNumber)
+      if record is None:
+        record = Series(seriesNumber, headerIndex.getValue(currentFile, "SeriesDescription"),
+                        self.makeSeriesNumberDescription(currentFile), uid=uid)
+        record.seriesType = self.seriesTypeManager.getSeriesType(record.name)
+        self.seriesRegistry.add(record)
+        newSeries.append(record.name)
+      record.files = headerIndex.getFilesForSeries(seriesNumber)
+      receivedSeries.append(record.name)
+    return receivedSeries, newSeries
 
   def verifyPatientIDEquality(self, receivedFiles):
     seriesNumberPatientID = self.getAdditionalInformationForReceivedSeries(receivedFiles)
@@ -517,54 +818,56 @@ class ProstateAblationSession(StepBasedSession):
 
   def getPatientIDValidationSource(self):
     # TODO: For loading case purposes it would be nice to keep track which series were accepted
-    if len(self.loadableList.keys()) > 1:
-      keylist = self.loadableList.keys()
-      keylist.sort(key=lambda x: int(x.split(": ")[0]))
-      return self.loadableList[keylist[0]][0]
+    if len(self.seriesRegistry) > 1:
+      return self.seriesRegistry.first().files[0]
     else:
       return None
 
-  def getOrCreateVolumeForSeries(self, series):
-    try:
-      volume = self.alreadyLoadedSeries[series]
-    except KeyError:
+  def getOrCreateVolumeForSeries(self, series, preview=False):
+    """ With preview, large series may be returned as a downsampled volume whose data is replaced in place by the full
+    resolution once it was loaded in the background. Without, the full resolution volume is always returned.
+    """
+    # prefetched volumes only count against the prefetch memory limit until they are used
+    self.prefetchedSeries.pop(series, None)
+    volume = self.volumeCache.get(series)
+    if volume is None:
+      prefetchJob = self.volumePrefetcher.wait(series)
+      if prefetchJob and prefetchJob.imageData is not None:
+        volume = self.setFullResolutionVolume(series, prefetchJob)
+    if volume is None and preview:
+      volume = self.createPreviewVolumeForSeries(series)
+    elif volume is not None and not preview and series in self.previewJobs:
+      volume = self.completePreviewVolume(series)
+    if volume is None:
       logging.info("Need to load volume")
-      files = self.loadableList[series]
-      loadables = self.scalarVolumePlugin.examine([files])
-      success, volume = slicer.util.loadVolume(files[0], returnNode=True)
-      volume.SetName(loadables[0].name)
-      self.alreadyLoadedSeries[series] = volume
+      files = self.seriesRegistry.get(series).files
+      if self.getSetting("Volume_Loader") != "SLICER":
+        volume = DICOMVolumeLoader(self.dicomHeaderIndex).load(series, files)
+      if volume is None:
+        success, volume = slicer.util.loadVolume(files[0], returnNode=True)
+        volume.SetName(series)
+      self.volumeCache.add(series, volume)
+      self.setSeriesLoadState(series, Series.LOADED)
     slicer.app.processEvents()
     return volume
 
-  def createLoadableFileListForSeries(self, series):
-    seriesNumber = int(series.split(": ")[0])
-    loadableList = []
-    for dcm in self.getFileList(self.intraopDICOMDirectory):
-      currentFile = os.path.join(self.intraopDICOMDirectory, dcm)
-      if self.getDICOMValue(currentFile, DICOMTAGS.SERIES_NUMBER) and (not self.getDICOMValue(currentFile, DICOMTAGS.SERIES_NUMBER)  == '__TAG_NOT_IN_INSTANCE__'):
-        try:
-          int(self.getDICOMValue(currentFile, DICOMTAGS.SERIES_NUMBER))
-        except:
-          print "nothing: ", self.getDICOMValue(currentFile, DICOMTAGS.SERIES_NUMBER)
-        currentSeriesNumber = int(self.getDICOMValue(currentFile, DICOMTAGS.SERIES_NUMBER))
-        if currentSeriesNumber and currentSeriesNumber == seriesNumber:
-          loadableList.append(currentFile)
-    return loadableList
-
   def deleteSeriesFromSeriesList(self, seriesNumber):
-    for series in self.seriesList:
-      currentSeriesNumber = int(series.split(": ")[0])
-      if currentSeriesNumber == seriesNumber:
-        self.seriesList.remove(series)
-        for seriesFile in self.loadableList[series]:
-          logging.debug("removing {} from filesystem".format(seriesFile))
-          os.remove(seriesFile)
-        del self.loadableList[series]
+    record = self.seriesRegistry.remove(seriesNumber)
+    if record is None:
+      return
+    self.prefetchedSeries.pop(record.name, None)
+    seriesDirectory = self.intraopStorage.getSeriesDirectory(seriesNumber)
+    for seriesFile in record.files + self.dicomHeaderIndex.removeSeries(seriesNumber):
+      # files within the series directory are deleted with it
+      if os.path.dirname(seriesFile) != seriesDirectory and os.path.exists(seriesFile):
+        logging.debug("removing {} from filesystem".format(seriesFile))
+        os.remove(seriesFile)
+    self.intraopStorage.deleteSeries(seriesNumber)
+    self.dicomHeaderIndex.save()
 
   def makeSeriesNumberDescription(self, dcmFile):
-    seriesDescription = self.getDICOMValue(dcmFile, DICOMTAGS.SERIES_DESCRIPTION)
-    seriesNumber = self.getDICOMValue(dcmFile, DICOMTAGS.SERIES_NUMBER)
+    seriesDescription = self.dicomHeaderIndex.getValue(dcmFile, "SeriesDescription")
+    seriesNumber = self.dicomHeaderIndex.getValue(dcmFile, "SeriesNumber")
     if not (seriesNumber and seriesDescription):
       raise DICOMValueError("Missing Attribute(s):\nFile: {}\nseriesNumber: {}\nseriesDescription: {}"
                             .format(dcmFile, seriesNumber, seriesDescription))
@@ -573,19 +876,16 @@ class ProstateAblationSession(StepBasedSession):
   def getAdditionalInformationForReceivedSeries(self, fileList):
     seriesNumberPatientID = {}
     for currentFile in [os.path.join(self.intraopDICOMDirectory, f) for f in fileList]:
-      seriesNumber = int(self.getDICOMValue(currentFile, DICOMTAGS.SERIES_NUMBER))
-      if seriesNumber not in seriesNumberPatientID.keys():
+      seriesNumber = self.dicomHeaderIndex.getSeriesNumberForFile(currentFile)
+      if seriesNumber is not None and seriesNumber not in seriesNumberPatientID.keys():
         seriesNumberPatientID[seriesNumber]= self.getPatientInformation(currentFile)
     return seriesNumberPatientID
 
   def getPatientInformation(self, currentFile):
-    return {
-      "PatientID": self.getDICOMValue(currentFile, DICOMTAGS.PATIENT_ID),
-      "PatientName": self.getDICOMValue(currentFile, DICOMTAGS.PATIENT_NAME),
-      "SeriesDescription": self.getDICOMValue(currentFile, DICOMTAGS.SERIES_DESCRIPTION)}
+    return self.dicomHeaderIndex.getPatientInformation(currentFile)
 
   def getSeriesForSubstring(self, substring):
-    for series in reversed(self.seriesList):
+    for series in reversed(self.seriesRegistry.names):
       if substring in series:
         return series
     return None
@@ -594,6 +894,7 @@ class ProstateAblationSession(StepBasedSession):
     if not os.path.exists(os.path.join(self.outputDirectory, constants.JSON_FILENAME)):
       if len(os.listdir(self.intraopDICOMDirectory)):
         self.startIntraopDICOMReceiver()
+        self.finishPendingImports()
     else:
       self.openSavedSession()
 
@@ -658,6 +959,8 @@ class ProstateAblationSession(StepBasedSession):
           break
 
   def isTrackingPossible(self, series):
+    if series not in self.seriesRegistry:
+      return False
     if self.data.completed:
       logging.debug("No tracking possible. Case has been marked as completed!")
       return False
@@ -665,7 +968,7 @@ class ProstateAblationSession(StepBasedSession):
       return True
 
   def isEligibleForDistanceMeasure(self, series):
-    seriesType = self.seriesTypeManager.getSeriesType(series)
+    seriesType = self.getSeriesType(series)
     listItems = [str(item) for item in self.getSetting("COVER_PROSTATE") + self.getSetting("COVER_TEMPLATE") + self.getSetting("VIBE_IMAGE")]
     return self.isAnyListItemInString(seriesType, listItems)
 
@@ -0,0 +1,124 @@
+import numpy
+import vtk
+import slicer
+from vtk.util import numpy_support
+
+
+class EllipsoidSliceIntersections(object):
+  """ Draws the intersections of ellipsoids with the slice planes as ellipse contours computed in closed form, instead
+  of letting every slice view cut the ellipsoid meshes on each reslice.
+
+  Ellipsoids are given by their centers and half axes, i.e. the matrices whose columns are the semi axis vectors.
+  """
+
+  NUMBER_OF_CONTOUR_POINTS = 64
+  SLICE_VIEW_NAMES = ["Red", "Yellow", "Green"]
+
+  def __init__(self, color=(0.0, 1.0, 0.0), lineWidth=2):
+    self.color = color
+    self.lineWidth = lineWidth
+    self.overlays = {}
+    self.visible = False
+    self.centers = numpy.zeros((0, 3))
+    self.halfAxes = numpy.zeros((0, 3, 3))
+
+  def clear(self):
+    self.visible = False
+    self.setEllipsoids(numpy.zeros((0, 3)), numpy.zeros((0, 3, 3)))
+
+  def cleanup(self):
+    for sliceWidget, sliceNode, observer, _, actor, renderer in self.overlays.values():
+      sliceNode.RemoveObserver(observer)
+      renderer.RemoveActor2D(actor)
+      sliceWidget.sliceView().scheduleRender()
+    self.overlays = {}
+
+  def setEllipsoids(self, centers, halfAxes):
+    self.centers = numpy.asarray(centers, dtype=float).reshape(-1, 3)
+    self.halfAxes = numpy.asarray(halfAxes, dtype=float).reshape(-1, 3, 3)
+    self.update()
+
+  def setVisibility(self, visible):
+    if self.visible != visible:
+      self.visible = visible
+      self.update()
+
+  def update(self):
+    if self.visible:
+      self.setupOverlays()
+    for name in self.overlays.keys():
+      self.updateOverlay(name)
+
+  def setupOverlays(self):
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager is None:
+      return
+    for name in self.SLICE_VIEW_NAMES:
+      sliceWidget = layoutManager.sliceWidget(name)
+      if sliceWidget is None or name in self.overlays:
+        continue
+      polyData = vtk.vtkPolyData()
+      mapper = vtk.vtkPolyDataMapper2D()
+      mapper.SetInputData(polyData)
+      actor = vtk.vtkActor2D()
+      actor.SetMapper(mapper)
+      actor.GetProperty().SetColor(self.color)
+      actor.GetProperty().SetLineWidth(self.lineWidth)
+      renderer = sliceWidget.sliceView().renderWindow().GetRenderers().GetItemAsObject(0)
+      renderer.AddActor2D(actor)
+      sliceNode = sliceWidget.sliceLogic().GetSliceNode()
+      observer = sliceNode.AddObserver(vtk.vtkCommand.ModifiedEvent,
+                                       lambda caller, event, viewName=name: self.updateOverlay(viewName))
+      self.overlays[name] = (sliceWidget, sliceNode, observer, polyData, actor, renderer)
+
+  def updateOverlay(self, name):
+    sliceWidget, sliceNode, _, polyData, actor, _ = self.overlays[name]
+    actor.SetVisibility(self.visible)
+    if self.visible:
+      xyToRAS = sliceNode.GetXYToRAS()
+      xyToRAS = numpy.array([[xyToRAS.GetElement(row, col) for col in range(4)] for row in range(4)])
+      centersXY, halfAxesXY = self.computeSliceEllipses(self.centers, self.halfAxes, xyToRAS)
+      self.setContours(polyData, self.createContourPoints(centersXY, halfAxesXY, self.NUMBER_OF_CONTOUR_POINTS))
+    sliceWidget.sliceView().scheduleRender()
+
+  @staticmethod
+  def computeSliceEllipses(centers, halfAxes, xyToRAS):
+    # the slice plane is RAS = origin + x * e1 + y * e2. In the unit sphere coordinates of each ellipsoid this gives
+    # |q + x * u + y * v|^2 = 1, which is an ellipse in slice view XY coordinates
+    if not len(centers):
+      return numpy.zeros((0, 2)), numpy.zeros((0, 2, 2))
+    toUnitSphere = numpy.linalg.inv(halfAxes)
+    q = numpy.einsum('nij,nj->ni', toUnitSphere, xyToRAS[0:3, 3] - centers)
+    u = numpy.einsum('nij,j->ni', toUnitSphere, xyToRAS[0:3, 0])
+    v = numpy.einsum('nij,j->ni', toUnitSphere, xyToRAS[0:3, 1])
+    uv = (u * v).sum(axis=1)
+    quadratic = numpy.stack([numpy.column_stack(((u * u).sum(axis=1), uv)),
+                             numpy.column_stack((uv, (v * v).sum(axis=1)))], axis=1)
+    linear = numpy.column_stack(((q * u).sum(axis=1), (q * v).sum(axis=1)))
+    centersXY = -numpy.linalg.solve(quadratic, linear[:, :, numpy.newaxis])[:, :, 0]
+    level = 1.0 - (q * q).sum(axis=1) - (linear * centersXY).sum(axis=1)
+    intersecting = level > 0
+    eigenValues, eigenVectors = numpy.linalg.eigh(quadratic[intersecting])
+    radii = numpy.sqrt(level[intersecting, numpy.newaxis] / eigenValues)
+    return centersXY[intersecting], eigenVectors * radii[:, numpy.newaxis, :]
+
+  @staticmethod
+  def createContourPoints(centersXY, halfAxesXY, numberOfPoints):
+    angles = numpy.linspace(0, 2 * numpy.pi, numberOfPoints, endpoint=False)
+    unitCircle = numpy.vstack((numpy.cos(angles), numpy.sin(angles)))
+    return centersXY[:, :, numpy.newaxis] + numpy.einsum('nij,jk->nik', halfAxesXY, unitCircle)
+
+  @staticmethod
+  def setContours(polyData, contours):
+    numberOfContours, _, numberOfPoints = contours.shape
+    points = numpy.zeros((numberOfContours * numberOfPoints, 3))
+    points[:, 0:2] = contours.transpose(0, 2, 1).reshape(-1, 2)
+    pointIds = numpy.arange(numberOfContours * numberOfPoints).reshape(numberOfContours, numberOfPoints)
+    cells = numpy.column_stack((numpy.full(numberOfContours, numberOfPoints + 1), pointIds, pointIds[:, 0]))
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+    lines = vtk.vtkCellArray()
+    lines.SetCells(numberOfContours, numpy_support.numpy_to_vtkIdTypeArray(cells.astype(numpy.int64).ravel(), deep=True))
+    polyData.SetPoints(vtkPoints)
+    polyData.SetLines(lines)
+    polyData.Modified()
@@ -13,9 +13,65 @@ from base import ProstateAblationLogicBase, ProstateAblationStep
 from ProstateAblationUtils.steps.plugins.case import ProstateAblationCaseManagerPlugin
 from ProstateAblationUtils.steps.plugins.training import ProstateAblationTrainingPlugin
 from ..constants import ProstateAblationConstants as constants
-from ..helpers import SeriesTypeManager
 from SlicerDevelopmentToolboxUtils.icons import Icons
 
+class IntraopSeriesListModel(qt.QAbstractListModel):
+  """ Lists the received series ordered by series number. Rows are inserted and removed for changed series only, so
+  that views keep their current index and scroll position, and rowForSeries looks up the row of a series directly.
+  """
+
+  def __init__(self, parent=None):
+    qt.QAbstractListModel.__init__(self, parent)
+    self.seriesNames = []
+    self.rows = {}
+
+  def rowCount(self, parent=None):
+    return len(self.seriesNames)
+
+  def data(self, index, role):
+    if not index.isValid() or index.row() >= len(self.seriesNames):
+      return None
+    if role in [qt.Qt.DisplayRole, qt.Qt.EditRole, qt.Qt.ToolTipRole]:
+      return self.seriesNames[index.row()]
+    if role == qt.Qt.BackgroundRole:
+      return COLOR.GREEN
+    return None
+
+  def rowForSeries(self, series):
+    return self.rows.get(series, -1)
+
+  def seriesForRow(self, row):
+    return self.seriesNames[row] if 0 <= row < len(self.seriesNames) else None
+
+  def setSeriesNames(self, seriesNames):
+    """ Applies the difference to seriesNames, which needs to keep the order of the series already listed
+    """
+    if seriesNames == self.seriesNames:
+      return
+    remaining = set(seriesNames)
+    for row in reversed(range(len(self.seriesNames))):
+      if self.seriesNames[row] not in remaining:
+        self.beginRemoveRows(qt.QModelIndex(), row, row)
+        del self.seriesNames[row]
+        self.endRemoveRows()
+    for row, series in enumerate(seriesNames):
+      if row >= len(self.seriesNames) or self.seriesNames[row] != series:
+        self.beginInsertRows(qt.QModelIndex(), row, row)
+        self.seriesNames.insert(row, series)
+        self.endInsertRows()
+    self.rows = dict((series, row) for row, series in enumerate(self.seriesNames))
+
+  def refresh(self):
+    if self.seriesNames:
+      self.dataChanged(self.index(0, 0), self.index(len(self.seriesNames) - 1, 0))
+
+  def clear(self):
+    self.beginResetModel()
+    self.seriesNames = []
+    self.rows = {}
+    self.endResetModel()
+
+
 class ProstateAblationOverViewStepLogic(ProstateAblationLogicBase):
 
   def __init__(self, ProstateAblationSession):
@@ -64,7 +120,7 @@ class ProstateAblationOverviewStep(ProstateAblationStep):
     self.intraopSeriesSelector.setSizePolicy(qt.QSizePolicy.Expanding, qt.QSizePolicy.Minimum)
     self.intraopSeriesSelector.setMinimumContentsLength(20)
     self.intraopSeriesSelector.setSizeAdjustPolicy(qt.QComboBox().AdjustToMinimumContentsLength)
-    self._seriesModel = qt.QStandardItemModel()
+    self._seriesModel = IntraopSeriesListModel()
     self.intraopSeriesSelector.setModel(self._seriesModel)
 
   def setupConnections(self):
@@ -76,11 +132,13 @@ class ProstateAblationOverviewStep(ProstateAblationStep):
   def addSessionObservers(self):
     super(ProstateAblationOverviewStep, self).addSessionObservers()
     self.session.addEventObserver(self.session.SeriesTypeManuallyAssignedEvent, self.onSeriesTypeManuallyAssigned)
+    self.session.addEventObserver(self.session.IntraopSeriesUpdatedEvent, self.onIntraopSeriesUpdated)
     self.session.addEventObserver(self.session.ZFrameRegistrationSuccessfulEvent, self.onZFrameRegistrationSuccessful)
 
   def removeSessionEventObservers(self):
     ProstateAblationStep.removeSessionEventObservers(self)
     self.session.removeEventObserver(self.session.SeriesTypeManuallyAssignedEvent, self.onSeriesTypeManuallyAssigned)
+    self.session.removeEventObserver(self.session.IntraopSeriesUpdatedEvent, self.onIntraopSeriesUpdated)
     self.session.removeEventObserver(self.session.ZFrameRegistrationSuccessfulEvent, self.onZFrameRegistrationSuccessful)
 
   def onNeedleTipLocateButtonClicked(self):
@@ -114,11 +172,9 @@ class ProstateAblationOverviewStep(ProstateAblationStep):
     logging.info("Current series selection changed invoked from session")
     logging.info("Series with name %s selected" % callData if callData else "")
     if callData:
-      model = self.intraopSeriesSelector.model()
-      index = next((i for i in range(model.rowCount()) if model.item(i).text() == callData), None)
-      self.intraopSeriesSelector.currentIndex = index
+      self.intraopSeriesSelector.currentIndex = self._seriesModel.rowForSeries(callData)
       self.intraopSeriesSelector.setToolTip(callData)
-      self.setupFourUpView(self.session.currentSeriesVolume)
+      self.setupFourUpView(self.session.getOrCreateVolumeForSeries(callData, preview=True))
 
   @logmethod(logging.INFO)
   def onZFrameRegistrationSuccessful(self, caller, event):
@@ -151,6 +207,11 @@ class ProstateAblationOverviewStep(ProstateAblationStep):
     self.updateIntraopSeriesSelectorTable()
 
   def onSeriesTypeManuallyAssigned(self, caller, event):
+    self._seriesModel.refresh()
+    if self.active and not self.session.isLoading():
+      self.selectMostRecentEligibleSeries()
+
+  def onIntraopSeriesUpdated(self, caller, event):
     self.updateIntraopSeriesSelectorTable()
 
   @vtk.calldata_type(vtk.VTK_STRING)
@@ -165,11 +226,7 @@ class ProstateAblationOverviewStep(ProstateAblationStep):
       return
     selectedSeries = self.intraopSeriesSelector.currentText
     if selectedSeries != "" and self.session.isTrackingPossible(selectedSeries):
-      selectedSeriesNumber = int(selectedSeries.split(": ")[0])
-
-      newImageSeries = ast.literal_eval(callData)
-      newImageSeriesNumbers = [int(s.split(": ")[0]) for s in newImageSeries]
-      if selectedSeriesNumber in newImageSeriesNumbers:
+      if selectedSeries in ast.literal_eval(callData):
         self.takeActionOnSelectedSeries()
 
   def onCaseOpened(self, caller, event):
@@ -184,30 +241,26 @@ class ProstateAblationOverviewStep(ProstateAblationStep):
       return
 
   def updateIntraopSeriesSelectorTable(self):
-    self.intraopSeriesSelector.blockSignals(True)
-    currentIndex = self.intraopSeriesSelector.currentIndex
-    self._seriesModel.clear()
-    for series in self.session.seriesList:
-      sItem = qt.QStandardItem(series)
-      self._seriesModel.appendRow(sItem)
-      color = COLOR.GREEN
-      self._seriesModel.setData(sItem.index(), color, qt.Qt.BackgroundRole)
-    self.intraopSeriesSelector.setCurrentIndex(currentIndex)
-    self.intraopSeriesSelector.blockSignals(False)
+    if not self._seriesModel.rowCount():
+      # QComboBox selects the first row on its own when rows are added to an empty model
+      self.intraopSeriesSelector.blockSignals(True)
+      self._seriesModel.setSeriesNames(list(self.session.seriesRegistry.names))
+      self.intraopSeriesSelector.setCurrentIndex(-1)
+      self.intraopSeriesSelector.blockSignals(False)
+    else:
+      self._seriesModel.setSeriesNames(list(self.session.seriesRegistry.names))
     self.intraopSeriesSelector.setStyleSheet("QComboBox{'background-color: green;'} QToolTip{background-color: white;}")
     if self.active and not self.session.isLoading():
       self.selectMostRecentEligibleSeries()
 
   def selectMostRecentEligibleSeries(self):
-    seriesTypeManager = SeriesTypeManager()
     self.intraopSeriesSelector.blockSignals(True)
     self.intraopSeriesSelector.setCurrentIndex(-1)
     self.intraopSeriesSelector.blockSignals(False)
     index = -1
-    for item in list(reversed(range(len(self.session.seriesList)))):
-      series = self._seriesModel.item(item).text()
-      if seriesTypeManager.isWorkableSeries(series):
-        index = self.intraopSeriesSelector.findText(series)
+    for row in reversed(range(self._seriesModel.rowCount())):
+      if self.session.isWorkableSeries(self._seriesModel.seriesForRow(row)):
+        index = row
         break
-    rowCount = self.intraopSeriesSelector.model().rowCount()
+    rowCount = self._seriesModel.rowCount()
     self.intraopSeriesSelector.setCurrentIndex(index if index != -1 else (rowCount-1 if rowCount else -1))
\ No newline at end of file
@@ -4,11 +4,111 @@ import slicer
 import numpy
 from ...constants import ProstateAblationConstants as constants
 from ..base import ProstateAblationPlugin
+from ...helpers import CoalescingScheduler
 
 from SlicerDevelopmentToolboxUtils.helpers import SliceAnnotation
 from SlicerDevelopmentToolboxUtils.widgets import TargetCreationWidget
 from SlicerDevelopmentToolboxUtils.icons import Icons
-from targetsDefinitionTable import TargetsDefinitionTable
+from targetsDefinitionTable import TargetsDefinitionTable, ZFrameGuidanceComputation
+
+
+class TargetDistanceListModel(qt.QAbstractListModel):
+  """ Lists the distances between all pairs of targets. The distance matrix is computed at once and updated per row
+  when single targets move, while item texts are only formatted for the rows requested by the view. Markup events are
+  coalesced by a CoalescingScheduler running at most maxRate times per second.
+  """
+
+  def __init__(self, parent=None, maxRate=None):
+    qt.QAbstractListModel.__init__(self, parent)
+    self.targetList = None
+    self.targetListObservers = []
+    self.updateScheduler = CoalescingScheduler(self.onTargetsModified, maxRate=maxRate)
+    self.labels = []
+    self.positions = numpy.zeros((0, 3))
+    self.distances = numpy.zeros((0, 0))
+    self.maximumDistance = None
+    self.pairs = numpy.zeros((0, 2), dtype=int)
+
+  def rowCount(self, parent=None):
+    return len(self.pairs)
+
+  def data(self, index, role):
+    if not index.isValid() or role not in [qt.Qt.DisplayRole, qt.Qt.ToolTipRole] or index.row() >= len(self.pairs):
+      return None
+    indexA, indexB = self.pairs[index.row()]
+    return "%s -> %s: %3.1f cm" % (self.labels[indexA], self.labels[indexB], self.distances[indexA, indexB])
+
+  def setTargetList(self, targetList):
+    if self.targetList is not targetList:
+      if self.targetList:
+        for observer in self.targetListObservers:
+          self.targetList.RemoveObserver(observer)
+      self.targetList = targetList
+      self.targetListObservers = []
+      if targetList:
+        self.targetListObservers = [
+          targetList.AddObserver(targetList.PointModifiedEvent, self.onPointModified),
+          targetList.AddObserver(targetList.MarkupAddedEvent, self.onMarkupListChanged),
+          targetList.AddObserver(targetList.MarkupRemovedEvent, self.onMarkupListChanged)
+        ]
+    self.updateScheduler.cancel()
+    self.update()
+
+  def setMaximumDistance(self, maximumDistance):
+    self.maximumDistance = maximumDistance if maximumDistance else None
+    self.updatePairs()
+
+  def update(self):
+    if self.targetList:
+      self.labels = [str(self.targetList.GetNthFiducialLabel(index))
+                     for index in range(self.targetList.GetNumberOfFiducials())]
+      self.positions = ZFrameGuidanceComputation.getTargetPositions(self.targetList)
+    else:
+      self.labels = []
+      self.positions = numpy.zeros((0, 3))
+    self.distances = self.computeDistanceMatrix(self.positions)
+    self.updatePairs()
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointModified(self, caller, event, callData=None):
+    self.updateScheduler.schedule(callData)
+
+  def onMarkupListChanged(self, caller=None, event=None):
+    self.updateScheduler.schedule(None)
+
+  def onTargetsModified(self, dirtyIndexes):
+    if not self.targetList or None in dirtyIndexes or \
+        self.targetList.GetNumberOfFiducials() != len(self.positions) or \
+        any(not 0 <= index < len(self.positions) for index in dirtyIndexes):
+      self.update()
+      return
+    for index in dirtyIndexes:
+      self.targetList.GetNthFiducialPosition(index, self.positions[index])
+      self.labels[index] = str(self.targetList.GetNthFiducialLabel(index))
+    for index in dirtyIndexes:
+      distances = numpy.linalg.norm(self.positions - self.positions[index], axis=1) / 10.0  # unit cm
+      self.distances[index, :] = distances
+      self.distances[:, index] = distances
+    self.updatePairs()
+
+  def updatePairs(self):
+    indexesA, indexesB = numpy.triu_indices(len(self.positions), 1)
+    if self.maximumDistance is not None:
+      closeEnough = self.distances[indexesA, indexesB] < self.maximumDistance
+      indexesA, indexesB = indexesA[closeEnough], indexesB[closeEnough]
+    pairs = numpy.column_stack((indexesA, indexesB)).astype(int)
+    if numpy.array_equal(pairs, self.pairs):
+      if len(pairs):
+        self.dataChanged(self.index(0, 0), self.index(len(pairs) - 1, 0))
+      return
+    self.beginResetModel()
+    self.pairs = pairs
+    self.endResetModel()
+
+  @staticmethod
+  def computeDistanceMatrix(positions):
+    differences = positions[:, numpy.newaxis, :] - positions[numpy.newaxis, :, :]
+    return numpy.sqrt(numpy.einsum('ijk,ijk->ij', differences, differences)) / 10.0  # unit cm
 
 
 class TargetsDefinitionPlugin(ProstateAblationPlugin):
@@ -32,13 +132,24 @@ class TargetsDefinitionPlugin(ProstateAblationPlugin):
     self.fiducialsWidget.addEventObserver(self.fiducialsWidget.StartedEvent, self.onTargetingStarted)
     self.fiducialsWidget.addEventObserver(self.fiducialsWidget.FinishedEvent, self.onTargetingFinished)
     self.fiducialsWidget.targetListSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onFiducialListSelected)
-    self.targetDistanceWidget = qt.QListWidget()
+    self.targetDistanceModel = TargetDistanceListModel(maxRate=self.session.getRecomputationMaxRate())
+    self.targetDistanceWidget = qt.QListView()
     self.targetDistanceWidget.setWindowTitle("Distances Between Targets")
+    self.targetDistanceWidget.setUniformItemSizes(True)
+    self.targetDistanceWidget.setModel(self.targetDistanceModel)
+    self.targetDistanceFilterSpinBox = qt.QDoubleSpinBox()
+    self.targetDistanceFilterSpinBox.setRange(0.0, 100.0)
+    self.targetDistanceFilterSpinBox.setSingleStep(0.5)
+    self.targetDistanceFilterSpinBox.setDecimals(1)
+    self.targetDistanceFilterSpinBox.setSuffix(" cm")
+    self.targetDistanceFilterSpinBox.setSpecialValueText("All")
+    self.targetDistanceFilterSpinBox.valueChanged.connect(self.targetDistanceModel.setMaximumDistance)
     #self.showTargetDistanceIcon = self.createIcon('icon-distance.png')
     #self.showTargetDistanceButton = self.createButton("", enabled=True, icon=self.showTargetDistanceIcon, iconSize=qt.QSize(24, 24),
     #                                              toolTip="Start placing targets")
     self.targetingGroupBoxLayout.addRow(self.targetTablePlugin)
     self.targetingGroupBoxLayout.addRow(self.fiducialsWidget)
+    self.targetingGroupBoxLayout.addRow("Distances closer than:", self.targetDistanceFilterSpinBox)
     self.targetingGroupBoxLayout.addRow(self.targetDistanceWidget)
     self.layout().addWidget(self.targetingGroupBox, 1, 0, 2, 2)
     #self.layout().addWidget(self.targetDistanceWidget)
@@ -60,7 +171,7 @@ class TargetsDefinitionPlugin(ProstateAblationPlugin):
   def cleanup(self):
     self.fiducialsWidget.reset()
     self.targetTablePlugin.cleanup()
-    self.targetDistanceWidget.clear()
+    self.targetDistanceModel.setTargetList(None)
 
   def onDeactivation(self):
     super(TargetsDefinitionPlugin, self).onDeactivation()
@@ -82,22 +193,7 @@ class TargetsDefinitionPlugin(ProstateAblationPlugin):
     self.sliceAnnotations = []
 
   def calculateTargetsDistance(self):
-    self.targetDistanceWidget.clear()
-    if self.targetTablePlugin.currentTargets is not None:
-      numberOfTargets = self.targetTablePlugin.currentTargets.GetNumberOfFiducials()
-      for targetIndex_A in range(numberOfTargets):
-        for targetIndex_B in range(targetIndex_A+1, numberOfTargets):
-          tAName = self.targetTablePlugin.currentTargets.GetNthFiducialLabel(targetIndex_A)
-          tBName = self.targetTablePlugin.currentTargets.GetNthFiducialLabel(targetIndex_B)
-          posA = 3*[0.0]
-          posB = 3*[0.0]
-          self.targetTablePlugin.currentTargets.GetNthFiducialPosition(targetIndex_A, posA)
-          self.targetTablePlugin.currentTargets.GetNthFiducialPosition(targetIndex_B, posB)
-          dist = numpy.linalg.norm(numpy.array(posA)-numpy.array(posB))/10.0
-          itemString = str(tAName) + " -> " +  str(tBName) + ": " + '%3.1f' % dist + " cm"
-          tmpWidgetItem = qt.QListWidgetItem(itemString)
-          self.targetDistanceWidget.addItem(tmpWidgetItem)
-    pass
+    self.targetDistanceModel.setTargetList(self.targetTablePlugin.currentTargets)
 
   def onFiducialListSelected(self, node):
     if node:
@@ -1,11 +1,13 @@
 import qt
 import vtk
 import numpy
+import weakref
 import logging
 import slicer
 from ...constants import ProstateAblationConstants as constants
 from ..base import ProstateAblationPlugin, ProstateAblationLogicBase
 from ProstateAblationUtils.steps.zFrameRegistration import ProstateAblationZFrameRegistrationStepLogic
+from ...helpers import CoalescingScheduler
 from SlicerDevelopmentToolboxUtils.mixins import ModuleLogicMixin
 from SlicerDevelopmentToolboxUtils.decorators import onModuleSelected
 from SlicerDevelopmentToolboxUtils.helpers import SliceAnnotation
@@ -140,12 +142,15 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
   @targetList.setter
   def targetList(self, targetList):
     self._targetList = targetList
-    if self.currentGuidanceComputation and self.observer:
-      self.currentGuidanceComputation.RemoveObserver(self.observer)
+    if self.currentGuidanceComputation:
+      self.currentGuidanceComputation.removeEventObserver(vtk.vtkCommand.ModifiedEvent, self.updateTable)
+      self.currentGuidanceComputation.removeEventObserver(self.currentGuidanceComputation.RowsModifiedEvent,
+                                                          self.onGuidanceRowsModified)
     self.currentGuidanceComputation = self.getOrCreateNewGuidanceComputation(targetList)
     if self.currentGuidanceComputation:
-      self.observer = self.currentGuidanceComputation.addEventObserver(vtk.vtkCommand.ModifiedEvent,
-                                                                       self.updateTable)
+      self.currentGuidanceComputation.addEventObserver(vtk.vtkCommand.ModifiedEvent, self.updateTable)
+      self.currentGuidanceComputation.addEventObserver(self.currentGuidanceComputation.RowsModifiedEvent,
+                                                       self.onGuidanceRowsModified)
     self.beginResetModel();
     self.endResetModel();
 
@@ -157,6 +162,7 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
   @coverProstateTargetList.setter
   def coverProstateTargetList(self, targetList):
     self._coverProstateTargetList = targetList
+    self.comparisonTable.invalidate()
 
   @property
   def cursorPosition(self):
@@ -172,12 +178,12 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
     self.session = ProstateAblationSession
     self._cursorPosition = None
     self._targetList = None
-    self._guidanceComputations = []
+    self.comparisonTable = TargetComparisonTable(self.PLANNING_IMAGE_NAME)
+    self.guidanceComputations = GuidanceComputationCache(self.session)
     self.currentGuidanceComputation = None
     self.targetList = targets
     self.computeCursorDistances = False
     self.currentTargetIndex = -1
-    self.observer = None
     self.session.addEventObserver(self.session.ZFrameRegistrationSuccessfulEvent, self.onZFrameRegistrationSuccessful)
 
   def flags(self, index):
@@ -199,27 +205,25 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
     return -1
 
   def getOrCreateNewGuidanceComputation(self, targetList):
-    if not targetList:
-      return None
-    guidance = None
-    for crntGuidance in self._guidanceComputations:
-      if crntGuidance.targetList is targetList:
-        guidance = crntGuidance
-        break
-    if not guidance:
-      self._guidanceComputations.append(ZFrameGuidanceComputation(self.session, targetList))
-      guidance = self._guidanceComputations[-1]
-    if self._targetList is targetList:
+    guidance = self.guidanceComputations.getOrCreate(targetList)
+    if guidance and self._targetList is targetList:
       self.updateTable()
     return guidance
 
   def onZFrameRegistrationSuccessful(self, caller, event):
-    self._guidanceComputations = []
+    self.guidanceComputations.clear()
+    self.comparisonTable.invalidate()
+    self.targetList = self._targetList
 
   def updateTable(self, caller=None, event=None):
     self.dataChanged(self.index(0, self.getColunmNumForHeaderName(self.COLUMN_HOLE)), self.index(self.rowCount() - 1, self.getColunmNumForHeaderName(self.COLUMN_DEPTH)))
     self.invokeEvent(vtk.vtkCommand.ModifiedEvent)
 
+  def onGuidanceRowsModified(self, caller=None, event=None):
+    firstRow, lastRow = self.currentGuidanceComputation.modifiedRows
+    self.dataChanged(self.index(firstRow, self.getColunmNumForHeaderName(self.COLUMN_HOLE)),
+                     self.index(lastRow, self.getColunmNumForHeaderName(self.COLUMN_DEPTH)))
+
   def rowCount(self):
     try:
       number_of_targets = self.targetList.GetNumberOfFiducials()
@@ -257,83 +261,273 @@ class CustomTargetTableModel(qt.QAbstractTableModel, ModuleLogicMixin):
   def getBackgroundOrToolTipData(self, index, role):
     if role not in [qt.Qt.BackgroundRole, qt.Qt.ToolTipRole]:
       return None
-    if self.currentGuidanceComputation is None:
+    comparisonTable = self.getComparisonTable()
+    if comparisonTable is None:
       return None
-    backgroundRequested = role == qt.Qt.BackgroundRole
-    row = index.row()
-    col = index.column()
-    outOfRangeText = "" if self.currentGuidanceComputation.getZFrameDepthInRange(row) else "Current depth: out of range"
-    if self.coverProstateTargetList and not self.coverProstateTargetList is self.targetList:
-      if col in [3, 4]:
-        coverProstateGuidance = self.getOrCreateNewGuidanceComputation(self.coverProstateTargetList)
-        if col == 3:
-          coverProstateHole = coverProstateGuidance.getZFrameHole(row)
-          if self.currentGuidanceComputation.getZFrameHole(row) == coverProstateHole:
-            return qt.QColor(qt.Qt.green) if backgroundRequested else ""
-          else:
-            return qt.QColor(qt.Qt.red) if backgroundRequested else "{} hole: {}".format(self.PLANNING_IMAGE_NAME,
-                                                                                         coverProstateHole)
-        elif col == 4:
-          currentDepth = self.currentGuidanceComputation.getZFrameDepth(row, asString=False)
-          coverProstateDepth = coverProstateGuidance.getZFrameDepth(row, asString=False)
-          if abs(currentDepth - coverProstateDepth) <= max(1e-9 * max(abs(currentDepth), abs(coverProstateDepth)), 0.5):
-            if backgroundRequested:
-              return qt.QColor(qt.Qt.red) if len(outOfRangeText) else qt.QColor(qt.Qt.green)
-            return "%s depth: '%.1f' %s" % (self.PLANNING_IMAGE_NAME, coverProstateDepth, "\n"+outOfRangeText)
-          else:
-            if backgroundRequested:
-              return qt.QColor(qt.Qt.red)
-            return "%s depth: '%.1f' %s" % (self.PLANNING_IMAGE_NAME, coverProstateDepth, "\n"+outOfRangeText)
-    elif self.coverProstateTargetList is self.targetList and col == 4:
-      if backgroundRequested and len(outOfRangeText):
-        return qt.QColor(qt.Qt.red)
-      elif len(outOfRangeText):
-        return outOfRangeText
-    return None
+    return comparisonTable.getBackgroundOrToolTip(index.row(), index.column(), role == qt.Qt.BackgroundRole)
+
+  def getComparisonTable(self):
+    if self.currentGuidanceComputation is None or self.coverProstateTargetList is None:
+      return None
+    currentGuidance = self.currentGuidanceComputation
+    plannedGuidance = currentGuidance if self.coverProstateTargetList is self.targetList else \
+      self.guidanceComputations.getOrCreate(self.coverProstateTargetList)
+    for guidance in set([currentGuidance, plannedGuidance]):
+      guidance.updateIfOutdated()
+    getKey = lambda: (id(currentGuidance), currentGuidance.revision, id(plannedGuidance), plannedGuidance.revision,
+                      self.rowCount())
+    if self.comparisonTable.key != getKey():
+      self.comparisonTable.update(currentGuidance, plannedGuidance, self.rowCount())
+      # the getters might have filled missing rows while updating, which increases the revisions
+      self.comparisonTable.key = getKey()
+    return self.comparisonTable
+
+
+class TargetComparisonTable(object):
+  """ Hole and depth comparison between the planned (cover prostate) and the current guidance per target row. It is
+  rebuilt once per change of either guidance computation, so that painting the table only needs lookups.
+  """
+
+  HOLE_COLUMN = 3
+  DEPTH_COLUMN = 4
+  DEPTH_TOLERANCE = 0.5 # unit cm
+  OUT_OF_RANGE_TEXT = "Current depth: out of range"
+
+  def __init__(self, planningImageName):
+    self.planningImageName = planningImageName
+    self.colors = {True: qt.QColor(qt.Qt.green), False: qt.QColor(qt.Qt.red)}
+    self.invalidate()
+
+  def invalidate(self):
+    self.key = None
+    self.compared = False
+    self.holeMatches = numpy.zeros(0, dtype=bool)
+    self.depthDeltas = numpy.zeros(0)
+    self.depthMatches = numpy.zeros(0, dtype=bool)
+    self.inRange = numpy.zeros(0, dtype=bool)
+    self.holeToolTips = []
+    self.depthToolTips = []
+
+  def __len__(self):
+    return len(self.inRange)
+
+  def update(self, currentGuidance, plannedGuidance, numberOfRows):
+    self.invalidate()
+    self.compared = plannedGuidance is not currentGuidance
+    if self.compared:
+      numberOfRows = min(numberOfRows, plannedGuidance.targetList.GetNumberOfFiducials())
+    rows = range(numberOfRows)
+    self.inRange = numpy.array([currentGuidance.getZFrameDepthInRange(row) for row in rows], dtype=bool)
+    outOfRangeTexts = ["" if inRange else self.OUT_OF_RANGE_TEXT for inRange in self.inRange]
+    if not self.compared:
+      self.depthToolTips = outOfRangeTexts
+      return
+    plannedHoles = [plannedGuidance.getZFrameHole(row) for row in rows]
+    plannedDepths = numpy.array([plannedGuidance.getZFrameDepth(row, asString=False) for row in rows], dtype=float)
+    currentDepths = numpy.array([currentGuidance.getZFrameDepth(row, asString=False) for row in rows], dtype=float)
+    self.holeMatches = numpy.array([currentGuidance.getZFrameHole(row) == plannedHole
+                                    for row, plannedHole in zip(rows, plannedHoles)], dtype=bool)
+    self.depthDeltas = numpy.abs(currentDepths - plannedDepths)
+    tolerances = numpy.maximum(1e-9 * numpy.maximum(numpy.abs(currentDepths), numpy.abs(plannedDepths)),
+                               self.DEPTH_TOLERANCE)
+    self.depthMatches = self.depthDeltas <= tolerances
+    self.holeToolTips = ["" if match else "{} hole: {}".format(self.planningImageName, plannedHole)
+                         for match, plannedHole in zip(self.holeMatches, plannedHoles)]
+    self.depthToolTips = ["%s depth: '%.1f' %s" % (self.planningImageName, plannedDepth, "\n" + outOfRangeText)
+                          for plannedDepth, outOfRangeText in zip(plannedDepths, outOfRangeTexts)]
+
+  def getBackgroundOrToolTip(self, row, col, backgroundRequested):
+    if row >= len(self) or col not in [self.HOLE_COLUMN, self.DEPTH_COLUMN]:
+      return None
+    if not self.compared:
+      if col != self.DEPTH_COLUMN or self.inRange[row]:
+        return None
+      return self.colors[False] if backgroundRequested else self.depthToolTips[row]
+    if col == self.HOLE_COLUMN:
+      return self.colors[bool(self.holeMatches[row])] if backgroundRequested else self.holeToolTips[row]
+    if backgroundRequested:
+      return self.colors[bool(self.depthMatches[row] and self.inRange[row])]
+    return self.depthToolTips[row]
+
+
+class GuidanceComputationCache(object):
+  """ Guidance computations keyed by markups node ID. Entries are evicted when their node is removed from the scene,
+  when the node behind an ID changed, or on clear(), which also removes the observers of the evicted computations.
+  """
+
+  def __init__(self, ProstateAblationSession):
+    self.session = ProstateAblationSession
+    self._computations = {}
+    self.hits = 0
+    self.misses = 0
+    self.sceneObserver = slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved)
+
+  def __del__(self):
+    slicer.mrmlScene.RemoveObserver(self.sceneObserver)
+
+  def __len__(self):
+    return len(self._computations)
+
+  def __contains__(self, nodeID):
+    return nodeID in self._computations
+
+  def getOrCreate(self, targetList):
+    if not targetList:
+      return None
+    nodeID = self.getNodeKey(targetList)
+    computation = self._computations.get(nodeID)
+    if computation is not None and computation.targetList is targetList:
+      self.hits += 1
+      return computation
+    self.misses += 1
+    self.evict(nodeID)
+    computation = ZFrameGuidanceComputation(self.session, targetList)
+    self._computations[nodeID] = computation
+    return computation
+
+  @staticmethod
+  def getNodeKey(targetList):
+    return targetList.GetID() or "%s-%x" % (targetList.GetClassName(), id(targetList))
+
+  def evict(self, nodeID):
+    computation = self._computations.pop(nodeID, None)
+    if computation is not None:
+      computation.cleanup()
+
+  def clear(self):
+    for nodeID in self._computations.keys():
+      self.evict(nodeID)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, caller, event, node):
+    if isinstance(node, slicer.vtkMRMLMarkupsNode):
+      self.evict(node.GetID())
 
 
 class ZFrameGuidanceComputation(ModuleLogicMixin):
 
-  SUPPORTED_EVENTS = [vtk.vtkCommand.ModifiedEvent]
+  RowsModifiedEvent = vtk.vtkCommand.UserEvent + 501
+
+  SUPPORTED_EVENTS = [vtk.vtkCommand.ModifiedEvent, RowsModifiedEvent]
+
+  @property
+  def targetList(self):
+    targetList = self._targetListReference() if self._targetListReference else None
+    if targetList is None and self.targetListID:
+      targetList = slicer.mrmlScene.GetNodeByID(self.targetListID)
+      self._targetListReference = weakref.ref(targetList) if targetList else None
+    return targetList
 
   def __init__(self, ProstateAblationSession, targetList = None):
     self.zFrameRegistration = ProstateAblationZFrameRegistrationStepLogic(ProstateAblationSession)
     self.session = ProstateAblationSession
-    self.targetList = targetList
-    if self.targetList:
-      self.observer = self.targetList.AddObserver(self.targetList.PointModifiedEvent, self.calculate)
-      self.observer = self.targetList.AddObserver(self.targetList.MarkupRemovedEvent, self.calculate)
+    self._targetListReference = weakref.ref(targetList) if targetList else None
+    self.targetListID = targetList.GetID() if targetList else None
+    self.targetListObservers = []
+    self.revision = 0
+    self.modifiedRows = None
+    self.recalculationScheduler = CoalescingScheduler(self.recalculate, maxRate=self.session.getRecomputationMaxRate())
+    if targetList:
+      self.targetListObservers = [
+        targetList.AddObserver(targetList.PointModifiedEvent, self.onPointModified),
+        targetList.AddObserver(targetList.MarkupAddedEvent, self.onMarkupListChanged),
+        targetList.AddObserver(targetList.MarkupRemovedEvent, self.onMarkupListChanged)
+      ]
     self.reset()
     self.calculate()
 
   def __del__(self):
-    if self.targetList and self.observer:
-      self.targetList.RemoveObserver(self.observer)
+    self.removeTargetListObservers()
+
+  def cleanup(self):
+    self.recalculationScheduler.cancel()
+    self.removeTargetListObservers()
+    self.removeEventObservers()
+
+  def removeTargetListObservers(self):
+    targetList = self.targetList
+    if targetList:
+      for observer in self.targetListObservers:
+        targetList.RemoveObserver(observer)
+    self.targetListObservers = []
 
   def reset(self):
+    self.revision += 1
+    self.templateVersion = self.zFrameRegistration.templatePaths.version
+    self.markupIDs = self.getMarkupIDs()
     self.needleStartEndPositions = {}
     self.computedHoles = {}
     self.computedDepth = {}
 
+  def getMarkupIDs(self):
+    if not self.targetList:
+      return []
+    return [self.targetList.GetNthMarkupID(index) for index in range(self.targetList.GetNumberOfFiducials())]
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointModified(self, caller, event, callData=None):
+    self.recalculationScheduler.schedule(callData)
+
+  def onMarkupListChanged(self, caller=None, event=None):
+    # moves the cached entries of the remaining markups to their new indexes instead of recomputing all of them
+    markupIDs = self.getMarkupIDs()
+    previousIndexes = dict((markupID, index) for index, markupID in enumerate(self.markupIDs))
+    newIndexes = dict((previousIndexes[markupID], index) for index, markupID in enumerate(markupIDs)
+                      if markupID in previousIndexes)
+    for cache in [self.needleStartEndPositions, self.computedHoles, self.computedDepth]:
+      entries = dict((newIndexes[index], value) for index, value in cache.items() if index in newIndexes)
+      cache.clear()
+      cache.update(entries)
+    scheduler = self.recalculationScheduler
+    scheduler.dirtyKeys = set(newIndexes[index] if index is not None else None for index in scheduler.dirtyKeys
+                              if index is None or index in newIndexes)
+    self.markupIDs = markupIDs
+    self.revision += 1
+    shiftedRows = [index for previousIndex, index in newIndexes.items() if previousIndex != index]
+    if shiftedRows:
+      self.modifiedRows = (min(shiftedRows), len(markupIDs) - 1)
+      self.invokeEvent(self.RowsModifiedEvent)
+
+  def recalculate(self, dirtyIndexes):
+    if None in dirtyIndexes or self.templateVersion != self.zFrameRegistration.templatePaths.version:
+      self.calculate()
+      return
+    indexes = sorted(index for index in dirtyIndexes if 0 <= index < self.targetList.GetNumberOfFiducials())
+    if indexes:
+      self.calculateZFrameHolesAndDepths(indexes)
+      self.modifiedRows = (indexes[0], indexes[-1])
+      self.invokeEvent(self.RowsModifiedEvent)
+
   def calculate(self, caller=None, event=None):
     if not self.targetList:
       return
+    self.recalculationScheduler.cancel()
     self.reset()
-    for index in range(self.targetList.GetNumberOfFiducials()):
-      self.calculateZFrameHoleAndDepth(index)
+    self.calculateZFrameHolesAndDepths(range(self.targetList.GetNumberOfFiducials()))
     self.invokeEvent(vtk.vtkCommand.ModifiedEvent)
 
+  def updateIfOutdated(self):
+    self.recalculationScheduler.flushIfPending()
+    self.resetIfTemplateChanged()
+
+  def resetIfTemplateChanged(self):
+    if self.templateVersion != self.zFrameRegistration.templatePaths.version:
+      self.reset()
+
   def getNeedleEndPos(self, index):
+    self.updateIfOutdated()
     if index not in self.computedHoles.keys():
       self.calculateZFrameHoleAndDepth(index)
     return self.needleStartEndPositions[index][1]
 
   def getZFrameHole(self, index):
+    self.updateIfOutdated()
     if index not in self.computedHoles.keys():
       self.calculateZFrameHoleAndDepth(index)
     return '(%s, %s)' % (self.computedHoles[index][0], self.computedHoles[index][1])
 
   def getZFrameDepth(self, index, asString=True):
+    self.updateIfOutdated()
     if index not in self.computedHoles.keys():
       self.calculateZFrameHoleAndDepth(index)
     if asString:
@@ -343,60 +537,85 @@ class ZFrameGuidanceComputation(ModuleLogicMixin):
       return self.computedDepth[index][1]
 
   def getZFrameDepthInRange(self, index):
+    self.updateIfOutdated()
     if index not in self.computedHoles.keys():
       self.calculateZFrameHoleAndDepth(index)
     return self.computedDepth[index][0]
 
   def calculateZFrameHoleAndDepth(self, index):
-    targetPosition = self.getTargetPosition(self.targetList, index)
-    (start, end, indexX, indexY, depth, inRange) = self.computeNearestPath(targetPosition)
-    logging.debug("start:{}, end:{}, indexX:{}, indexY:{}, depth:{}, inRange:{}".format(start, end, indexX, indexY, depth, inRange))
-    needleDirection = (numpy.array(end) - numpy.array(start)) / numpy.linalg.norm(numpy.array(end) - numpy.array(start))
-    self.needleStartEndPositions[index] = (start, start + depth * needleDirection)
-    self.computedHoles[index] = [indexX, indexY]
-    self.computedDepth[index] = [inRange, round(depth/10, 1)]
+    self.calculateZFrameHolesAndDepths([index])
+
+  def calculateZFrameHolesAndDepths(self, indexes):
+    indexes = list(indexes)
+    if not len(indexes):
+      return
+    self.revision += 1
+    positions = self.getTargetPositions(self.targetList, indexes)
+    (starts, ends, indexesX, indexesY, depths, inRange) = self.computeNearestPaths(positions)
+    tips = self.getNeedleTipPositions(starts, ends, depths)
+    for row, index in enumerate(indexes):
+      logging.debug("start:{}, end:{}, indexX:{}, indexY:{}, depth:{}, inRange:{}".format(starts[row], ends[row],
+                                                                                           indexesX[row], indexesY[row],
+                                                                                           depths[row], inRange[row]))
+      self.needleStartEndPositions[index] = (starts[row], tips[row])
+      self.computedHoles[index] = [indexesX[row], indexesY[row]]
+      self.computedDepth[index] = [bool(inRange[row]), round(depths[row]/10, 1)]
+
+  @staticmethod
+  def getTargetPositions(targetList, indexes=None):
+    if indexes is None:
+      indexes = range(targetList.GetNumberOfFiducials())
+    positions = numpy.zeros((len(indexes), 3))
+    for row, index in enumerate(indexes):
+      targetList.GetNthFiducialPosition(index, positions[row])
+    return positions
+
+  @staticmethod
+  def getNeedleTipPositions(starts, ends, depths):
+    vectors = ends - starts
+    lengths = numpy.sqrt(numpy.einsum('ij,ij->i', vectors, vectors))
+    lengths[lengths == 0] = 1.0
+    return starts + (depths / lengths)[:, numpy.newaxis] * vectors
 
   def computeNearestPath(self, pos):
-    minMag2 = numpy.Inf
-    minDepth = 0.0
-    minIndex = -1
-    needleStart = None
-    needleEnd = None
-
-    p = numpy.array(pos)
-    for i, orig in enumerate(self.zFrameRegistration.pathOrigins):
-      vec = self.zFrameRegistration.pathVectors[i]
-      op = p - orig
-      aproj = numpy.inner(op, vec)
-      perp = op-aproj*vec
-      mag2 = numpy.vdot(perp, perp)
-      if mag2 < minMag2:
-        minMag2 = mag2
-        minIndex = i
-        minDepth = aproj
-      i += 1
-
-    indexX = '--'
-    indexY = '--'
-    inRange = False
-
-    if minIndex != -1:
-      indexX = self.zFrameRegistration.templateIndex[minIndex][0]
-      indexY = self.zFrameRegistration.templateIndex[minIndex][1]
-      if 0 < minDepth < self.zFrameRegistration.templateMaxDepth[minIndex]:
-        inRange = True
-        needleStart, needleEnd = self.getNeedleStartEndPointFromPathOrigins(minIndex)
-
-    return needleStart, needleEnd, indexX, indexY, minDepth, inRange
+    (starts, ends, indexesX, indexesY, depths, inRange) = self.computeNearestPaths([pos])
+    return starts[0], ends[0], indexesX[0], indexesY[0], depths[0], inRange[0]
+
+  def computeNearestPaths(self, positions):
+    # Finds the closest template path for all N positions at once by broadcasting them against all M paths
+    # (path vectors are unit length, therefore the squared distance to a path is |op|^2 - (op.v)^2)
+    positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+    numberOfPositions = len(positions)
+    templatePaths = self.zFrameRegistration.templatePaths
+    origins, vectors, maxDepths = templatePaths.origins, templatePaths.vectors, templatePaths.maxDepths
+
+    if not len(origins) or not numberOfPositions:
+      empty = numpy.full((numberOfPositions, 3), numpy.nan)
+      return empty, empty.copy(), ['--'] * numberOfPositions, ['--'] * numberOfPositions, \
+             numpy.zeros(numberOfPositions), numpy.zeros(numberOfPositions, dtype=bool)
+
+    op = positions[:, numpy.newaxis, :] - origins[numpy.newaxis, :, :]
+    aproj = numpy.einsum('nmk,mk->nm', op, vectors)
+    mag2 = numpy.einsum('nmk,nmk->nm', op, op) - aproj * aproj
+    nearest = numpy.argmin(mag2, axis=1)
+
+    depths = aproj[numpy.arange(numberOfPositions), nearest]
+    inRange = (depths > 0) & (depths < maxDepths[nearest])
+    starts, ends = self.getNeedleStartEndPointsFromPathOrigins(nearest)
+    indexesX = [templatePaths.templateIndex[i][0] for i in nearest]
+    indexesY = [templatePaths.templateIndex[i][1] for i in nearest]
+    return starts, ends, indexesX, indexesY, depths, inRange
 
   def getNeedleStartEndPointFromPathOrigins(self, index):
-    start = self.zFrameRegistration.pathOrigins[index]
-    v = self.zFrameRegistration.pathVectors[index]
-    nl = numpy.linalg.norm(v)
-    n = v / nl  # normal vector
-    l = self.zFrameRegistration.templateMaxDepth[index]
-    end = start + l * n
-    return start, end
+    starts, ends = self.getNeedleStartEndPointsFromPathOrigins([index])
+    return starts[0], ends[0]
+
+  def getNeedleStartEndPointsFromPathOrigins(self, indexes):
+    templatePaths = self.zFrameRegistration.templatePaths
+    starts = templatePaths.origins[indexes]
+    vectors = templatePaths.vectors[indexes]
+    normals = vectors / numpy.linalg.norm(vectors, axis=1)[:, numpy.newaxis]
+    return starts, starts + templatePaths.maxDepths[indexes][:, numpy.newaxis] * normals
 
 
 class TargetsDefinitionTableLogic(ProstateAblationLogicBase):
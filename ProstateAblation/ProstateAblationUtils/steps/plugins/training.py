@@ -90,7 +90,29 @@ class ProstateAblationTrainingPlugin(ProstateAblationPlugin):
       if os.path.isdir(current) and recursive:
         self.copyDirectory(current, destination, recursive)
       else:
-        shutil.copy(current, destination)
+        self.copyFile(current, destination)
+
+  def copyFile(self, source, destination):
+    """ Files which already exist in the destination and instances whose SOPInstanceUID was already received are
+    skipped. Files are hard linked if enabled and supported by the file system, and copied otherwise.
+    """
+    if os.path.isdir(destination):
+      destination = os.path.join(destination, os.path.basename(source))
+    if os.path.exists(destination) or self.isInstanceReceived(source):
+      return
+    if str(self.getSetting("Import_HardLink")).lower() == "true" and hasattr(os, "link"):
+      try:
+        os.link(source, destination)
+        return
+      except OSError:
+        pass
+    shutil.copy(source, destination)
+
+  def isInstanceReceived(self, fileName):
+    headerIndex = self.session.dicomHeaderIndex
+    if headerIndex is None:
+      return False
+    return headerIndex.hasInstance(headerIndex.readHeader(fileName).get("SOPInstanceUID"))
 
   def onIncomingDataSkipped(self, caller, event):
     self.simulateIntraopPhaseButton.enabled = True
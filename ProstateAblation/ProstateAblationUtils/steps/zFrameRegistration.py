@@ -49,6 +49,52 @@ class OpenSourceZFrameRegistration(ZFrameRegistrationBase):
     print params
     slicer.cli.run(slicer.modules.zframeregistration, None, params, wait_for_completion=True)
 
+class TemplatePathStore(object):
+  """ Needle paths of the template held as contiguous (N, 3) arrays in template and world coordinates.
+
+  The version is increased whenever the world coordinates change, so that consumers can keep derived data until the
+  template pose actually changes.
+  """
+
+  def __init__(self):
+    self.version = 0
+    self.clear()
+
+  def __len__(self):
+    return len(self.templateIndex)
+
+  def clear(self):
+    self.templateIndex = []
+    self.templateOrigins = numpy.zeros((0, 3))
+    self.templateVectors = numpy.zeros((0, 3))
+    self.maxDepths = numpy.zeros(0)
+    self.origins = numpy.zeros((0, 3))  ## Origins of needle paths (after transformation by parent transform node)
+    self.vectors = numpy.zeros((0, 3))  ## Normal vectors of needle paths (after transformation by parent transform node)
+    self.worldMatrix = None
+    self.version += 1
+
+  def load(self, templateIndex, templateConfig):
+    config = numpy.asarray(templateConfig, dtype=float).reshape(-1, 7)
+    vectors = config[:, 3:6] - config[:, 0:3]
+    self.templateIndex = list(templateIndex)
+    self.templateOrigins = config[:, 0:3].copy()
+    self.templateVectors = vectors / numpy.linalg.norm(vectors, axis=1)[:, numpy.newaxis]
+    self.maxDepths = config[:, 6].copy()
+    self.worldMatrix = None
+    self.setWorldMatrix(numpy.identity(4))
+
+  def setWorldMatrix(self, matrix):
+    matrix = numpy.asarray(matrix, dtype=float).reshape(4, 4)
+    if self.worldMatrix is not None and numpy.array_equal(matrix, self.worldMatrix):
+      return False
+    self.worldMatrix = matrix.copy()
+    homogeneousOrigins = numpy.hstack((self.templateOrigins, numpy.ones((len(self.templateOrigins), 1))))
+    self.origins = homogeneousOrigins.dot(matrix[0:3, :].T)
+    self.vectors = self.templateVectors.dot(matrix[0:3, 0:3].T)
+    self.version += 1
+    return True
+
+
 class ProstateAblationZFrameRegistrationStepLogic(ProstateAblationLogicBase):
 
   __metaclass__ = Singleton
@@ -69,9 +115,26 @@ class ProstateAblationZFrameRegistrationStepLogic(ProstateAblationLogicBase):
   def zFrameSuccessfulLoaded(self):
     return self.zFrameModelNode
 
+  @property
+  def pathOrigins(self):
+    return self.templatePaths.origins
+
+  @property
+  def pathVectors(self):
+    return self.templatePaths.vectors
+
+  @property
+  def templateMaxDepth(self):
+    return self.templatePaths.maxDepths
+
+  @property
+  def templateIndex(self):
+    return self.templatePaths.templateIndex
+
   def __init__(self, ProstateAblationSession):
     super(ProstateAblationZFrameRegistrationStepLogic, self).__init__(ProstateAblationSession)
     self.resourcesPath = os.path.join(self.modulePath, "Resources")
+    self.templatePaths = TemplatePathStore()
     self.setupSliceWidgets()
     self.resetAndInitialize()
 
@@ -87,9 +150,7 @@ class ProstateAblationZFrameRegistrationStepLogic(ProstateAblationLogicBase):
     self.tempModelNode = None
     self.pathModelNode = None
     self.templateConfig = []
-    self.templateMaxDepth = []
-    self.pathOrigins = []  ## Origins of needle paths (after transformation by parent transform node)
-    self.pathVectors = []  ## Normal vectors of needle paths (after transformation by parent transform node)
+    self.templatePaths.clear()
 
     self.clearOldNodes()
     self.loadZFrameModel()
@@ -129,7 +190,7 @@ class ProstateAblationZFrameRegistrationStepLogic(ProstateAblationLogicBase):
     self.redSliceLogic = self.redSliceWidget.sliceLogic()
 
   def loadTemplateConfigFile(self):
-    self.templateIndex = []
+    templateIndex = []
     self.templateConfig = []
     defaultTemplateFile = os.path.join(self.resourcesPath, "zframe", self.ZFRAME_NEEDLEPATH_CONFIG_FILE_NAME)
 
@@ -137,7 +198,7 @@ class ProstateAblationZFrameRegistrationStepLogic(ProstateAblationLogicBase):
     try:
       next(reader)
       for row in reader:
-        self.templateIndex.append(row[0:2])
+        templateIndex.append(row[0:2])
         self.templateConfig.append([float(row[2]), float(row[3]), float(row[4]),
                                     float(row[5]), float(row[6]), float(row[7]),
                                     float(row[8])])
@@ -145,15 +206,13 @@ class ProstateAblationZFrameRegistrationStepLogic(ProstateAblationLogicBase):
       print('file %s, line %d: %s' % (defaultTemplateFile, reader.line_num, e))
       return
 
+    self.templatePaths.load(templateIndex, self.templateConfig)
     self.createTemplateAndNeedlePathModel()
     self.setTemplateVisibility(0)
     self.setTemplatePathVisibility(0)
     self.updateTemplateVectors()
 
   def createTemplateAndNeedlePathModel(self):
-    self.templatePathVectors = []
-    self.templatePathOrigins = []
-
     zFrameTemplateModelFile= os.path.join(self.resourcesPath, self.ZFRAME_TEMPLATE_VTK_FILE_NAME)
     _, self.tempModelNode = slicer.util.loadModel(zFrameTemplateModelFile, returnNode=True)
     self.tempModelNode.SetName(self.ZFRAME_TEMPLATE_NAME)
@@ -162,27 +221,11 @@ class ProstateAblationZFrameRegistrationStepLogic(ProstateAblationLogicBase):
     needlePathModelFile = os.path.join(self.resourcesPath, self.ZFRAME_NEEDLEPATH_VTK_FILE_NAME)
     _, self.pathModelNode = slicer.util.loadModel(needlePathModelFile, returnNode=True)
 
-    for row in self.templateConfig:
-      p, n = self.extractPointsAndNormalVectors(row)
-
-      self.templatePathOrigins.append([row[0], row[1], row[2], 1.0])
-      self.templatePathVectors.append([n[0], n[1], n[2], 1.0])
-      self.templateMaxDepth.append(row[6])
     self.tempModelNode.GetDisplayNode().SetColor(0.5,0,1)
     self.tempModelNode.GetDisplayNode().SetSliceIntersectionVisibility(True)
     self.pathModelNode.GetDisplayNode().SetColor(0.8,0.5,1)
     self.pathModelNode.GetDisplayNode().SetSliceIntersectionVisibility(True)
 
-  def extractPointsAndNormalVectors(self, row):
-    p1 = numpy.array(row[0:3])
-    p2 = numpy.array(row[3:6])
-    v = p2-p1
-    nl = numpy.linalg.norm(v)
-    n = v/nl  # normal vector
-    l = row[6]
-    p3 = p1 + l * n
-    return [p1, p2, p3], n
-
   def updateTemplateVectors(self, observee=None, event=None):
     if self.tempModelNode is None:
       return
@@ -193,20 +236,7 @@ class ProstateAblationZFrameRegistrationStepLogic(ProstateAblationLogicBase):
       transformNode.GetMatrixTransformToWorld(trans)
     else:
       trans.Identity()
-    # Calculate offset
-    zero = [0.0, 0.0, 0.0, 1.0]
-    offset = trans.MultiplyDoublePoint(zero)
-
-    self.pathOrigins = []
-    self.pathVectors = []
-
-    for i, orig in enumerate(self.templatePathOrigins):
-      torig = trans.MultiplyDoublePoint(orig)
-      self.pathOrigins.append(numpy.array(torig[0:3]))
-      vec = self.templatePathVectors[i]
-      tvec = trans.MultiplyDoublePoint(vec)
-      self.pathVectors.append(numpy.array([tvec[0] - offset[0], tvec[1] - offset[1], tvec[2] - offset[2]]))
-      i += 1
+    self.templatePaths.setWorldMatrix([[trans.GetElement(row, col) for col in range(4)] for row in range(4)])
 
   def setZFrameVisibility(self, visibility):
     self.setNodeVisibility(self.zFrameModelNode, visibility)
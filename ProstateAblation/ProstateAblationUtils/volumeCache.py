@@ -0,0 +1,100 @@
+import logging
+from collections import OrderedDict
+
+import slicer
+
+
+class VolumeCache(object):
+  """ Least recently used cache of the volume nodes loaded for series, bounded by byteBudget. Volumes whose node IDs
+  are returned by pinnedVolumeIDsCallback are never evicted. Evicted volumes are removed from the scene and need to be
+  loaded again on their next access.
+  """
+
+  def __init__(self, byteBudget=None, pinnedVolumeIDsCallback=None, evictedCallback=None):
+    self.byteBudget = byteBudget
+    self.pinnedVolumeIDsCallback = pinnedVolumeIDsCallback
+    self.evictedCallback = evictedCallback
+    self.volumes = OrderedDict()
+    self.memorySizes = {}
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __contains__(self, series):
+    return series in self.volumes
+
+  def __len__(self):
+    return len(self.volumes)
+
+  @property
+  def memorySize(self):
+    return sum(self.memorySizes.values())
+
+  def get(self, series):
+    volume = self.volumes.pop(series, None)
+    if volume is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.volumes[series] = volume
+    return volume
+
+  def peek(self, series):
+    return self.volumes.get(series)
+
+  def add(self, series, volume):
+    self.volumes.pop(series, None)
+    self.volumes[series] = volume
+    self.memorySizes[series] = self.getMemorySize(volume)
+    self.evictIfNeeded(keep=series)
+
+  def pop(self, series, default=None):
+    """ Forgets the volume of series without removing its node from the scene
+    """
+    self.memorySizes.pop(series, None)
+    return self.volumes.pop(series, default)
+
+  def clear(self):
+    self.volumes = OrderedDict()
+    self.memorySizes = {}
+
+  def evictIfNeeded(self, keep=None):
+    if not self.byteBudget or self.memorySize <= self.byteBudget:
+      return
+    pinnedVolumeIDs = set(self.pinnedVolumeIDsCallback()) if self.pinnedVolumeIDsCallback else set()
+    for series, volume in self.volumes.items():
+      if self.memorySize <= self.byteBudget:
+        break
+      if series == keep or volume.GetID() in pinnedVolumeIDs:
+        continue
+      self.evict(series)
+
+  def evict(self, series):
+    volume = self.pop(series)
+    if volume is None:
+      return
+    self.evictions += 1
+    logging.debug("Evicting volume of series %s from the volume cache" % series)
+    if volume.GetScene():
+      nodes = [volume.GetNthDisplayNode(n) for n in range(volume.GetNumberOfDisplayNodes())] + \
+              [volume.GetStorageNode(), volume]
+      for node in nodes:
+        if node and node.GetScene():
+          slicer.mrmlScene.RemoveNode(node)
+    if self.evictedCallback:
+      self.evictedCallback(series)
+
+  def getStatistics(self):
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "evictions": self.evictions,
+      "volumes": len(self.volumes),
+      "memorySize": self.memorySize,
+      "byteBudget": self.byteBudget
+    }
+
+  @staticmethod
+  def getMemorySize(volume):
+    imageData = volume.GetImageData() if volume else None
+    return imageData.GetActualMemorySize() * 1024 if imageData else 0
@@ -0,0 +1,255 @@
+import Queue
+import logging
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy
+import qt
+import vtk
+import slicer
+from vtk.util import numpy_support
+
+from dicomIndex import dicom
+
+
+class SeriesGeometry(object):
+
+  __slots__ = ("files", "rows", "columns", "ijkToRAS", "inPlaneStep")
+
+  def __init__(self, files, rows, columns, ijkToRAS, inPlaneStep=1):
+    self.files = files
+    self.rows = rows
+    self.columns = columns
+    self.ijkToRAS = ijkToRAS
+    self.inPlaneStep = inPlaneStep
+
+  def estimateMemorySize(self, bytesPerVoxel=2):
+    return self.rows * self.columns * len(self.files) * bytesPerVoxel
+
+
+class DICOMVolumeLoader(object):
+  """ Loads single frame scalar series straight into a vtkMRMLScalarVolumeNode. Slices are sorted along the slice
+  normal using the geometry stored in the header index and their pixel data is decoded on a thread pool into the
+  preallocated image data of the volume.
+
+  load returns None for series it cannot handle (multi-frame files, inconsistent geometry or pixel representation,
+  pydicom not available), so that the caller can fall back to slicer.util.loadVolume.
+  """
+
+  LPS_TO_RAS = numpy.diag([-1.0, -1.0, 1.0, 1.0])
+  SPACING_TOLERANCE = 0.01 # relative
+
+  def __init__(self, headerIndex, numberOfWorkers=None):
+    self.headerIndex = headerIndex
+    self.numberOfWorkers = numberOfWorkers or min(8, multiprocessing.cpu_count())
+
+  def load(self, name, files):
+    geometry = self.computeGeometry(files)
+    if geometry is None:
+      return None
+    try:
+      imageData = self.readImageData(geometry)
+    except Exception as exc:
+      logging.warning("Could not decode pixel data of series %s: %s" % (name, exc))
+      return None
+    return self.createVolumeNode(name, imageData, geometry.ijkToRAS)
+
+  def computeGeometry(self, files):
+    if dicom is None or not files:
+      return None
+    headerIndex = self.headerIndex
+    if any((headerIndex.getIntegerValue(f, "NumberOfFrames") or 1) > 1 for f in files):
+      return None
+    orientations = set(headerIndex.getValue(f, "ImageOrientationPatient") for f in files)
+    sizes = set((headerIndex.getIntegerValue(f, "Rows"), headerIndex.getIntegerValue(f, "Columns")) for f in files)
+    # slices are decoded into a single array, which needs all of them to result in the same data type
+    representations = set(tuple(headerIndex.getValue(f, field) for field in
+                                ["BitsAllocated", "PixelRepresentation", "RescaleSlope", "RescaleIntercept"])
+                          for f in files)
+    orientation = headerIndex.getFloatValues(files[0], "ImageOrientationPatient")
+    pixelSpacing = headerIndex.getFloatValues(files[0], "PixelSpacing")
+    positions = [headerIndex.getFloatValues(f, "ImagePositionPatient") for f in files]
+    if len(orientations) != 1 or len(sizes) != 1 or len(representations) != 1 or None in list(sizes)[0] or \
+        not orientation or not pixelSpacing or any(p is None for p in positions):
+      return None
+    rows, columns = sizes.pop()
+    rowDirection, columnDirection = numpy.array(orientation[0:3]), numpy.array(orientation[3:6])
+    sliceDirection = numpy.cross(rowDirection, columnDirection)
+    positions = numpy.array(positions)
+    distances = positions.dot(sliceDirection)
+    order = numpy.argsort(distances, kind='mergesort')
+    sliceSpacing = self.computeSliceSpacing(distances[order])
+    if sliceSpacing is None:
+      return None
+    ijkToLPS = numpy.eye(4)
+    ijkToLPS[0:3, 0] = rowDirection * pixelSpacing[1]
+    ijkToLPS[0:3, 1] = columnDirection * pixelSpacing[0]
+    ijkToLPS[0:3, 2] = sliceDirection * sliceSpacing
+    ijkToLPS[0:3, 3] = positions[order[0]]
+    return SeriesGeometry([files[index] for index in order], rows, columns, self.LPS_TO_RAS.dot(ijkToLPS))
+
+  @staticmethod
+  def computePreviewGeometry(geometry, sliceStep=4, inPlaneStep=2):
+    """ Geometry of a downsampled preview using every sliceStep-th slice and every inPlaneStep-th row and column
+    """
+    ijkToRAS = geometry.ijkToRAS.copy()
+    ijkToRAS[0:3, 0:2] *= inPlaneStep
+    ijkToRAS[0:3, 2] *= sliceStep
+    return SeriesGeometry(geometry.files[::sliceStep], len(range(0, geometry.rows, inPlaneStep)),
+                          len(range(0, geometry.columns, inPlaneStep)), ijkToRAS, inPlaneStep)
+
+  def computeSliceSpacing(self, sortedDistances):
+    if len(sortedDistances) < 2:
+      return 1.0
+    spacings = numpy.diff(sortedDistances)
+    sliceSpacing = spacings.mean()
+    if sliceSpacing <= 0 or numpy.abs(spacings - sliceSpacing).max() > self.SPACING_TOLERANCE * sliceSpacing:
+      return None
+    return sliceSpacing
+
+  def readImageData(self, geometry):
+    step = geometry.inPlaneStep
+    firstSlice = self.readSlice(geometry.files[0])[::step, ::step]
+    if firstSlice.shape != (geometry.rows, geometry.columns):
+      raise ValueError("unexpected slice shape %s" % str(firstSlice.shape))
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(geometry.columns, geometry.rows, len(geometry.files))
+    imageData.AllocateScalars(numpy_support.get_vtk_array_type(firstSlice.dtype), 1)
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    voxels = voxels.reshape(len(geometry.files), geometry.rows, geometry.columns)
+    voxels[0] = firstSlice
+
+    def readSliceInto(index):
+      pixels = self.readSlice(geometry.files[index])[::step, ::step]
+      if pixels.dtype != voxels.dtype:
+        raise ValueError("slice %s decodes to %s instead of %s" % (geometry.files[index], pixels.dtype, voxels.dtype))
+      voxels[index] = pixels
+
+    remainingSlices = range(1, len(geometry.files))
+    if self.numberOfWorkers < 2 or len(remainingSlices) < 2:
+      map(readSliceInto, remainingSlices)
+    else:
+      pool = ThreadPool(self.numberOfWorkers)
+      try:
+        pool.map(readSliceInto, remainingSlices)
+      finally:
+        pool.close()
+        pool.join()
+    imageData.Modified()
+    return imageData
+
+  @staticmethod
+  def readSlice(fileName):
+    dataset = dicom.read_file(fileName)
+    pixels = dataset.pixel_array
+    slope = float(getattr(dataset, "RescaleSlope", 1) or 1)
+    intercept = float(getattr(dataset, "RescaleIntercept", 0) or 0)
+    if slope != 1 or intercept != 0:
+      pixels = (pixels * slope + intercept).astype(numpy.float32)
+    return pixels
+
+  @staticmethod
+  def createVolumeNode(name, imageData, ijkToRAS):
+    volume = slicer.vtkMRMLScalarVolumeNode()
+    volume.SetName(name)
+    DICOMVolumeLoader.updateVolumeNode(volume, imageData, ijkToRAS)
+    slicer.mrmlScene.AddNode(volume)
+    volume.CreateDefaultDisplayNodes()
+    volume.CreateDefaultStorageNode()
+    return volume
+
+  @staticmethod
+  def updateVolumeNode(volume, imageData, ijkToRAS):
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(4):
+      for col in range(4):
+        matrix.SetElement(row, col, ijkToRAS[row, col])
+    wasModifying = volume.StartModify()
+    volume.SetIJKToRASMatrix(matrix)
+    volume.SetAndObserveImageData(imageData)
+    volume.EndModify(wasModifying)
+
+
+class PrefetchJob(object):
+
+  __slots__ = ("series", "loader", "geometry", "imageData", "finished", "cancelled")
+
+  def __init__(self, series, loader, geometry):
+    self.series = series
+    self.loader = loader
+    self.geometry = geometry
+    self.imageData = None
+    self.finished = threading.Event()
+    self.cancelled = False
+
+
+class VolumePrefetcher(object):
+  """ Decodes the pixel data of series on a background thread. MRML nodes must be created on the main thread, which is
+  why finished jobs are collected by a polling timer and handed to callback(job) there.
+  """
+
+  POLL_INTERVAL = 100 # unit ms
+
+  def __init__(self, callback):
+    self.callback = callback
+    self.jobs = {}
+    self.jobQueue = Queue.Queue()
+    self.worker = None
+    self.timer = qt.QTimer()
+    self.timer.setInterval(self.POLL_INTERVAL)
+    self.timer.connect('timeout()', self.collectFinishedJobs)
+
+  def isPending(self, series):
+    return series in self.jobs
+
+  def enqueue(self, series, loader, geometry):
+    if series in self.jobs:
+      return self.jobs[series]
+    job = PrefetchJob(series, loader, geometry)
+    self.jobs[series] = job
+    self.jobQueue.put(job)
+    if self.worker is None or not self.worker.is_alive():
+      self.worker = threading.Thread(target=self.processJobs, name="VolumePrefetcher")
+      self.worker.daemon = True
+      self.worker.start()
+    if not self.timer.isActive():
+      self.timer.start()
+    return job
+
+  def processJobs(self):
+    while True:
+      job = self.jobQueue.get()
+      if not job.cancelled:
+        try:
+          job.imageData = job.loader.readImageData(job.geometry)
+        except Exception as exc:
+          logging.warning("Prefetching series %s failed: %s" % (job.series, exc))
+      job.finished.set()
+
+  def collectFinishedJobs(self):
+    for series, job in self.jobs.items():
+      if job.finished.is_set():
+        del self.jobs[series]
+        self.callback(job)
+    if not self.jobs:
+      self.timer.stop()
+
+  def wait(self, series):
+    """ Blocks until the job for series is finished and returns it instead of passing it to the callback
+    """
+    job = self.jobs.pop(series, None)
+    if job is not None:
+      job.finished.wait()
+    return job
+
+  def cancel(self, series):
+    job = self.jobs.pop(series, None)
+    if job is not None:
+      job.cancelled = True
+
+  def clear(self):
+    for job in self.jobs.values():
+      job.cancelled = True
+    self.jobs = {}
+    self.timer.stop()
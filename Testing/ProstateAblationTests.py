@@ -1,9 +1,19 @@
 import unittest
-import os, inspect, slicer
+import os, ast, inspect, shutil, tempfile, time, numpy, slicer
 from ProstateAblationUtils.session import ProstateAblationSession
 from ProstateAblationUtils.sessionData import SessionData
+from ProstateAblationUtils.helpers import CoalescingScheduler, CooperativeTask, SeriesTypeManager
+from ProstateAblationUtils.dicomIndex import DICOMHeaderIndex
+from ProstateAblationUtils.intraopStorage import IntraopStorage
+from ProstateAblationUtils.seriesAssembler import SeriesAssembler
+from ProstateAblationUtils.seriesRegistry import Series, SeriesRegistry
+from ProstateAblationUtils.sliceIntersections import EllipsoidSliceIntersections
+from ProstateAblationUtils.steps.zFrameRegistration import TemplatePathStore
+from ProstateAblationUtils.steps.plugins.targetsDefinitionTable import ZFrameGuidanceComputation
 
-__all__ = ['ProstateAblationSessionTests', 'RegistrationResultsTest']
+__all__ = ['ProstateAblationSessionTests', 'RegistrationResultsTest', 'CoalescingSchedulerTest', 'CooperativeTaskTest',
+           'DICOMHeaderIndexTest', 'EllipsoidSliceIntersectionsTest', 'IntraopStorageTest', 'SeriesAssemblerTest',
+           'SeriesRegistryTest', 'SeriesTypeManagerTest', 'TemplatePathStoreTest', 'ZFrameGuidanceComputationTest']
 
 tempDir =  os.path.join(slicer.app.temporaryPath, "ProstateAblationSessionResults")
 
@@ -50,4 +60,610 @@ class RegistrationResultsTest(unittest.TestCase):
   def test_Writing_json(self):
     self.registrationResults.resumed = True
     self.registrationResults.completed = True
-    self.registrationResults.save(tempDir)
\ No newline at end of file
+    self.registrationResults.save(tempDir)
+
+
+class CoalescingSchedulerTest(unittest.TestCase):
+
+  def runTest(self):
+    self.test_CoalesceKeys()
+    self.test_Cancel()
+
+  def createScheduler(self):
+    self.calls = []
+    return CoalescingScheduler(self.calls.append)
+
+  def test_CoalesceKeys(self):
+    scheduler = self.createScheduler()
+    scheduler.schedule("a")
+    scheduler.schedule("b", "a")
+    self.assertTrue(scheduler.pending)
+    self.assertEqual(self.calls, [])
+    scheduler.flushIfPending()
+    self.assertEqual(self.calls, [set(["a", "b"])])
+    self.assertFalse(scheduler.pending)
+    scheduler.flushIfPending()
+    self.assertEqual(len(self.calls), 1)
+
+  def test_Cancel(self):
+    scheduler = self.createScheduler()
+    scheduler.schedule("a")
+    scheduler.cancel()
+    self.assertFalse(scheduler.pending)
+    scheduler.flushIfPending()
+    self.assertEqual(self.calls, [])
+
+
+class CooperativeTaskTest(unittest.TestCase):
+
+  def runTest(self):
+    self.test_Finish()
+    self.test_TimeSlice()
+    self.test_Cancel()
+
+  def generateWork(self, count):
+    try:
+      for index in range(count):
+        yield index + 1
+    finally:
+      self.closed = True
+
+  def createTask(self, count, **kwargs):
+    self.closed = False
+    self.progress = []
+    self.finished = 0
+    return CooperativeTask(self.generateWork(count), progressCallback=self.progress.append,
+                           finishedCallback=lambda: setattr(self, "finished", self.finished + 1), **kwargs)
+
+  def test_Finish(self):
+    task = self.createTask(5, progressRate=1)
+    task.finish()
+    self.assertFalse(task.running)
+    self.assertEqual(self.finished, 1)
+    # throttled progress reports are skipped, but the last one is always reported
+    self.assertEqual(self.progress, [1, 5])
+
+  def test_TimeSlice(self):
+    task = self.createTask(3, timeSlice=0)
+    task.runTimeSlice()
+    self.assertEqual(self.progress, [1])
+    self.assertTrue(task.running)
+    self.assertTrue(task.timer.isActive())
+    task.finish()
+    self.assertEqual(self.progress, [1, 2, 3])
+    self.assertEqual(self.finished, 1)
+
+  def test_Cancel(self):
+    task = self.createTask(3)
+    task.step()
+    task.cancel()
+    self.assertFalse(task.running)
+    self.assertTrue(self.closed)
+    self.assertEqual(self.finished, 0)
+    self.assertEqual(self.progress, [1])
+
+
+class SeriesTypeManagerTest(unittest.TestCase):
+
+  SETTINGS = {
+    "SERIES_TYPES": ["COVER TEMPLATE", "COVER PROSTATE", "GUIDANCE", "NEEDLE GUIDANCE", "NEEDLE"],
+    "COVER_PROSTATE": ["COVER PROSTATE", "GUIDANCE"],
+    "COVER_TEMPLATE": "COVER TEMPLATE",
+    "NEEDLE_IMAGE": ["NEEDLE GUIDANCE", "NEEDLE"],
+    "VIBE_IMAGE": ["VIBE"],
+    "OTHER_IMAGE": ["OTHER"]
+  }
+
+  def setUp(self):
+    self.seriesTypeManager = SeriesTypeManager()
+    self.originalSettings = dict((name, self.seriesTypeManager.getSetting(name)) for name in self.SETTINGS)
+    self.applySettings(self.SETTINGS)
+    self.seriesTypeManager.clear()
+
+  def tearDown(self):
+    self.applySettings(self.originalSettings)
+    self.seriesTypeManager.clear()
+
+  def applySettings(self, settings):
+    for name, value in settings.items():
+      if value is not None:
+        self.seriesTypeManager.setSetting(name, value)
+
+  def runTest(self):
+    self.test_Precedence()
+    self.test_OverlappingKeywords()
+    self.test_ManualAssignment()
+    self.test_SettingsChanged()
+
+  def test_Precedence(self):
+    manager = self.seriesTypeManager
+    self.assertEqual(manager.getSeriesType("3: COVER PROSTATE VIBE"), "COVER PROSTATE")
+    self.assertEqual(manager.getSeriesType("4: VIBE NEEDLE"), "NEEDLE")
+    self.assertEqual(manager.getSeriesType("5: COVER TEMPLATE"), "COVER TEMPLATE")
+    self.assertTrue(manager.isCoverTemplate("5: COVER TEMPLATE"))
+    self.assertFalse(manager.isCoverTemplate("6: TEMPLATE"))
+    self.assertEqual(manager.getSeriesType("7: OTHER VIBE"), "VIBE")
+    self.assertEqual(manager.getSeriesType("8: OTHER"), "OTHER")
+    self.assertIsNone(manager.getSeriesType("9: LOCALIZER"))
+    self.assertTrue(manager.isOther("8: OTHER"))
+    self.assertTrue(manager.isOther("9: LOCALIZER"))
+    self.assertTrue(manager.isWorkableSeries("7: OTHER VIBE"))
+
+  def test_OverlappingKeywords(self):
+    manager = self.seriesTypeManager
+    # both "NEEDLE GUIDANCE" and the contained "GUIDANCE" match, the cover prostate keyword takes precedence
+    self.assertEqual(manager.getMatchedKeywords("10: NEEDLE GUIDANCE"), set(["NEEDLE GUIDANCE", "NEEDLE", "GUIDANCE"]))
+    self.assertEqual(manager.getSeriesType("10: NEEDLE GUIDANCE"), "GUIDANCE")
+    self.assertTrue(manager.isCoverProstate("10: NEEDLE GUIDANCE"))
+    self.assertTrue(manager.isGuidance("10: NEEDLE GUIDANCE"))
+    self.assertFalse(manager.isGuidance("11: GUIDANCE"))
+
+  def test_ManualAssignment(self):
+    manager = self.seriesTypeManager
+    self.assignedEvents = 0
+    manager.addEventObserver(manager.SeriesTypeManuallyAssignedEvent, self.onSeriesTypeManuallyAssigned)
+    self.assertTrue(manager.isCoverProstate("12: COVER PROSTATE"))
+    manager.assign("12: COVER PROSTATE", "NEEDLE")
+    self.assertEqual(self.assignedEvents, 1)
+    self.assertEqual(manager.getSeriesType("12: COVER PROSTATE"), "NEEDLE")
+    self.assertFalse(manager.isCoverProstate("12: COVER PROSTATE"))
+    self.assertTrue(manager.isGuidance("12: COVER PROSTATE"))
+    manager.assign("13: LOCALIZER")
+    self.assertTrue(manager.isOther("13: LOCALIZER"))
+    manager.removeEventObserver(manager.SeriesTypeManuallyAssignedEvent, self.onSeriesTypeManuallyAssigned)
+
+  def onSeriesTypeManuallyAssigned(self, caller, event):
+    self.assignedEvents += 1
+
+  def test_SettingsChanged(self):
+    manager = self.seriesTypeManager
+    self.assertEqual(manager.getSeriesType("14: T2 AX"), None)
+    manager.setSetting("COVER_PROSTATE", ["T2 AX"])
+    self.assertEqual(manager.getSeriesType("14: T2 AX"), "T2 AX")
+    self.assertTrue(manager.isCoverProstate("14: T2 AX"))
+    self.assertFalse(manager.isCoverProstate("10: NEEDLE GUIDANCE"))
+
+
+class SeriesAssemblerTest(unittest.TestCase):
+
+  def createAssembler(self):
+    self.assembler = SeriesAssembler(stallTimeout=30)
+    self.completed = []
+    self.stalled = []
+    self.assembler.addEventObserver(self.assembler.SeriesCompletedEvent,
+                                    lambda caller, event, callData: self.completed.extend(ast.literal_eval(callData)))
+    self.assembler.addEventObserver(self.assembler.SeriesStalledEvent,
+                                    lambda caller, event, callData: self.stalled.extend(ast.literal_eval(callData)))
+
+
+  def tearDown(self):
+    if getattr(self, "assembler", None):
+      self.assembler.clear()
+
+  def runTest(self):
+    self.test_CompleteWithExpectedNumberOfFiles()
+    self.test_CompleteOnFinishedTransfer()
+    self.test_CompleteAfterStabilization()
+    self.test_Stalled()
+
+  def setArrivalTime(self, series, secondsAgo):
+    self.assembler.states[series].lastArrivalTime = time.time() - secondsAgo
+
+  def test_CompleteWithExpectedNumberOfFiles(self):
+    self.createAssembler()
+    self.assembler.update("1: T2", [1, 2], imagesInAcquisition=3)
+    self.assembler.evaluatePendingSeries()
+    self.assertEqual(self.assembler.getState("1: T2"), SeriesAssembler.PARTIAL)
+    self.assembler.update("1: T2", [1, 2, 3], imagesInAcquisition=3)
+    self.assembler.evaluatePendingSeries()
+    self.assertTrue(self.assembler.isComplete("1: T2"))
+    self.assertEqual(self.completed, ["1: T2"])
+    self.assertEqual(SeriesAssembler.computeExpectedNumberOfFiles(60, 20), 3)
+    self.assertEqual(SeriesAssembler.computeExpectedNumberOfFiles(None, 20), 1)
+    self.assertIsNone(SeriesAssembler.computeExpectedNumberOfFiles(None, None))
+
+  def test_CompleteOnFinishedTransfer(self):
+    self.createAssembler()
+    self.assembler.update("2: T2", [1, 2], imagesInAcquisition=3, transferFinished=True)
+    self.assembler.evaluatePendingSeries()
+    self.assertTrue(self.assembler.isComplete("2: T2"))
+    self.assertEqual(self.completed, ["2: T2"])
+
+  def test_CompleteAfterStabilization(self):
+    self.createAssembler()
+    self.assembler.update("3: T2", [1, 2, 4])
+    self.setArrivalTime("3: T2", SeriesAssembler.STABILIZATION_TIME + 1)
+    self.assembler.evaluatePendingSeries()
+    self.assertEqual(self.assembler.getState("3: T2"), SeriesAssembler.PARTIAL)
+    self.assembler.update("3: T2", [1, 2, 3, 4])
+    self.assembler.evaluatePendingSeries()
+    self.assertEqual(self.assembler.getState("3: T2"), SeriesAssembler.PARTIAL)
+    self.setArrivalTime("3: T2", SeriesAssembler.STABILIZATION_TIME + 1)
+    self.assembler.evaluatePendingSeries()
+    self.assertTrue(self.assembler.isComplete("3: T2"))
+
+  def test_Stalled(self):
+    self.createAssembler()
+    self.assembler.update("4: T2", [1, 2], imagesInAcquisition=3)
+    self.setArrivalTime("4: T2", 31)
+    self.assembler.evaluatePendingSeries()
+    self.assertEqual(self.assembler.getState("4: T2"), SeriesAssembler.STALLED)
+    self.assertEqual(self.stalled, ["4: T2"])
+    self.assembler.update("4: T2", [1, 2, 3], imagesInAcquisition=3)
+    self.assembler.evaluatePendingSeries()
+    self.assertTrue(self.assembler.isComplete("4: T2"))
+    self.assertEqual(self.completed, ["4: T2"])
+
+
+class SeriesRegistryTest(unittest.TestCase):
+
+  def runTest(self):
+    self.test_OrderedBySeriesNumber()
+    self.test_ReplaceAndRemove()
+
+  def createRegistry(self, numbers):
+    registry = SeriesRegistry()
+    for number in numbers:
+      registry.add(Series(number, "T2", "%d: T2" % number, uid="1.2.%d" % number))
+    return registry
+
+  def test_OrderedBySeriesNumber(self):
+    registry = self.createRegistry([7, 2, 10, 5])
+    self.assertEqual(len(registry), 4)
+    self.assertEqual(registry.numbers, [2, 5, 7, 10])
+    self.assertEqual(registry.names, ["2: T2", "5: T2", "7: T2", "10: T2"])
+    self.assertEqual([series.number for series in registry], [2, 5, 7, 10])
+    self.assertEqual(registry.first().number, 2)
+    self.assertTrue("10: T2" in registry)
+    self.assertIs(registry.get("5: T2"), registry.getByNumber(5))
+    self.assertIs(registry.getByUID("1.2.7"), registry.getByNumber(7))
+    self.assertEqual(registry.sortNames(["10: T2", "unknown", "2: T2"]), ["unknown", "2: T2", "10: T2"])
+
+  def test_ReplaceAndRemove(self):
+    registry = self.createRegistry([3, 1])
+    registry.add(Series(3, "T2 COVER", "3: T2 COVER"))
+    self.assertEqual(registry.names, ["1: T2", "3: T2 COVER"])
+    self.assertFalse("3: T2" in registry)
+    self.assertIsNone(registry.getByUID("1.2.3"))
+
+    removed = registry.remove(1)
+    self.assertEqual(removed.name, "1: T2")
+    self.assertIsNone(registry.remove(1))
+    self.assertEqual(registry.numbers, [3])
+    self.assertIsNone(registry.get("1: T2"))
+    registry.clear()
+    self.assertIsNone(registry.first())
+
+
+def createTemplatePaths():
+  """ Two needle paths along the z axis, A1 at the origin with a depth of 100 mm and B1 at x=10 mm with 50 mm """
+  templatePaths = TemplatePathStore()
+  templatePaths.load([["A", "1"], ["B", "1"]], [[0, 0, 0, 0, 0, 2, 100],
+                                                [10, 0, 0, 10, 0, 5, 50]])
+  return templatePaths
+
+
+class TemplatePathStoreTest(unittest.TestCase):
+
+  def runTest(self):
+    self.test_Load()
+    self.test_WorldMatrix()
+
+  def test_Load(self):
+    templatePaths = createTemplatePaths()
+    self.assertEqual(len(templatePaths), 2)
+    self.assertEqual(templatePaths.templateIndex, [["A", "1"], ["B", "1"]])
+    self.assertTrue(numpy.allclose(templatePaths.vectors, [[0, 0, 1], [0, 0, 1]]))
+    self.assertTrue(numpy.allclose(templatePaths.origins, [[0, 0, 0], [10, 0, 0]]))
+    self.assertTrue(numpy.allclose(templatePaths.maxDepths, [100, 50]))
+    templatePaths.clear()
+    self.assertEqual(len(templatePaths), 0)
+    self.assertEqual(templatePaths.origins.shape, (0, 3))
+
+  def test_WorldMatrix(self):
+    templatePaths = createTemplatePaths()
+    version = templatePaths.version
+    self.assertFalse(templatePaths.setWorldMatrix(numpy.identity(4)))
+    self.assertEqual(templatePaths.version, version)
+
+    # rotation by 90 degrees around the x axis followed by a translation
+    matrix = [[1, 0, 0, 1],
+              [0, 0, -1, 2],
+              [0, 1, 0, 3],
+              [0, 0, 0, 1]]
+    self.assertTrue(templatePaths.setWorldMatrix(matrix))
+    self.assertEqual(templatePaths.version, version + 1)
+    self.assertTrue(numpy.allclose(templatePaths.origins, [[1, 2, 3], [11, 2, 3]]))
+    self.assertTrue(numpy.allclose(templatePaths.vectors, [[0, -1, 0], [0, -1, 0]]))
+    self.assertTrue(numpy.allclose(templatePaths.templateOrigins, [[0, 0, 0], [10, 0, 0]]))
+    self.assertFalse(templatePaths.setWorldMatrix(numpy.array(matrix, dtype=float)))
+
+
+class ZFrameGuidanceComputationTest(unittest.TestCase):
+
+  class ZFrameRegistration(object):
+
+    def __init__(self, templatePaths):
+      self.templatePaths = templatePaths
+
+  def runTest(self):
+    self.test_NearestPaths()
+    self.test_NoTemplateOrTargets()
+
+  def createComputation(self, templatePaths):
+    # the computation is not initialized, so that it is neither bound to the zFrame registration step logic nor to a
+    # target list
+    computation = ZFrameGuidanceComputation.__new__(ZFrameGuidanceComputation)
+    computation.zFrameRegistration = self.ZFrameRegistration(templatePaths)
+    computation._targetListReference = None
+    computation.targetListID = None
+    return computation
+
+  def test_NearestPaths(self):
+    computation = self.createComputation(createTemplatePaths())
+    starts, ends, indexesX, indexesY, depths, inRange = \
+      computation.computeNearestPaths([[1, 0, 20], [9, 1, 60], [-1, 0, -5], [6, 0, 10]])
+    self.assertEqual(indexesX, ["A", "B", "A", "B"])
+    self.assertEqual(indexesY, ["1", "1", "1", "1"])
+    self.assertTrue(numpy.allclose(depths, [20, 60, -5, 10]))
+    self.assertEqual(list(inRange), [True, False, False, True])
+    self.assertTrue(numpy.allclose(starts, [[0, 0, 0], [10, 0, 0], [0, 0, 0], [10, 0, 0]]))
+    self.assertTrue(numpy.allclose(ends, [[0, 0, 100], [10, 0, 50], [0, 0, 100], [10, 0, 50]]))
+
+    start, end = computation.getNeedleStartEndPointFromPathOrigins(1)
+    self.assertTrue(numpy.allclose(start, [10, 0, 0]))
+    self.assertTrue(numpy.allclose(end, [10, 0, 50]))
+
+  def test_NoTemplateOrTargets(self):
+    computation = self.createComputation(TemplatePathStore())
+    starts, ends, indexesX, indexesY, depths, inRange = computation.computeNearestPaths([[1, 0, 20]])
+    self.assertTrue(numpy.isnan(starts).all())
+    self.assertEqual(indexesX, ["--"])
+    self.assertEqual(list(inRange), [False])
+
+    computation = self.createComputation(createTemplatePaths())
+    starts, ends, indexesX, indexesY, depths, inRange = computation.computeNearestPaths(numpy.zeros((0, 3)))
+    self.assertEqual(starts.shape, (0, 3))
+    self.assertEqual(indexesX, [])
+
+
+class EllipsoidSliceIntersectionsTest(unittest.TestCase):
+
+  def runTest(self):
+    self.test_SphereIntersection()
+    self.test_EllipsoidIntersection()
+
+  def createXYToRAS(self, spacing, offset):
+    xyToRAS = numpy.identity(4)
+    xyToRAS[0:3, 0:3] *= spacing
+    xyToRAS[0:3, 3] = offset
+    return xyToRAS
+
+  def test_SphereIntersection(self):
+    centers = [[0, 0, 0], [0, 0, 30]]
+    halfAxes = [10 * numpy.identity(3)] * 2
+    # the slice at z=6 cuts the first sphere in a circle of radius 8 and misses the second one
+    xyToRAS = self.createXYToRAS(1.0, [-50, -50, 6])
+    centersXY, halfAxesXY = EllipsoidSliceIntersections.computeSliceEllipses(numpy.array(centers, dtype=float),
+                                                                               numpy.array(halfAxes), xyToRAS)
+    self.assertTrue(numpy.allclose(centersXY, [[50, 50]]))
+    self.assertTrue(numpy.allclose(numpy.linalg.norm(halfAxesXY[0], axis=0), [8, 8]))
+
+    contours = EllipsoidSliceIntersections.createContourPoints(centersXY, halfAxesXY, 16)
+    self.assertEqual(contours.shape, (1, 2, 16))
+    self.assertTrue(numpy.allclose(numpy.linalg.norm(contours[0] - centersXY[0][:, numpy.newaxis], axis=0), 8))
+
+    centersXY, halfAxesXY = EllipsoidSliceIntersections.computeSliceEllipses(numpy.zeros((0, 3)),
+                                                                               numpy.zeros((0, 3, 3)), xyToRAS)
+    self.assertEqual(centersXY.shape, (0, 2))
+
+  def test_EllipsoidIntersection(self):
+    halfAxes = numpy.array([numpy.diag([10.0, 20.0, 5.0])])
+    xyToRAS = self.createXYToRAS(0.5, [0, 0, 0])
+    centersXY, halfAxesXY = EllipsoidSliceIntersections.computeSliceEllipses(numpy.zeros((1, 3)), halfAxes, xyToRAS)
+    self.assertTrue(numpy.allclose(centersXY, [[0, 0]]))
+    # with 0.5 mm per pixel the half axes of 20 mm along y and 10 mm along x span 40 and 20 pixels
+    self.assertTrue(numpy.allclose(numpy.abs(halfAxesXY[0]), [[0, 20], [40, 0]]))
+
+    xyToRAS = self.createXYToRAS(0.5, [0, 0, 5])
+    centersXY, halfAxesXY = EllipsoidSliceIntersections.computeSliceEllipses(numpy.zeros((1, 3)), halfAxes, xyToRAS)
+    self.assertEqual(len(centersXY), 0)
+
+
+def createIndexedFiles(directory, headerIndex, files):
+  """ Writes dummy files and indexes them with the given headers, files maps file names to (seriesNumber, uid) """
+  for fileName, (seriesNumber, uid) in sorted(files.items()):
+    with open(os.path.join(directory, fileName), 'w') as dummyFile:
+      dummyFile.write(fileName)
+    headerIndex.addEntry(fileName, {"SeriesNumber": str(seriesNumber), "SOPInstanceUID": uid,
+                                    "InstanceNumber": fileName[-1], "ImagesInAcquisition": "3"},
+                         headerIndex.getFileStat(fileName))
+
+
+class DICOMHeaderIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directories = []
+
+  def tearDown(self):
+    for directory in self.directories:
+      shutil.rmtree(directory)
+
+  def runTest(self):
+    self.test_DuplicateInstances()
+    self.test_RewrittenFile()
+    self.test_MoveDuplicates()
+    self.test_SaveAndLoad()
+    self.test_ThreadPool()
+
+  def createHeaderIndex(self):
+    self.directory = tempfile.mkdtemp()
+    self.directories.append(self.directory)
+    self.headerIndex = DICOMHeaderIndex(self.directory, os.path.join(self.directory, ".index.json"))
+
+  def getSeriesFiles(self, seriesNumber):
+    return [os.path.relpath(f, self.directory) for f in self.headerIndex.getFilesForSeries(seriesNumber)]
+
+  def test_DuplicateInstances(self):
+    self.createHeaderIndex()
+    createIndexedFiles(self.directory, self.headerIndex, {"img2": (5, "u2"), "img1": (5, "u1")})
+    createIndexedFiles(self.directory, self.headerIndex, {"dup1": (5, "u1"), "other1": (5, "u1")})
+    self.assertTrue(self.headerIndex.isDuplicate("dup1"))
+    self.assertTrue(self.headerIndex.isDuplicate("other1"))
+    self.assertFalse(self.headerIndex.isDuplicate("img1"))
+    self.assertIsNone(self.headerIndex.getSeriesNumberForFile("dup1"))
+    self.assertTrue(self.headerIndex.hasInstance("u1"))
+    self.assertFalse(self.headerIndex.hasInstance("u3"))
+    self.assertEqual(self.getSeriesFiles(5), ["img1", "img2"])
+    self.assertFalse(self.headerIndex.addEntry("dup1", {"SeriesNumber": "5", "SOPInstanceUID": "u1"},
+                                               self.headerIndex.getFileStat("dup1")))
+
+    # the first remaining duplicate takes the place of a removed original
+    self.headerIndex.remove("img1")
+    self.assertFalse(self.headerIndex.isDuplicate("dup1"))
+    self.assertEqual(self.headerIndex.getSeriesNumberForFile("dup1"), 5)
+    self.assertEqual(self.headerIndex.entries["other1"]["DuplicateOf"], "dup1")
+    self.assertEqual(self.getSeriesFiles(5), ["dup1", "img2"])
+
+    duplicates = self.headerIndex.removeSeries(5)
+    self.assertEqual(duplicates, [os.path.join(self.directory, "other1")])
+    self.assertEqual(self.getSeriesFiles(5), [])
+    self.assertEqual(len(self.headerIndex), 0)
+    self.assertFalse(self.headerIndex.hasInstance("u1"))
+
+  def test_RewrittenFile(self):
+    self.createHeaderIndex()
+    createIndexedFiles(self.directory, self.headerIndex, {"img1": (5, "u1")})
+    createIndexedFiles(self.directory, self.headerIndex, {"dup1": (5, "u1")})
+    fileStat = self.headerIndex.getFileStat("img1")
+    # resending the same instance into the same file is not a new instance
+    self.assertFalse(self.headerIndex.addEntry("img1", {"SeriesNumber": "5", "SOPInstanceUID": "u1"}, fileStat))
+    self.assertTrue(self.headerIndex.isDuplicate("dup1"))
+    # overwriting the file with another instance promotes the duplicate of the previous one
+    self.assertTrue(self.headerIndex.addEntry("img1", {"SeriesNumber": "5", "SOPInstanceUID": "u9"}, fileStat))
+    self.assertFalse(self.headerIndex.isDuplicate("dup1"))
+    self.assertEqual(sorted(self.getSeriesFiles(5)), ["dup1", "img1"])
+
+  def test_MoveDuplicates(self):
+    self.createHeaderIndex()
+    createIndexedFiles(self.directory, self.headerIndex, {"img1": (5, "u1")})
+    createIndexedFiles(self.directory, self.headerIndex, {"dup1": (5, "u1")})
+    seriesDirectory = os.path.join(self.directory, "Series5")
+    os.makedirs(seriesDirectory)
+    moves = {"img1": os.path.join("Series5", "img1")}
+    os.rename(os.path.join(self.directory, "img1"), os.path.join(seriesDirectory, "img1"))
+    self.headerIndex.moveFiles(moves)
+    self.assertEqual(self.getSeriesFiles(5), [moves["img1"]])
+    self.assertEqual(self.headerIndex.entries["dup1"]["DuplicateOf"], moves["img1"])
+    self.assertEqual(self.headerIndex.resolveMovedFile("img1"), moves["img1"])
+    self.assertEqual(self.headerIndex.resolveMovedFile("dup1"), "dup1")
+
+    self.headerIndex.remove(moves["img1"])
+    self.assertFalse(self.headerIndex.isDuplicate("dup1"))
+    self.assertEqual(self.getSeriesFiles(5), ["dup1"])
+
+  def test_SaveAndLoad(self):
+    self.createHeaderIndex()
+    createIndexedFiles(self.directory, self.headerIndex, {"img1": (5, "u1"), "img2": (6, "u2")})
+    createIndexedFiles(self.directory, self.headerIndex, {"dup1": (5, "u1")})
+    self.headerIndex.save()
+    self.assertFalse(self.headerIndex.modified)
+    reopenedIndex = DICOMHeaderIndex(self.directory, self.headerIndex.sidecarFileName)
+    reopenedIndex.load()
+    self.assertEqual(len(reopenedIndex), 3)
+    self.assertTrue(reopenedIndex.isDuplicate("dup1"))
+    self.assertEqual(reopenedIndex.getFilesForSeries(5), self.headerIndex.getFilesForSeries(5))
+    self.assertEqual(reopenedIndex.getFilesForSeries(6), self.headerIndex.getFilesForSeries(6))
+    # files which did not change on disk are not parsed again
+    self.assertEqual(reopenedIndex.update([os.path.join(self.directory, f) for f in ["img1", "img2", "dup1"]]), [])
+
+  def test_ThreadPool(self):
+    self.createHeaderIndex()
+    # the pool is created once and kept for all following updates until the index is cancelled
+    pool = self.headerIndex.getPool()
+    self.assertIs(self.headerIndex.getPool(), pool)
+    self.headerIndex.cancel()
+    self.assertIsNone(self.headerIndex.pool)
+    self.headerIndex.cancel()
+    self.assertIsNot(self.headerIndex.getPool(), pool)
+    self.headerIndex.cancel()
+
+
+class IntraopStorageTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directories = []
+
+  def tearDown(self):
+    for directory in self.directories:
+      shutil.rmtree(directory)
+
+  def runTest(self):
+    self.test_PartitionAndFinishedTransfer()
+    self.test_ResentInstance()
+
+  def createStorage(self):
+    self.directory = tempfile.mkdtemp()
+    self.directories.append(self.directory)
+    self.headerIndex = DICOMHeaderIndex(self.directory, os.path.join(self.directory, ".index.json"))
+    self.storage = IntraopStorage(self.directory, partitionBySeries=True)
+
+  def partition(self, relativePaths):
+    moves = self.storage.partition(relativePaths, lambda f: self.headerIndex.getIntegerValue(f, "SeriesNumber"))
+    self.headerIndex.moveFiles(moves)
+    return moves
+
+  def test_PartitionAndFinishedTransfer(self):
+    self.createStorage()
+    # the watcher reports the first two files, which are moved into their series directory
+    createIndexedFiles(self.directory, self.headerIndex, {"img1": (5, "u1"), "img2": (5, "u2")})
+    moves = self.partition(["img1", "img2"])
+    self.assertEqual(moves, {"img1": os.path.join("Series5", "img1"), "img2": os.path.join("Series5", "img2")})
+    self.assertEqual(self.storage.listFiles(), [os.path.join("Series5", "img1"), os.path.join("Series5", "img2")])
+
+    # the receiver reports all files of the finished transfer by their flat names
+    createIndexedFiles(self.directory, self.headerIndex, {"img3": (5, "u3")})
+    self.partition(["img3"])
+    finishedFiles = [self.headerIndex.resolveMovedFile(f) for f in ["img1", "img2", "img3"]]
+    for fileName in finishedFiles:
+      self.assertTrue(os.path.isfile(os.path.join(self.directory, fileName)))
+    self.assertEqual(self.headerIndex.update([os.path.join(self.directory, f) for f in finishedFiles]), [])
+    files = self.headerIndex.getFilesForSeries(5)
+    self.assertEqual([os.path.relpath(f, self.directory) for f in files], finishedFiles)
+
+    assembler = SeriesAssembler()
+    assembler.update("5: test", [self.headerIndex.getIntegerValue(f, "InstanceNumber") for f in files],
+                     imagesInAcquisition=3, transferFinished=True)
+    assembler.evaluatePendingSeries()
+    self.assertTrue(assembler.isComplete("5: test"))
+
+    # moves survive reopening the case
+    self.headerIndex.save()
+    reopenedIndex = DICOMHeaderIndex(self.directory, self.headerIndex.sidecarFileName)
+    reopenedIndex.load()
+    self.assertEqual(reopenedIndex.resolveMovedFile("img3"), os.path.join("Series5", "img3"))
+    self.assertEqual(reopenedIndex.getFilesForSeries(5), files)
+
+    self.storage.deleteSeries(5)
+    self.assertFalse(os.path.exists(self.storage.getSeriesDirectory(5)))
+
+  def test_ResentInstance(self):
+    self.createStorage()
+    createIndexedFiles(self.directory, self.headerIndex, {"img1": (6, "v1"), "img2": (6, "v2")})
+    self.partition(["img1", "img2"])
+    original = os.path.join("Series6", "img1")
+
+    # the resent file has the name of a moved file and is stored next to it
+    createIndexedFiles(self.directory, self.headerIndex, {"img1": (6, "v1")})
+    self.assertTrue(self.headerIndex.isDuplicate("img1"))
+    moves = self.partition(["img1"])
+    self.assertEqual(moves, {"img1": os.path.join("Series6", "img1.1")})
+    self.assertFalse(os.path.exists(os.path.join(self.directory, "img1")))
+    self.assertTrue(self.headerIndex.isDuplicate(moves["img1"]))
+    self.assertEqual(self.headerIndex.entries[moves["img1"]]["DuplicateOf"], original)
+    self.assertEqual(self.headerIndex.resolveMovedFile("img1"), original)
+    self.assertEqual(self.storage.getManifest(6), ["img1", "img2", "img1.1"])
+
+    duplicates = self.headerIndex.removeSeries(6)
+    self.assertEqual(duplicates, [os.path.join(self.directory, moves["img1"])])
+    self.assertEqual(self.headerIndex.movedFiles, {})